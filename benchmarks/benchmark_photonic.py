@@ -0,0 +1,223 @@
+"""
+Benchmarks for the photonic-to-qubit mapping and the simulation paths
+Times (best of --repeat runs) and peak memory (tracemalloc) are written as json
+so that runs can be compared, e.g.:
+python benchmark_photonic.py --output before.json
+python benchmark_photonic.py --output after.json --compare before.json
+"""
+import argparse
+import itertools
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy
+import tequila as tq
+
+import photonic
+from photonic import PhotonicPaths, PhotonicSetup, PhotonicStateVector
+from photonic import serialization
+from photonic.elements import operator_cache
+
+PATHNAMES = ['a', 'b', 'c', 'd', 'e', 'f']
+
+
+def measure(prepare, repeat: int = 3) -> dict:
+    """
+    :param prepare: function without arguments which returns the function which is benchmarked
+                    (preparation is not timed, it is called again before every run)
+    :param repeat: number of timed runs
+    :return: dictionary with best/mean time in seconds and peak memory in bytes
+    """
+    times = []
+    for _ in range(repeat):
+        run = prepare()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    run = prepare()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"best": min(times), "mean": sum(times) / len(times), "peak_memory": peak}
+
+
+def cold(function):
+    # operators are built from scratch
+    def prepare():
+        operator_cache.clear()
+        return function
+
+    return prepare
+
+
+def warm(function):
+    return lambda: function
+
+
+def product_state(paths: PhotonicPaths, photons: int) -> str:
+    # one photon in mode 0 of the first paths
+    result = ""
+    for k, pname in enumerate(paths.keys()):
+        occs = ["0"] * (2 * paths.S + 1)
+        if k < photons:
+            occs[paths.S] = "1"
+        result += "|" + "".join(occs) + ">_" + str(pname)
+    return result
+
+
+def hom_setup(qpm: int = 2, steps: int = 20) -> PhotonicSetup:
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=qpm)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, steps=steps)
+    return setup
+
+
+def setup_332(steps: int = 1) -> PhotonicSetup:
+    setup = PhotonicSetup(pathnames=['a', 'b', 'c', 'd'], S=1, qpm=1)
+    setup.prepare_SPDC_state(path_a='a', path_b='b')
+    setup.prepare_SPDC_state(path_a='c', path_b='d')
+    setup.add_beamsplitter(path_a='b', path_b='c', t=0.25, steps=steps)
+    setup.add_doveprism(path='c', t=0.5)
+    setup.add_beamsplitter(path_a='b', path_b='c', t=0.25, steps=steps)
+    setup.add_one_photon_projector(path='a')
+    return setup
+
+
+def crespi_setup(qpm: int = 2, steps: int = 1) -> PhotonicSetup:
+    bs_parameters = [numpy.arcsin(p) / numpy.pi for p in [0.19, 0.55, 0.4, 0.76, 0.54, 0.95, 0.48, 0.99, 0.51, 0.44]]
+    phases = [p / numpy.pi for p in [2.21, 0.64, 1.08, 1.02, 1.37, 2.58, 2.93, 1.1]]
+    network = [('a', 'b', None), ('b', 'c', 'b'), ('a', 'b', 'a'), ('c', 'd', 'c'), ('b', 'c', 'c'), ('d', 'e', None),
+               ('a', 'b', 'b'), ('c', 'd', 'c'), ('b', 'c', 'b'), ('a', 'b', 'b')]
+    setup = PhotonicSetup(pathnames=['a', 'b', 'c', 'd', 'e'], S=0, qpm=qpm)
+    phase = iter(phases)
+    for k, (t, (path_a, path_b, shifted)) in enumerate(zip(bs_parameters, network)):
+        if shifted is not None:
+            setup.add_phase_shifter(path=shifted, t=-next(phase))
+        setup.add_beamsplitter(path_a=path_a, path_b=path_b, t=t, phi=0, steps=steps)
+        if k == 0:
+            setup.add_phase_shifter(path='a', t=-1)
+            setup.add_phase_shifter(path='b', t=-1)
+    return setup
+
+
+def grid(**kwargs):
+    keys = list(kwargs.keys())
+    for values in itertools.product(*[kwargs[k] for k in keys]):
+        yield dict(zip(keys, values))
+
+
+def benchmarks(quick: bool = False):
+    """
+    :return: iterator over (name, parameters, prepare)
+    """
+    n_paths = [2, 4] if quick else [2, 4, 6]
+    spins = [0, 1] if quick else [0, 1, 2]
+    qpms = [1, 2] if quick else [1, 2, 3]
+    steps = [1, 5] if quick else [1, 5, 20]
+
+    for p in grid(paths=n_paths, S=spins, qpm=qpms):
+        yield "PhotonicPaths", p, warm(lambda p=p: PhotonicPaths(path_names=PATHNAMES[:p["paths"]], S=p["S"],
+                                                                  qpm=p["qpm"]))
+
+    for p in grid(qpm=qpms):
+        qubits = list(range(p["qpm"]))
+        yield "creation", p, cold(lambda qubits=qubits: photonic.creation(qubits))
+        yield "anihilation", p, cold(lambda qubits=qubits: photonic.anihilation(qubits))
+
+    for p in grid(S=spins, qpm=qpms, steps=steps):
+        def prepare(p=p):
+            operator_cache.clear()
+            setup = PhotonicSetup(pathnames=['a', 'b'], S=p["S"], qpm=p["qpm"])
+            return lambda: setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, steps=p["steps"])
+
+        yield "add_beamsplitter", p, prepare
+
+    for p in grid(paths=n_paths, S=spins, qpm=qpms):
+        paths = PhotonicPaths(path_names=PATHNAMES[:p["paths"]], S=p["S"], qpm=p["qpm"])
+        string = "+".join("1.0" + product_state(paths, photons=k) for k in range(p["paths"] + 1))
+        yield "from_string", p, warm(lambda paths=paths, string=string: PhotonicStateVector.from_string(
+            paths=paths, string=string))
+
+    for p in grid(paths=n_paths, S=[0, 1], qpm=[1, 2], states=[100] if quick else [100, 10000]):
+        paths = PhotonicPaths(path_names=PATHNAMES[:p["paths"]], S=p["S"], qpm=p["qpm"])
+        # seeded, so that runs can be compared
+        keys = numpy.unique(numpy.random.default_rng(1).integers(0, 2 ** paths.n_qubits, size=p["states"]))
+        state = tq.QubitWaveFunction(state={tq.BitString.from_int(integer=int(k), nbits=paths.n_qubits): 1.0
+                                            for k in keys})
+        # repr of a fresh state vector, includes the decoding of the keys
+        yield "repr", p, warm(lambda paths=paths, state=state: repr(PhotonicStateVector(paths=paths, state=state)))
+
+    # canonical workloads
+    for p in grid(qpm=[2] if quick else [2, 3], steps=[1, 20]):
+        setup = hom_setup(qpm=p["qpm"], steps=p["steps"])
+        yield "hom_simulate_wavefunction", p, warm(lambda setup=setup: setup.simulate_wavefunction(
+            initial_state="|1>_a|1>_b"))
+        for engine in ["fock", "qubit"]:
+            yield "hom_sample", dict(p, engine=engine), warm(lambda setup=setup, engine=engine: setup.sample(
+                samples=1000, initial_state="|1>_a|1>_b", engine=engine))
+
+    setup = setup_332()
+    yield "332_simulate_wavefunction", {"steps": 1}, warm(lambda: setup.simulate_wavefunction())
+
+    for p in grid(qpm=[2], steps=[1], engine=["fock"] if quick else ["fock", "qubit"]):
+        setup = crespi_setup(qpm=p["qpm"], steps=p["steps"])
+        yield "crespi_simulate_wavefunction", p, warm(lambda setup=setup, p=p: setup.simulate_wavefunction(
+            initial_state="|1>_a|0>_b|1>_c|0>_d|1>_e", engine=p["engine"]))
+
+    # all inputs with one photon in three of the five paths
+    setup = crespi_setup(qpm=2)
+    inputs = ["".join("|{}>_{}".format(int(p in occupied), p) for p in PATHNAMES[:5])
+              for occupied in itertools.combinations(PATHNAMES[:5], 3)]
+    yield "crespi_transfer_table", {"inputs": len(inputs)}, warm(lambda: setup.transfer_table(inputs=inputs))
+
+    # reload of a stored setup with and without the stored operators
+    for p in grid(operators=[True, False]):
+        string = serialization.dumps(crespi_setup(qpm=2), operators=p["operators"])
+        yield "crespi_load", p, cold(lambda string=string: serialization.loads(string))
+
+
+def compare(results: list, baseline: list, tolerance: float = 0.2, min_time: float = 1.e-3) -> list:
+    """
+    :return: list of (name, parameters, ratio) for all benchmarks which are slower than the baseline by more than
+             the tolerance (benchmarks faster than min_time in both runs are too noisy and ignored)
+    """
+    reference = {(r["name"], json.dumps(r["parameters"], sort_keys=True)): r for r in baseline}
+    result = []
+    for r in results:
+        key = (r["name"], json.dumps(r["parameters"], sort_keys=True))
+        if key in reference and max(r["best"], reference[key]["best"]) >= min_time:
+            ratio = r["best"] / reference[key]["best"]
+            if ratio > 1.0 + tolerance:
+                result.append((r["name"], r["parameters"], ratio))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="photonic benchmarks")
+    parser.add_argument("--output", type=str, default="benchmark_photonic.json", help="where the results are written")
+    parser.add_argument("--compare", type=str, default=None, help="results of an earlier run")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument("--quick", action="store_true", help="smaller parameter grid")
+    parser.add_argument("--filter", type=str, default=None, help="only run benchmarks which contain this")
+    args = parser.parse_args()
+
+    results = []
+    for name, parameters, prepare in benchmarks(quick=args.quick):
+        if args.filter is not None and args.filter not in name:
+            continue
+        result = {"name": name, "parameters": parameters, **measure(prepare=prepare, repeat=args.repeat)}
+        print("{:30} {:60} {:10.4f}s {:10.2f}MB".format(name, str(parameters), result["best"],
+                                                          result["peak_memory"] / 2 ** 20))
+        results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump({"python": platform.python_version(), "tequila": tq.__version__, "results": results}, f, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+        for name, parameters, ratio in compare(results=results, baseline=baseline):
+            print("slower: {:30} {:60} {:6.2f}x".format(name, str(parameters), ratio))
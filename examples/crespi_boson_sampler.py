@@ -6,10 +6,10 @@ Photons will start in paths a,c,e
 
 import tequila as tq
 import photonic
+from photonic import serialization
 import numpy
 from itertools import combinations, permutations
 from matplotlib import pyplot as plt
-import pickle
 
 S = 0
 qpm = 2
@@ -97,14 +97,6 @@ if __name__ == "__main__":
 
         initial_state = setup.initialize_state("1.0|1>_a|1>_c|1>_e")
         print(initial_state)
-        U = tq.circuit.QCircuit()
-        assert (len(initial_state.state.keys()) == 1)
-        for k, v in initial_state.state.items():
-            for i, v in enumerate(k.array):
-                if v == 1:
-                    U += tq.gates.X(target=i)
-
-        setup.add_circuit(U=U)
 
         setup.add_beamsplitter(path_a=a, path_b=b, t=bs_parameters[0], phi=0, steps=trotter_steps)
         setup.add_phase_shifter(path=a, t=-1)
@@ -136,7 +128,7 @@ if __name__ == "__main__":
         setup.add_phase_shifter(path=b, t=-phase_parameters[7])
         setup.add_beamsplitter(path_a=a, path_b=b, t=bs_parameters[9], phi=0, steps=trotter_steps)
 
-        result = setup.simulate_wavefunction()
+        result = setup.simulate_wavefunction(initial_state=initial_state)
         print("full wfn = ", result)
         print("simulated wavefunction is:\n", result)
 
@@ -164,8 +156,7 @@ if __name__ == "__main__":
         plt.bar(labels, values, label=title)
         plt.legend()
         filename = "boson_sampler_steps_" + str(trotter_steps)
-        with open(filename + ".pickle", 'wb') as handle:
-            pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        serialization.save(result, filename=filename + ".json")
         plt.savefig(filename + ".pdf")
         # will print to terminal, add filename=... to plot to file
         plt.show()
@@ -7,8 +7,7 @@ are asymetric)
 Count will differ from run to run and by how you set samples and trotter step
 """
 
-from photonic import PhotonicSetup, PhotonicStateVector
-import tequila as tq
+from photonic import PhotonicSetup
 
 if __name__ == "__main__":
     """
@@ -27,28 +26,12 @@ if __name__ == "__main__":
     # the beam splitter is parametrized as phi=i*pi*t
     setup.add_beamsplitter(path_a='a', path_b='b', t=t, steps=trotter_steps)
 
-    # need explicit circuit for initial state
-    state = setup.initialize_state(state=initial_state)
-    # can only do product states right now, alltough more general ones are possible
-    # with code adaption
-    Ui = tq.QCircuit()
-    assert (len(state.state) == 1)
-    key = [k for k in state.state.keys()][0]
-    for i, q in enumerate(key.array):
-        if q == 1:
-            Ui += tq.gates.X(target=i)
+    print(setup.setup)
 
-    # full circuit (initial state plus mapped HOM setup)
-    U = Ui + setup.setup + tq.gates.Measurement(target=[0,1,2,3])
+    # the initial state is given to the simulator directly (superpositions of basis states work as well)
+    # those are the photonic counts
+    pcounts = setup.sample(samples=samples, initial_state=initial_state, simulator=simulator)
 
-    print(U)
-
-    # those are the qubit counts given back by tequila
-    qcounts = tq.simulate(U, samples=samples)
-    # those are the qubit counts re-interpreted as photonic counts
-    pcounts = PhotonicStateVector(paths=setup.paths, state=qcounts)
-
-    print("qubit counts:\n", qcounts)
     print("photon counts:\n", pcounts)
 
     pcounts.plot(title="HOM-Counts for initial state "+ initial_state)
@@ -1,2 +1,2 @@
 from photonic.mode import PhotonicMode, PhotonicPaths, PhotonicStateVector
-from photonic.elements import PhotonicSetup, creation, anihilation
+from photonic.elements import PhotonicSetup, creation, anihilation, ladder_product
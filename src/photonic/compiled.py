@@ -0,0 +1,186 @@
+"""
+Compile a PhotonicSetup once and evaluate it for batches of variables
+(e.g. grid scans over beamsplitter ratios or dove-prism phases)
+"""
+import numbers
+import typing
+import numpy
+
+import tequila as tq
+
+from photonic.mode import PhotonicStateVector
+from photonic import linear_optics, fock
+
+
+def variable_batches(variables: typing.Union[dict, typing.List[dict]] = None) -> typing.List[dict]:
+    """
+    :param variables: dictionary of {variable: value or array of values}, the values are broadcasted against each other
+                      a list of dictionaries is taken as it is
+    :return: list of variable dictionaries, one for each point of the batch
+    """
+    if variables is None:
+        return [dict()]
+    if isinstance(variables, (list, tuple)):
+        return list(variables)
+    keys = list(variables.keys())
+    values = [v.ravel() for v in numpy.broadcast_arrays(*[numpy.asarray(variables[k]) for k in keys])]
+    if len(values) == 0:
+        return [dict()]
+    return [{k: v[i] for k, v in zip(keys, values)} for i in range(len(values[0]))]
+
+
+def has_variables(element) -> bool:
+    """
+    :param element: AbstractElement as recorded by PhotonicSetup
+    :return: True if the parameters of the element depend on variables
+    """
+    return any(not isinstance(element.parameters[name], numbers.Number) for name in ["t", "phi"]
+               if name in element.parameters)
+
+
+def basis_states(paths, state: PhotonicStateVector = None) -> typing.Tuple[list, numpy.ndarray]:
+    """
+    :param paths: the photonic paths (layout of the qubits at the beginning of the circuit)
+    :param state: initial photonic state, vacuum if None
+    :return: integers of the qubit basis states and their amplitudes
+    """
+    if state is None:
+        return [0], numpy.ones(1, dtype=complex)
+    return paths.encode_occupations(state.occupations).tolist(), numpy.asarray(state.amplitudes, dtype=complex)
+
+
+def simulate_basis_states(circuit, paths, mapped_paths, keys: list, amplitudes: numpy.ndarray,
+                          variables: dict = None) -> PhotonicStateVector:
+    """
+    Simulate a superposition of basis states with one backend call per basis state (the backends only take basis
+    states as initial states) and add up the results
+    :param circuit: compiled circuit of the setup
+    :param paths: paths of the setup
+    :param mapped_paths: paths of the setup at the end of the circuit (see PhotonicSetup.mapped_paths)
+    :param keys: integers of the qubit basis states (see basis_states)
+    :param amplitudes: amplitudes of the basis states
+    :param variables: values for the variables of parametrized elements
+    :return: the final state on paths
+    """
+    occupations = []
+    result = []
+    for key, amplitude in zip(keys, amplitudes):
+        wfn = PhotonicStateVector(paths=mapped_paths, state=circuit(variables=variables, initial_state=key))
+        occupations.append(wfn.occupations)
+        result.append(amplitude * wfn.amplitudes)
+    if len(keys) == 1 and amplitudes[0] == 1.0 and mapped_paths is paths:
+        return wfn
+    return PhotonicStateVector.from_arrays(paths=paths, occupations=numpy.concatenate(occupations),
+                                           amplitudes=numpy.concatenate(result))
+
+
+class CompiledSetup:
+    """
+    A PhotonicSetup with fixed initial state, compiled once
+    The compiled backend circuit and expectation values are reused for every point of a batch
+    for the fock and subspace engines, the Fock space and the elements without variables are built once
+    Get it from PhotonicSetup.compile
+    """
+
+    def __init__(self, setup, initial_state: [str, PhotonicStateVector] = None, simulator=None,
+                 observables: typing.List[tq.hamiltonian.QubitHamiltonian] = None, engine: str = "qubit"):
+        """
+        :param setup: the PhotonicSetup
+        :param initial_state: initial photonic state, vacuum if None (basis state if there are observables)
+        :param simulator: the tequila backend
+        :param observables: QubitHamiltonians for expectation_values
+        :param engine: 'qubit', 'fock' or 'subspace' (see PhotonicSetup.simulate_wavefunction)
+        """
+        if isinstance(initial_state, str):
+            initial_state = PhotonicStateVector.from_string(paths=setup.paths, string=initial_state)
+        if engine not in ["qubit", "fock", "subspace"]:
+            raise Exception("unknown engine: {}".format(engine))
+
+        self.paths = setup.paths
+        self.engine = engine
+        self.initial_state = initial_state
+        self._elements = list(setup._abstract_setup)
+
+        self._keys, self._amplitudes = basis_states(paths=setup.paths, state=initial_state)
+
+        self._circuit = None
+        self._mapped_paths = setup.mapped_paths
+        if engine == "qubit":
+            # without the SWAP gates of relabeled modes, the states are decoded with the mapped paths instead
+            self._circuit = tq.compile(setup._setup, backend=simulator)
+        elif engine == "fock":
+            # consecutive elements without variables are multiplied into one unitary
+            self._unitaries = []
+            for element in self._elements:
+                if has_variables(element):
+                    self._unitaries.append(element)
+                    continue
+                unitary = linear_optics.element_unitary(element=element, paths=self.paths)
+                if len(self._unitaries) > 0 and isinstance(self._unitaries[-1], numpy.ndarray):
+                    unitary = unitary @ self._unitaries.pop()
+                self._unitaries.append(unitary)
+            if initial_state is None:
+                self._initial = {tuple([0] * len(linear_optics.mode_indices(self.paths))): 1.0}
+            else:
+                self._initial = linear_optics.state_occupations(initial_state)
+        else:
+            if initial_state is None:
+                self._space = fock.FockSpace(paths=self.paths, photons=0)
+                self._vector = numpy.ones(1, dtype=complex)
+            else:
+                self._space = fock.FockSpace.from_state(initial_state)
+                self._vector = self._space.vector(initial_state)
+
+        if observables is None:
+            observables = []
+        if len(observables) > 0 and len(self._keys) > 1:
+            raise Exception("expectation values need a basis state as initial state")
+        # the initial state is given to the backend in the same way as in simulate
+        self._observables = [tq.compile(tq.ExpectationValue(U=setup.setup, H=H), backend=simulator)
+                             for H in observables]
+
+    def simulate(self, variables: typing.Union[dict, typing.List[dict]] = None) -> typing.List[PhotonicStateVector]:
+        """
+        :param variables: batch of variables (see variable_batches)
+        :return: the final states for all points of the batch
+        """
+        result = []
+        for point in variable_batches(variables):
+            if self.engine == "fock":
+                unitary = numpy.eye(len(linear_optics.mode_indices(self.paths)), dtype=complex)
+                for u in self._unitaries:
+                    if not isinstance(u, numpy.ndarray):
+                        u = linear_optics.element_unitary(element=u, paths=self.paths, variables=point)
+                    unitary = u @ unitary
+                wfn = linear_optics.fock_state(unitary=unitary, paths=self.paths, initial=self._initial)
+            elif self.engine == "subspace":
+                vector = self._vector
+                for element in self._elements:
+                    # the matrices of elements with variables are not kept, they differ for every point
+                    matrix = self._space.element_matrix(element=element, variables=point,
+                                                        cache=not has_variables(element))
+                    vector = matrix @ vector
+                wfn = self._space.state(vector)
+            else:
+                wfn = simulate_basis_states(circuit=self._circuit, paths=self.paths, mapped_paths=self._mapped_paths,
+                                            keys=self._keys, amplitudes=self._amplitudes, variables=point)
+            result.append(wfn)
+        return result
+
+    def amplitudes(self, outputs: typing.List[str],
+                   variables: typing.Union[dict, typing.List[dict]] = None) -> numpy.ndarray:
+        """
+        :param outputs: basis states in the form |x>_a|y>_b ...
+        :param variables: batch of variables (see variable_batches)
+        :return: (batch x outputs) array with the amplitudes of the outputs
+        """
+        return numpy.asarray([[wfn.get_basis_state(output) for output in outputs]
+                              for wfn in self.simulate(variables=variables)], dtype=complex)
+
+    def expectation_values(self, variables: typing.Union[dict, typing.List[dict]] = None) -> numpy.ndarray:
+        """
+        :param variables: batch of variables (see variable_batches)
+        :return: (batch x observables) array with the expectation values of the observables
+        """
+        return numpy.asarray([[E(variables=point, initial_state=self._keys[0]) for E in self._observables]
+                              for point in variable_batches(variables)], dtype=float).reshape(-1, len(self._observables))
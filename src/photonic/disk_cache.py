@@ -0,0 +1,182 @@
+"""
+Persistent cache of setup operators shared by processes and runs
+Entries are json files (see serialization) named by the structural hash of the paths and the elements of a setup,
+rebuilding a cached setup takes its operators from the file and does not compute them again
+Only the operators are cached: compiled backend circuits can not be stored, so tq.compile
+(in simulate_wavefunction, sample or PhotonicSetup.compile) still runs once in every process
+"""
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import time
+import typing
+import uuid
+
+from photonic import serialization
+from photonic.elements import PhotonicSetup
+
+
+def structural_hash(data: dict) -> str:
+    """
+    :param data: setup in the form of serialization.description_to_dict (operators are not part of the hash)
+    :return: hex digest of the format version, the paths and the elements
+    """
+    content = {k: data[k] for k in ["format", "version", "paths", "elements"]}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class DiskCache:
+    """
+    Content-addressed directory of setup operators
+    Files are written atomically (temporary file and rename), writers and the eviction hold a lock file,
+    readers do not need the lock
+    A lock which is older than the timeout is taken over, its holder does not remove the lock of the new holder
+    The least recently used entries are removed once the files exceed max_bytes
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 2 ** 28, timeout: float = 30.0):
+        """
+        :param directory: the cache directory, created if it does not exist
+        :param max_bytes: size limit of the cached files
+        :param timeout: seconds after which a lock file is considered stale (left by a crashed process)
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def _entries(self) -> typing.List[typing.Tuple[float, int, str]]:
+        result = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            result.append((stat.st_mtime, stat.st_size, name))
+        return sorted(result)
+
+    def __len__(self):
+        return len(self._entries())
+
+    def __contains__(self, key: str):
+        return os.path.exists(self._filename(key))
+
+    def size(self) -> int:
+        """
+        :return: bytes of the cached files
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    @contextlib.contextmanager
+    def _lock(self):
+        filename = os.path.join(self.directory, ".lock")
+        # identifies the holder, the lock file is only removed if it still holds this token
+        token = "{}-{}".format(os.getpid(), uuid.uuid4().hex)
+        while True:
+            try:
+                handle = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(filename).st_mtime > self.timeout:
+                        os.remove(filename)
+                except FileNotFoundError:
+                    pass
+                time.sleep(0.01)
+        try:
+            os.write(handle, token.encode())
+        finally:
+            os.close(handle)
+        try:
+            yield
+        finally:
+            try:
+                with open(filename, "r") as f:
+                    current = f.read()
+                if current == token:
+                    os.remove(filename)
+            except FileNotFoundError:
+                # removed as stale by another process
+                pass
+
+    def get(self, key: str) -> typing.Optional[dict]:
+        """
+        :param key: structural hash of the setup
+        :return: the cached setup in the form of serialization.setup_to_dict, None if it is not cached
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename, "r") as f:
+                data = json.load(f)
+            # the modification time is the last access for the eviction
+            os.utime(filename)
+        except (FileNotFoundError, ValueError):
+            # evicted meanwhile or not readable
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: dict):
+        """
+        Store an entry and evict the least recently used ones if the cache is too large
+        :param key: structural hash of the setup
+        :param data: the setup in the form of serialization.setup_to_dict
+        """
+        with self._lock():
+            handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(handle, "w") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                os.replace(temporary, self._filename(key))
+            except BaseException:
+                os.remove(temporary)
+                raise
+            self._evict(keep=key + ".json")
+
+    def _evict(self, keep: str):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        with self._lock():
+            for _, _, name in self._entries():
+                os.remove(os.path.join(self.directory, name))
+        self.hits = 0
+        self.misses = 0
+
+    def build_setup(self, description: dict) -> PhotonicSetup:
+        """
+        Same as serialization.build_setup, the operators of the elements are taken from the cache
+        and the setup is added to the cache if it was not there yet
+        The setup is not compiled, that happens when it is simulated (see the module docstring)
+        :param description: see serialization.setup_description
+        :return: the setup
+        """
+        data = serialization.description_to_dict(description, operators=False)
+        key = structural_hash(data)
+        cached = self.get(key)
+        if cached is not None:
+            return serialization.setup_from_dict(cached)
+        setup, data["operators"] = serialization.record_operators(description)
+        self.put(key, data)
+        return setup
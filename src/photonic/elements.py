@@ -1,11 +1,22 @@
+import functools
+import numbers
 import typing
-from photonic.mode import PhotonicMode, PhotonicPaths, PhotonicStateVector
+import warnings
+import numpy
+from photonic.mode import PhotonicMode, PhotonicPaths, PhotonicStateVector, row_keys, success_rate
+from photonic import linear_optics, fock
+from photonic.compiled import CompiledSetup, basis_states, simulate_basis_states
+from photonic import sampling
+from photonic.sampling import SampleStatistics
+from photonic import noise
+from photonic.noise import LossModel, TrajectoryResult
 from numpy import pi, sqrt, exp
 
 import tequila as tq
 from tequila.apps import UnaryStatePrep
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from collections import OrderedDict
 
 
 @dataclass
@@ -13,38 +24,75 @@ class AbstractElement:
     """
     DataClass which keeps track of the photonic setup
     --> More elegant solutions possible
-    Currently only implemented for qpic output
+    Used for qpic output and by the native linear-optics engine
+    kind is the name of the PhotonicSetup method which added the element
+    parameters are the arguments it was called with
     """
     name: str
     paths: typing.List[str]
+    kind: str = None
+    parameters: typing.Dict[str, typing.Any] = field(default_factory=dict)
 
 
 class PhotonicHeralder:
     """
     Post-Processing assignment for OpenVQE
-    Will only count states with one photon in each path
+    By default it will only count states with one photon in each path
     """
 
-    def __init__(self, paths: PhotonicPaths):
+    def __init__(self, paths: PhotonicPaths, photons: int = 1,
+                 windows: typing.Dict[str, typing.Tuple[int, int]] = None,
+                 mode_masks: typing.Dict[str, typing.List[int]] = None):
+        """
+        :param paths: the photonic paths
+        :param photons: number of photons required in each path, None means no requirement
+        :param windows: dictionary of {path: (min, max)} photon numbers (inclusive), replaces photons for those paths
+        :param mode_masks: dictionary of {path: modes}, only photons in those modes are counted for the path
+        """
         self.paths = paths
+        self.lower = numpy.zeros(len(paths.keys()), dtype=numpy.int64)
+        self.upper = numpy.full(len(paths.keys()), numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+        self.mask = numpy.ones(shape=paths.qubit_shifts().shape[:2], dtype=numpy.int64)
+        if windows is None:
+            windows = dict()
+        if mode_masks is None:
+            mode_masks = dict()
+        for k, (pname, p) in enumerate(paths.items()):
+            if pname in windows:
+                self.lower[k], self.upper[k] = windows[pname]
+            elif photons is not None:
+                self.lower[k] = self.upper[k] = photons
+            if pname in mode_masks:
+                self.mask[k] = [mname in mode_masks[pname] for mname in p.keys()]
+
+    def valid(self, occupations: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param occupations: (n x paths x modes) array of occupation numbers (see PhotonicPaths.decode_keys)
+        :return: boolean array which is True for the basis states which are heralded
+        """
+        occupations = numpy.asarray(occupations).reshape((-1,) + self.mask.shape)
+        photons = numpy.sum(occupations * self.mask, axis=2)
+        return numpy.all((photons >= self.lower) & (photons <= self.upper), axis=1)
 
     def is_valid(self, key: tq.BitString) -> bool:
-        # valid if every path has one photon (no matter in which mode)
-        occs = self.paths.extract_occupation_numbers(i=key)
-        for path, mode in occs.items():
-            total = 0
-            for occ in mode.values():
-                total += occ.integer
-            if total != 1:
-                return False
+        return bool(self.valid(self.paths.decode_keys([int(key)]))[0])
 
-        return True
+    def herald(self, state: PhotonicStateVector, counts: bool = None) -> typing.Tuple[PhotonicStateVector, float]:
+        """
+        :param state: counts or amplitudes
+        :param counts: see success_rate
+        :return: the heralded state (not normalized) and the heralding success rate
+        """
+        mask = self.valid(state.occupations)
+        return state.filter(mask), success_rate(state=state, mask=mask, counts=counts)
 
 
 class PhotonicHeraldingProjector:
 
     def __init__(self, paths: PhotonicPaths, active_path: str, delete_active_path: bool = True):
         self.paths = paths
+        self.active_path = active_path
+        self.delete_active_path = delete_active_path
         subregister = []
         for mode in paths[active_path].values():
             subregister += mode.qubits
@@ -63,6 +111,25 @@ class PhotonicHeraldingProjector:
         else:
             self.reduced_paths = paths
 
+    def project(self, state: PhotonicStateVector, counts: bool = None) -> typing.Tuple[PhotonicStateVector, float]:
+        """
+        Keep the basis states where the active path is empty
+        :param state: counts or amplitudes on self.paths
+        :param counts: see success_rate
+        :return: the projected state on self.reduced_paths (not normalized) and the success rate
+        """
+        k = list(self.paths.keys()).index(self.active_path)
+        n_modes = len(self.paths[self.active_path])
+        occupations = state.occupations.reshape(len(state), -1, n_modes)
+        mask = numpy.all(occupations[:, k] == 0, axis=1)
+        occupations = occupations[mask]
+        if self.delete_active_path:
+            occupations = numpy.delete(occupations, k, axis=1)
+        projected = PhotonicStateVector.from_arrays(paths=self.reduced_paths,
+                                                    occupations=occupations.reshape(len(occupations), -1),
+                                                    amplitudes=state.amplitudes[mask])
+        return projected, success_rate(state=state, mask=mask, counts=counts)
+
 
 def QuditS(target: PhotonicMode, t):
     """
@@ -90,24 +157,226 @@ def QuditSWAP(mode1: PhotonicMode, mode2: PhotonicMode) -> tq.gates.QCircuit:
     return result
 
 
-def anihilation(qubits: typing.List[int] = None) -> tq.hamiltonian.QubitHamiltonian:
-    max_occ = 2 ** len(qubits) - 1
-    result = tq.hamiltonian.QubitHamiltonian.zero()
-    for occ in range(max_occ):
-        c = sqrt(occ + 1)
-        result += c * tq.paulis.decompose_transfer_operator(ket=occ + 1, bra=occ, qubits=qubits)
-    return result.simplify()
+class OperatorCache:
+    """
+    Bounded cache for the qubit representation of bosonic ladder operators and their products
+    Keys are tuples of (name, qubits) factors where qubits is the tuple of qubit indices of the mode
+    (so the qpm is part of the key through the length of the tuple)
+    The least recently used entry is evicted once maxsize is reached
+    Hamiltonians are handed out as copies, so they can be modified in-place without spoiling the cache
+    """
+
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
 
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
 
-def creation(qubits: typing.List[int] = None) -> tq.hamiltonian.QubitHamiltonian:
+    def get(self, key, builder: typing.Callable) -> tq.hamiltonian.QubitHamiltonian:
+        """
+        :param key: hashable key of the operator
+        :param builder: callable without arguments which computes the operator if it is not cached
+        :return: a copy of the cached operator
+        """
+        if key in self._data:
+            self.hits += 1
+            self._data.move_to_end(key)
+        else:
+            self.misses += 1
+            self._data[key] = builder()
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return self._copy(self._data[key])
+
+    def put(self, key, hamiltonian: tq.hamiltonian.QubitHamiltonian):
+        """
+        Store an operator which was computed elsewhere (e.g. loaded from a file, see serialization)
+        """
+        self._data[key] = self._copy(hamiltonian)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    @staticmethod
+    def _copy(hamiltonian: tq.hamiltonian.QubitHamiltonian) -> tq.hamiltonian.QubitHamiltonian:
+        result = tq.hamiltonian.QubitHamiltonian.zero()
+        result.qubit_operator.terms = dict(hamiltonian.qubit_operator.terms)
+        return result
+
+
+# global cache used by creation, anihilation and ladder_product
+operator_cache = OperatorCache()
+
+
+def _ladder_operator(name: str, qubits: typing.Tuple[int]) -> tq.hamiltonian.QubitHamiltonian:
     max_occ = 2 ** len(qubits) - 1
     result = tq.hamiltonian.QubitHamiltonian.zero()
     for occ in range(max_occ):
         c = sqrt(occ + 1)
-        result += c * tq.paulis.decompose_transfer_operator(ket=occ, bra=occ + 1, qubits=qubits)
+        if name == "creation":
+            result += c * tq.paulis.decompose_transfer_operator(ket=occ, bra=occ + 1, qubits=list(qubits))
+        elif name == "anihilation":
+            result += c * tq.paulis.decompose_transfer_operator(ket=occ + 1, bra=occ, qubits=list(qubits))
+        else:
+            raise Exception("unknown ladder operator: {}".format(name))
     return result.simplify()
 
 
+def anihilation(qubits: typing.List[int] = None, cache: OperatorCache = None) -> tq.hamiltonian.QubitHamiltonian:
+    cache = operator_cache if cache is None else cache
+    key = (("anihilation", tuple(qubits)),)
+    return cache.get(key=key, builder=lambda: _ladder_operator(name="anihilation", qubits=tuple(qubits)))
+
+
+def creation(qubits: typing.List[int] = None, cache: OperatorCache = None) -> tq.hamiltonian.QubitHamiltonian:
+    cache = operator_cache if cache is None else cache
+    key = (("creation", tuple(qubits)),)
+    return cache.get(key=key, builder=lambda: _ladder_operator(name="creation", qubits=tuple(qubits)))
+
+
+def ladder_product(factors: typing.List[typing.Tuple[str, typing.List[int]]],
+                   cache: OperatorCache = None) -> tq.hamiltonian.QubitHamiltonian:
+    """
+    Cached product of ladder operators
+    e.g. factors=[("creation", [0,1]), ("anihilation", [2,3])] gives a^\\dagger_{01} a_{23}
+    :param factors: list of (name, qubits) with name being 'creation' or 'anihilation'
+    :param cache: the OperatorCache, the global operator_cache if None
+    :return: the product in qubit representation
+    """
+    cache = operator_cache if cache is None else cache
+    key = tuple((name, tuple(qubits)) for name, qubits in factors)
+
+    def builder():
+        result = tq.hamiltonian.QubitHamiltonian.unit()
+        for name, qubits in key:
+            result = result * cache.get(key=((name, qubits),),
+                                        builder=lambda: _ladder_operator(name=name, qubits=qubits))
+        return result.simplify()
+
+    return cache.get(key=key, builder=builder)
+
+
+def transfer_operator(ket: int, bra: int, qubits: typing.List[int],
+                      cache: OperatorCache = None) -> tq.hamiltonian.QubitHamiltonian:
+    """
+    Cached |ket><bra| on the given qubits (ket and bra as integers in the binary encoding of the qubits)
+    """
+    cache = operator_cache if cache is None else cache
+    key = (("transfer", ket, bra, tuple(qubits)),)
+    return cache.get(key=key, builder=lambda: tq.paulis.decompose_transfer_operator(ket=ket, bra=bra,
+                                                                                    qubits=list(qubits)))
+
+
+def _givens_rotations(matrix: numpy.ndarray) -> typing.List[typing.Tuple[int, int, float]]:
+    """
+    Reduce a real orthogonal matrix to a diagonal matrix of signs with rotations between neighbouring rows
+    :return: list of (p, q, alpha) in the order of application,
+             each rotation is exp(alpha*(|p><q| - |q><p|)) and G_m ... G_1 matrix is diagonal
+    """
+    matrix = numpy.array(matrix, dtype=float)
+    m = matrix.shape[0]
+    result = []
+    for column in range(m - 1):
+        for row in range(m - 1, column, -1):
+            a = matrix[row - 1, column]
+            b = matrix[row, column]
+            if numpy.isclose(b, 0.0, atol=1.e-12):
+                continue
+            alpha = numpy.arctan2(b, a)
+            c, s = numpy.cos(alpha), numpy.sin(alpha)
+            upper = c * matrix[row - 1] + s * matrix[row]
+            lower = -s * matrix[row - 1] + c * matrix[row]
+            matrix[row - 1], matrix[row] = upper, lower
+            result.append((row - 1, row, alpha))
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def _mode_mixing_decomposition(qpm: int) -> typing.Tuple[tuple, tuple]:
+    """
+    Eigendecomposition of the phi=0 beamsplitter generator between two modes with qpm qubits each
+    :return: Givens rotations (p, q, alpha) to the eigenbasis and the nonzero eigenvalues (key, value)
+             with p, q and key the basis states as integers of the 2*qpm qubits
+    """
+    max_occ = 2 ** qpm - 1
+    rotations = []
+    diagonal = []
+    for total in range(2 * max_occ + 1):
+        # basis states |n_a, n_b> with n_a + n_b = total
+        block = [(na, total - na) for na in range(max(0, total - max_occ), min(total, max_occ) + 1)]
+        keys = [(na << qpm) + nb for na, nb in block]
+        generator = numpy.zeros(shape=[len(block), len(block)])
+        for k, (na, nb) in enumerate(block[1:], start=1):
+            # G moves photons from a to b (and back), block[k-1] has one photon less in a
+            generator[k - 1, k] = generator[k, k - 1] = sqrt(na * (nb + 1))
+        eigenvalues, eigenvectors = numpy.linalg.eigh(generator)
+        for p, q, alpha in _givens_rotations(eigenvectors):
+            rotations.append((keys[p], keys[q], alpha))
+        for key, value in zip(keys, eigenvalues):
+            if not numpy.isclose(value, 0.0):
+                diagonal.append((key, value))
+    return tuple(rotations), tuple(diagonal)
+
+
+def ExactModeMixing(qubits_a: typing.List[int], qubits_b: typing.List[int], t,
+                    cache: OperatorCache = None) -> tq.gates.QCircuit:
+    """
+    Trotter-free exp(i*pi*t*G) with G the phi=0 beamsplitter generator between two modes
+    (in the truncated space of the qubit encoding)
+    G is diagonalized in each block of constant total occupation, the (fixed) eigenbasis is reached with
+    Givens rotations between pairs of basis states and t only enters the diagonal part in between
+    All Pauli strings in each of those generators commute, so single Trotter steps are exact
+    The generators do not depend on t and are kept in the operator_cache
+    :param qubits_a: qubits of the mode in path a
+    :param qubits_b: qubits of the mode in path b
+    :param t: beamsplitter parameter, can be a variable
+    :param cache: the OperatorCache, the global operator_cache if None
+    :return: the circuit
+    """
+    assert (len(qubits_a) == len(qubits_b))
+    cache = operator_cache if cache is None else cache
+    qubits = tuple(qubits_a) + tuple(qubits_b)
+    rotations, eigenvalues = _mode_mixing_decomposition(len(qubits_a))
+
+    def rotation(k, p, q, alpha):
+        # exp(alpha*(|p><q| - |q><p|)) = exp(-i/2 * H) with H = 2i*alpha*(|p><q| - |q><p|)
+        def builder():
+            return (2.0j * alpha * (transfer_operator(ket=p, bra=q, qubits=qubits, cache=cache)
+                                    - transfer_operator(ket=q, bra=p, qubits=qubits, cache=cache))).simplify()
+
+        # the inverse rotation is the one with p and q exchanged, k is the position in rotations
+        generator = cache.get(key=(("givens", k, p, q, qubits),), builder=builder)
+        return tq.gates.Trotterized(generator=generator, steps=1, angle=1.0)
+
+    def diagonal():
+        result = tq.hamiltonian.QubitHamiltonian.zero()
+        for key, value in eigenvalues:
+            result += value * transfer_operator(ket=key, bra=key, qubits=qubits, cache=cache)
+        # same angle convention as for the Trotterized beamsplitter
+        return (pi * -2.0 * result).simplify()
+
+    result = tq.gates.QCircuit()
+    for k, (p, q, alpha) in enumerate(rotations):
+        result += rotation(k, p, q, alpha)
+    if len(eigenvalues) > 0:
+        generator = cache.get(key=(("mixing", qubits),), builder=diagonal)
+        result += tq.gates.Trotterized(generator=generator, steps=1, angle=t)
+    for k, (p, q, alpha) in reversed(list(enumerate(rotations))):
+        result += rotation(k, q, p, alpha)
+    return result
+
+
 class PhotonicSetup:
 
     @property
@@ -130,8 +399,33 @@ class PhotonicSetup:
     def qubits(self) -> int:
         return self.paths.qubits
 
+    @property
+    def mapped_paths(self) -> PhotonicPaths:
+        """
+        The paths with the qubits which currently hold the modes
+        Same as paths, unless mode permutations were done by relabeling the qubits (mirrors, holograms)
+        """
+        if not self.relabeled:
+            return self.paths
+        if self._mapped_paths is None:
+            qubits = []
+            for slot in self._slots:
+                qubits += self._mode_qubits[slot]
+            self._mapped_paths = PhotonicPaths(path_names=list(self.paths.keys()), S=self.S, qpm=self.qpm,
+                                               qubits=qubits)
+        return self._mapped_paths
+
+    @property
+    def relabeled(self) -> bool:
+        return self._slots != list(range(len(self._slots)))
+
     @property
     def setup(self):
+        """
+        :return: the circuit, pending relabelings of the qubits are resolved with SWAP gates at the end
+        """
+        if self.relabeled:
+            return self._setup + self._relabeling_circuit()
         return self._setup
 
     def print_circuit(self, simulator=None):
@@ -141,12 +435,14 @@ class PhotonicSetup:
         return PhotonicStateVector.from_string(paths=self.paths, string=state)
 
     def __init__(self, pathnames: typing.List[str], S: int, qpm: int, qubits: typing.List[int] = None,
-                 setup: tq.gates.QCircuit = None):
+                 setup: tq.gates.QCircuit = None, cache: OperatorCache = None):
         """
         :param pathnames: The names of the paths in the setups
         :param S: The Spin number which defines the number of simulated modes which ranges from -S to S
         :param qpm: qubits per mode
+        :param cache: OperatorCache for the operators of the elements, the global operator_cache if None
         """
+        self.operator_cache = operator_cache if cache is None else cache
 
         self._paths = PhotonicPaths(path_names=pathnames, S=S, qpm=qpm, qubits=qubits)
         if setup is None:
@@ -154,12 +450,125 @@ class PhotonicSetup:
         else:
             self._setup = setup
 
-        self.setup.n_qubits = self._paths.n_qubits
+        self._setup.n_qubits = self._paths.n_qubits
 
         self._abstract_setup = []
 
         self.heralding = None
 
+        # the setup can be rebuilt from the recorded elements (see optimize_circuit)
+        self._replayable = setup is None
+
+        # qubits of the mode slots and the slot which currently holds each mode (order of linear_optics.mode_indices)
+        self._mode_qubits = [mode.qubits for path in self._paths.values() for mode in path.values()]
+        self._slots = list(range(len(self._mode_qubits)))
+        self._mapped_paths = None
+
+        # compiled circuits for each backend and prepared basis state, valid for _compiled_circuit with _compiled_gates
+        self._circuit_cache = dict()
+        self._compiled_circuit = None
+        self._compiled_gates = 0
+
+    def _relabel(self, permutation: typing.Dict[typing.Tuple[str, int], typing.Tuple[str, int]]):
+        """
+        Permute modes without gates by changing which qubits hold them
+        :param permutation: dictionary {(path, mode): (path, target mode)}, the photons in mode are moved to target mode
+        """
+        indices = linear_optics.mode_indices(self.paths)
+        slots = list(self._slots)
+        for source, target in permutation.items():
+            slots[indices[target]] = self._slots[indices[source]]
+        self._slots = slots
+        self._mapped_paths = None
+
+    def _relabeling_circuit(self) -> tq.gates.QCircuit:
+        # SWAP the modes back to their original qubits
+        result = tq.gates.QCircuit()
+        slots = list(self._slots)
+        holder = {slot: mode for mode, slot in enumerate(slots)}
+        for mode in range(len(slots)):
+            slot = slots[mode]
+            if slot == mode:
+                continue
+            result += QuditSWAP(mode1=PhotonicMode(qubits=self._mode_qubits[slot]),
+                                mode2=PhotonicMode(qubits=self._mode_qubits[mode]))
+            # the mode which was in slot 'mode' is now in 'slot'
+            other = holder[mode]
+            slots[other] = slot
+            holder[slot] = other
+            slots[mode] = mode
+            holder[mode] = mode
+        return result
+
+    def _flush_relabeling(self):
+        # for elements which are defined on the original qubits
+        if self.relabeled:
+            self._setup += self._relabeling_circuit()
+            self._slots = list(range(len(self._slots)))
+            self._mapped_paths = None
+
+    def _mode_permutation(self, kind: str, path: str) -> typing.Dict[typing.Tuple[str, int], typing.Tuple[str, int]]:
+        # mode permutations of mirrors and holograms
+        modes = sorted(self.paths[path].keys())
+        if kind == "add_mirror":
+            return {(path, k): (path, -k) for k in modes}
+        elif kind == "add_hologram":
+            # k --> k+1 and S --> -S
+            return {(path, k): (path, modes[(i + 1) % len(modes)]) for i, k in enumerate(modes)}
+        raise Exception("{} is not a mode permutation".format(kind))
+
+    def _add_phases(self, phases: typing.Dict[typing.Tuple[str, int], typing.Any]):
+        for (path, mode), t in phases.items():
+            if isinstance(t, numbers.Number) and t == 0.0:
+                continue
+            self._setup += QuditS(target=self.mapped_paths[path][mode], t=t)
+
+    def optimize_circuit(self):
+        """
+        Rebuild the circuit from the recorded elements
+        Consecutive phase shifters and dove prisms are folded into a single phase (one Rz per qubit) per mode
+        and mirrors and holograms become a relabeling of the qubits which hold the modes (no gates),
+        unless they were added with relabel=False
+        Results of simulate_wavefunction and sample don't change,
+        the setup property resolves remaining relabelings with SWAP gates at the end
+        :return: self for chaining
+        """
+        if not self._replayable:
+            raise Exception("setup contains circuits which were not added with the methods of PhotonicSetup")
+
+        elements = self._abstract_setup
+        self._setup = tq.gates.QCircuit()
+        self._setup.n_qubits = self.paths.n_qubits
+        self._abstract_setup = []
+        self._slots = list(range(len(self._slots)))
+        self._mapped_paths = None
+        self.heralding = None
+
+        phases = dict()
+        for element in elements:
+            kind = element.kind
+            parameters = element.parameters
+            if kind == "add_phase_shifter":
+                key = (parameters["path"], parameters["mode"])
+                phases[key] = phases[key] + parameters["t"] if key in phases else parameters["t"]
+            elif kind == "add_doveprism":
+                for mode in self.paths[parameters["path"]].keys():
+                    key = (parameters["path"], mode)
+                    phases[key] = phases[key] + parameters["t"] * mode if key in phases else parameters["t"] * mode
+            elif kind in ["add_mirror", "add_hologram"] and parameters.get("relabel", None) is not False:
+                # pending phases move with their modes
+                permutation = self._mode_permutation(kind=kind, path=parameters["path"])
+                phases = {permutation.get(key, key): t for key, t in phases.items()}
+                self._relabel(permutation=permutation)
+            else:
+                self._add_phases(phases=phases)
+                phases = dict()
+                getattr(self, kind)(**parameters)
+                continue
+            self._abstract_setup.append(element)
+        self._add_phases(phases=phases)
+        return self
+
     def extract_parameters(self):
         return self._setup.extract_parameters()
 
@@ -168,43 +577,299 @@ class PhotonicSetup:
         result += str(self.paths)
         return result
 
-    def _add_measurements(self):
-        self._setup += tq.gates.Measurement(target=self.paths.qubits)
+    def _backend_circuit(self, simulator=None, key: int = None):
+        """
+        The setup compiled once for each backend (and prepared basis state)
+        The relabeling of the modes is not part of the circuit (the states are decoded with the mapped paths)
+        The cache is dropped when gates are added or the circuit is rebuilt (e.g. by optimize_circuit)
+        :param simulator: the tequila backend
+        :param key: if None: initial states are given to the backend as integers (wavefunctions)
+                    otherwise: integer of the basis state which is prepared with X gates in front of the setup
+                    (the sampling backends ignore initial states and start from the all-zero state)
+        :return: the compiled circuit
+        """
+        if self._compiled_circuit is not self._setup or self._compiled_gates != len(self._setup.gates):
+            self._circuit_cache = dict()
+            self._compiled_circuit = self._setup
+            self._compiled_gates = len(self._setup.gates)
+        if (simulator, key) not in self._circuit_cache:
+            circuit = self._setup
+            if key is not None:
+                prep = tq.gates.QCircuit()
+                for q in range(self.paths.n_qubits):
+                    if (key >> (self.paths.n_qubits - 1 - q)) & 1:
+                        prep += tq.gates.X(target=q)
+                circuit = prep + circuit
+            self._circuit_cache[(simulator, key)] = tq.compile(circuit, backend=simulator)
+        return self._circuit_cache[(simulator, key)]
+
+    def mode_unitary(self, variables: dict = None):
+        """
+        Only possible if the setup consists of linear-optical elements
+        (beamsplitters, phase shifters, dove prisms, mirrors and holograms)
+        :param variables: values for the variables of parametrized elements
+        :return: the unitary of the setup on the single-photon mode space
+        """
+        return linear_optics.setup_unitary(elements=self._abstract_setup, paths=self.paths, variables=variables)
+
+    def output_amplitudes(self, initial_state: [str, PhotonicStateVector], outputs: typing.List[str],
+                          variables: dict = None) -> numpy.ndarray:
+        """
+        Amplitudes of selected output Fock states computed from permanents of the mode unitary
+        Only possible if the setup consists of linear-optical elements
+        No wavefunction is built, so this scales to photon numbers where the qubit mapping is hopeless
+        :param initial_state: initial photonic state
+        :param outputs: output basis states in the form |x>_a|y>_b ..., paths which are not given are unoccupied
+        :param variables: values for the variables of parametrized elements
+        :return: the amplitudes in the order of outputs
+        """
+        if isinstance(initial_state, str):
+            initial_state = PhotonicStateVector.from_string(paths=self.paths, string=initial_state)
+        unitary = self.mode_unitary(variables=variables)
+        initial = linear_optics.state_occupations(initial_state)
+
+        result = numpy.zeros(len(outputs), dtype=complex)
+        for k, output in enumerate(outputs):
+            occupations_out = linear_optics.basis_state_occupations(
+                paths=self.paths, state=PhotonicStateVector.string_to_basis_state(string=output))
+            for occupations_in, coeff in initial.items():
+                result[k] += coeff * linear_optics.transition_amplitude(unitary=unitary, occupations_in=occupations_in,
+                                                                        occupations_out=occupations_out)
+        return result
+
+    def output_probabilities(self, initial_state: str, outputs: typing.List[str], gram: [float, numpy.ndarray] = 1.0,
+                             variables: dict = None, order: int = None) -> numpy.ndarray:
+        """
+        Probabilities of selected output Fock states for partially distinguishable photons
+        The photons carry internal states (time, frequency, polarization) which are not part of the setup,
+        their overlaps enter through the Gram matrix (see linear_optics.partially_distinguishable_probability)
+        Only possible if the setup consists of linear-optical elements
+        :param initial_state: initial basis state in the form |x>_a|y>_b ...
+        :param outputs: output basis states in the form |x>_a|y>_b ..., paths which are not given are unoccupied
+        :param gram: (photons x photons) matrix of the overlaps of the internal states of the input photons,
+                     ordered as the modes of PhotonicStateVector.modes,
+                     or a number: the same overlap for all pairs (1.0: indistinguishable, 0.0: distinguishable)
+        :param variables: values for the variables of parametrized elements
+        :param order: truncate to interference terms of at most order exchanged photons, exact if None
+        :return: the probabilities in the order of outputs
+        """
+        occupations_in = linear_optics.basis_state_occupations(
+            paths=self.paths, state=PhotonicStateVector.string_to_basis_state(string=initial_state))
+        n_photons = sum(occupations_in)
+        if numpy.isscalar(gram):
+            gram = numpy.full((n_photons, n_photons), gram, dtype=complex)
+            numpy.fill_diagonal(gram, 1.0)
+        gram = numpy.asarray(gram, dtype=complex)
+        if gram.shape != (n_photons, n_photons):
+            raise Exception("gram matrix needs shape ({n},{n}) for {n} photons, got {s}".format(n=n_photons,
+                                                                                           s=gram.shape))
+        unitary = self.mode_unitary(variables=variables)
+
+        result = numpy.zeros(len(outputs))
+        for k, output in enumerate(outputs):
+            occupations_out = linear_optics.basis_state_occupations(
+                paths=self.paths, state=PhotonicStateVector.string_to_basis_state(string=output))
+            result[k] = linear_optics.partially_distinguishable_probability(
+                unitary=unitary, occupations_in=occupations_in, occupations_out=occupations_out, gram=gram,
+                order=order)
+        return result
+
+    def gradient(self, initial_state: [str, PhotonicStateVector], observable: [typing.Callable, typing.List[str]],
+                 variables: dict = None) -> typing.Tuple[float, dict]:
+        """
+        Expectation value of an observable and its analytic gradient with respect to all variables of the setup
+        computed in one forward and one backward pass in the Fock space (see fock.adjoint_gradient)
+        Only possible if the setup consists of linear-optical elements
+        :param initial_state: initial photonic state
+        :param observable: function which gives the values of the observable for an (n x modes) array of occupations
+                           (modes ordered as in PhotonicStateVector.modes)
+                           or a list of output basis states, then the observable is their total probability
+        :param variables: values for the variables of parametrized elements
+        :return: the expectation value and the dictionary {variable: derivative}
+        """
+        if isinstance(initial_state, str):
+            initial_state = PhotonicStateVector.from_string(paths=self.paths, string=initial_state)
+        if not callable(observable):
+            accepted = PhotonicStateVector.from_arrays(paths=self.paths, occupations=[
+                linear_optics.basis_state_occupations(paths=self.paths,
+                                                      state=PhotonicStateVector.string_to_basis_state(string=output))
+                for output in observable], amplitudes=numpy.ones(len(observable)))
+            observable = lambda occupations: numpy.isin(row_keys(occupations), row_keys(accepted.occupations))
+        return fock.adjoint_gradient(elements=self._abstract_setup, paths=self.paths, initial_state=initial_state,
+                                     observable=observable, variables=variables)
+
+    def simulate_losses(self, initial_state: [str, PhotonicStateVector], model: LossModel, trajectories: int = 100,
+                        variables: dict = None, seed=None) -> TrajectoryResult:
+        """
+        Detection probabilities with photon loss and detector inefficiency
+        from Monte Carlo wavefunction trajectories (see noise.simulate_trajectories and ParallelSetup.trajectories)
+        Only possible if the setup consists of linear-optical elements
+        :param initial_state: initial photonic state
+        :param model: the LossModel with the transmissions of the elements and paths and the detector efficiency
+        :param trajectories: number of trajectories
+        :param variables: values for the variables of parametrized elements
+        :param seed: seed of the random numbers
+        :return: TrajectoryResult with the averaged detection probabilities and their standard errors
+        """
+        if isinstance(initial_state, str):
+            initial_state = PhotonicStateVector.from_string(paths=self.paths, string=initial_state)
+        return noise.simulate_trajectories(elements=self._abstract_setup, paths=self.paths,
+                                           initial_state=initial_state, model=model, trajectories=trajectories,
+                                           variables=variables, seed=seed)
+
+    def transfer_table(self, inputs: typing.List[typing.Union[str, PhotonicStateVector]],
+                       outputs: typing.List[str] = None,
+                       variables: dict = None) -> typing.Tuple[typing.List[str], numpy.ndarray]:
+        """
+        Output amplitudes for many initial states, e.g. all inputs with one photon in three of five paths
+        The element matrices are built once (see fock.FockSpace) and applied to all inputs at once
+        Only possible if the setup consists of linear-optical elements
+        :param inputs: initial photonic states
+        :param outputs: output basis states in the form |x>_a|y>_b ..., if None: all basis states which are reached
+        :param variables: values for the variables of parametrized elements
+        :return: the outputs and the (inputs x outputs) array of amplitudes
+        """
+        inputs = [PhotonicStateVector.from_string(paths=self.paths, string=state) if isinstance(state, str) else state
+                  for state in inputs]
+        space, table = fock.transfer_table(elements=self._abstract_setup, paths=self.paths, inputs=inputs,
+                                           variables=variables)
+        if outputs is None:
+            reached = numpy.flatnonzero(numpy.any(numpy.abs(table) >= 1.e-14, axis=1))
+            empty = PhotonicStateVector(paths=self.paths)
+            outputs = [empty.occupation_string(space.states[k]) for k in reached]
+            return outputs, table[reached].T
+
+        occupations = numpy.asarray([linear_optics.basis_state_occupations(
+            paths=self.paths, state=PhotonicStateVector.string_to_basis_state(string=output)) for output in outputs])
+        indices = space.index(occupations.reshape(len(outputs), -1), missing=len(space))
+        # outputs with other photon numbers than the inputs have zero amplitude
+        table = numpy.vstack([table, numpy.zeros(shape=(1, len(inputs)), dtype=complex)])
+        return list(outputs), table[indices].T
 
     def simulate_wavefunction(self, initial_state: [str, PhotonicStateVector] = None,
-                              simulator=None) -> PhotonicStateVector:
+                              simulator=None, variables: dict = None, engine: str = "qubit") -> PhotonicStateVector:
+        """
+        :param initial_state: initial photonic state, vacuum if None
+                              superpositions are simulated basis state by basis state with the qubit engine
+        :param simulator: the tequila backend (only used by the qubit engine)
+        :param variables: values for the variables of parametrized elements
+        :param engine: 'qubit': map to qubits and simulate with tequila
+                       'fock': simulate the linear-optical elements directly on the modes (no Trotter error)
+                       'subspace': evolve a dense vector in the Fock space with the photon numbers of the initial state
+                                   (truncated like the qubit encoding, no Trotter error)
+        :return: the final state
+        """
 
         if isinstance(initial_state, str):
             initial_state = PhotonicStateVector.from_string(paths=self.paths, string=initial_state)
 
-        if initial_state is None:
-            initial_state = 0
+        if engine == "fock":
+            return linear_optics.simulate_fock(elements=self._abstract_setup, paths=self.paths,
+                                               initial_state=initial_state, variables=variables)
+        elif engine == "subspace":
+            return fock.simulate_subspace(elements=self._abstract_setup, paths=self.paths,
+                                          initial_state=initial_state, variables=variables)
+        elif engine != "qubit":
+            raise Exception("unknown engine: {}".format(engine))
+
+        keys, amplitudes = basis_states(paths=self.paths, state=initial_state)
+        return simulate_basis_states(circuit=self._backend_circuit(simulator=simulator), paths=self.paths,
+                                     mapped_paths=self.mapped_paths, keys=keys, amplitudes=amplitudes,
+                                     variables=variables)
+
+    def sample(self, samples: int = 1, initial_state: str = None, simulator=None, variables: dict = None,
+               engine: str = "qubit"):
+        """
+        :param samples: number of samples
+        :param initial_state: see simulate_wavefunction, superpositions are sampled from the simulated wavefunction
+                              basis states are prepared with X gates (compiled once for each basis state)
+        :param simulator: the tequila backend (qubit engine), the compiled circuits are reused
+        :param variables: values for the variables of parametrized elements
+        :param engine: see simulate_wavefunction
+        :return: photonic counts, the heralded path is projected out if the setup has a heralding projector
+        """
+        if engine in ["fock", "subspace"]:
+            wfn = self.simulate_wavefunction(initial_state=initial_state, variables=variables, engine=engine)
+            pcounts = linear_optics.sample_state(state=wfn, samples=samples)
+        elif engine != "qubit":
+            raise Exception("unknown engine: {}".format(engine))
         else:
-            initial_state = initial_state.state
-
-        simresult = tq.simulate(self.setup, backend=simulator, initial_state=initial_state)
-        return PhotonicStateVector(paths=self.paths, state=simresult)
-
-    def sample(self, samples: int = 1, initial_state: str = None, simulator=None):
-        iprep = tq.gates.QCircuit()
-        if initial_state is not None:
-            state = self.initialize_state(state=initial_state)
-            # can only do product states right now, alltough more general ones are possible
-            assert (len(state.state) == 1)
-            key = [k for k in state.state.keys()][0]
-            for i, q in enumerate(key.array):
-                if q == 1:
-                    iprep += tq.gates.X(target=i)
-
-        self._add_measurements()
-
-        # those are the qubit counts given back by tequila
-        qcounts = tq.simulate(iprep + self.setup, samples=samples)
-        # those are the qubit counts re-interpreted as photonic counts
-        pcounts = PhotonicStateVector(paths=self.paths, state=qcounts)
+            pcounts = self._sample_qubits(samples=samples, initial_state=initial_state, simulator=simulator,
+                                          variables=variables)
 
+        if self.heralding is not None:
+            pcounts, _ = self.heralding.project(state=pcounts, counts=True)
         return pcounts
 
+    def _sample_qubits(self, samples: int, initial_state: [str, PhotonicStateVector] = None, simulator=None,
+                       variables: dict = None):
+        if isinstance(initial_state, str):
+            initial_state = PhotonicStateVector.from_string(paths=self.paths, string=initial_state)
+        keys, _ = basis_states(paths=self.paths, state=initial_state)
+        if len(keys) > 1:
+            # superpositions can not be given to the backend, sample from the wavefunction
+            wfn = self.simulate_wavefunction(initial_state=initial_state, simulator=simulator, variables=variables)
+            return linear_optics.sample_state(state=wfn, samples=samples)
+
+        paths = self.mapped_paths
+        circuit = self._backend_circuit(simulator=simulator, key=keys[0])
+        # tequila measures the active qubits only, the other ones are zero
+        qubits = list(circuit.abstract_qubits)
+        result, counts = [0], [samples]
+        if len(qubits) > 0:
+            # those are the qubit counts given back by tequila
+            qcounts = circuit(variables=variables, samples=samples)
+            result, counts = [], []
+            for k, v in qcounts.items():
+                measured = k.integer
+                result.append(sum(((measured >> (len(qubits) - 1 - i)) & 1) << (paths.n_qubits - 1 - q)
+                              for i, q in enumerate(qubits)))
+                counts.append(int(round(numpy.real(v))))
+
+        # those are the qubit counts re-interpreted as photonic counts
+        occupations = paths.decode_keys(result).reshape(len(result), -1)
+        return PhotonicStateVector.from_arrays(paths=self.paths, occupations=occupations,
+                                               amplitudes=numpy.asarray(counts, dtype=int))
+
+    def sample_stream(self, chunk: int = 1000, max_samples: int = None, precision: float = None,
+                      initial_state: str = None, simulator=None, variables: dict = None, engine: str = "qubit",
+                      heralder: PhotonicHeralder = None, z: float = 1.96,
+                      seed: typing.Union[int, numpy.random.Generator] = None) -> typing.Iterator[SampleStatistics]:
+        """
+        Sample in chunks with running count histogram, heralding rate and confidence intervals
+        The photon-number distribution is computed once, then the chunks are drawn from it instead of requesting
+        shots from the backend for every chunk (the same statistics as the shots of a noiseless simulator)
+        e.g. for statistics in setup.sample_stream(precision=0.01): print(statistics)
+        :param chunk: samples per chunk
+        :param max_samples: stop after this many samples
+        :param precision: stop when all confidence intervals have at most this half width
+        :param initial_state: see simulate_wavefunction
+        :param simulator: see simulate_wavefunction
+        :param variables: see simulate_wavefunction
+        :param engine: see simulate_wavefunction
+        :param heralder: only count the samples accepted by the heralder
+        :param z: quantile of the normal distribution for the confidence intervals (1.96 for 95%)
+        :param seed: seed or numpy random generator for reproducible chunks
+        :return: iterator over the running SampleStatistics (the same object, updated after each chunk)
+        """
+        wfn = self.simulate_wavefunction(initial_state=initial_state, simulator=simulator, variables=variables,
+                                         engine=engine)
+        return sampling.sample_stream(state=wfn, chunk=chunk, max_samples=max_samples, precision=precision,
+                                      heralder=heralder, z=z, seed=seed)
+
+    def compile(self, initial_state: [str, PhotonicStateVector] = None, simulator=None,
+                observables: typing.List[tq.hamiltonian.QubitHamiltonian] = None, engine: str = "qubit"):
+        """
+        Compile the setup once for parameter sweeps
+        :param initial_state: initial photonic basis state, vacuum if None
+        :param simulator: the tequila backend
+        :param observables: QubitHamiltonians for CompiledSetup.expectation_values
+        :param engine: 'qubit', 'fock' or 'subspace' (see simulate_wavefunction)
+        :return: CompiledSetup which takes batches of variables, e.g. {'t': numpy.linspace(0.0, 1.0, 100)}
+        """
+        return CompiledSetup(setup=self, initial_state=initial_state, simulator=simulator, observables=observables,
+                             engine=engine)
+
     @classmethod
     def from_paths(cls, paths: PhotonicPaths, setup: tq.gates.QCircuit = None):
         return cls(pathnames=[k for k in paths.keys()], S=paths.S, qpm=paths.qpm, setup=setup)
@@ -214,7 +879,9 @@ class PhotonicSetup:
         return self.from_paths(paths=self.paths, setup=self.setup + other.setup)
 
     def __iadd__(self, other):
+        self._flush_relabeling()
         self._setup += other.setup
+        self._replayable = False
         return self
 
     def prepare_332_state(self, path_a: str, path_b: str, path_c: str, daggered=False):
@@ -223,9 +890,9 @@ class PhotonicSetup:
         :return: A circuit which prepares the photonic 332 state in qubit representation
         """
 
-        pa = self.paths[path_a]
-        pb = self.paths[path_b]
-        pc = self.paths[path_c]
+        pa = self.mapped_paths[path_a]
+        pb = self.mapped_paths[path_b]
+        pc = self.mapped_paths[path_c]
 
         qubits = []  # qubits onto which the circuit will act
         max_qubit = 0  # maxmimal number of qubits in the whole path setup, the circuit should know that in order for the simulator to give back the states in correct formats
@@ -265,16 +932,33 @@ class PhotonicSetup:
         circuit += tq.gates.X(target=qubits[5], control=qubits[6])
         circuit += tq.gates.X(target=qubits[3], control=qubits[5])
 
+        parameters = {"path_a": path_a, "path_b": path_b, "path_c": path_c, "daggered": daggered}
         if daggered:
             self._setup += circuit.dagger()
-            self._abstract_setup += [AbstractElement(name="332^\\dagger", paths=[path_a, path_b, path_c])]
+            self._abstract_setup += [AbstractElement(name="332^\\dagger", paths=[path_a, path_b, path_c],
+                                                     kind="prepare_332_state", parameters=parameters)]
         else:
             self._setup += circuit
-            self._abstract_setup += [AbstractElement(name="332", paths=[path_a, path_b, path_c])]
+            self._abstract_setup += [AbstractElement(name="332", paths=[path_a, path_b, path_c],
+                                                     kind="prepare_332_state", parameters=parameters)]
         return self
 
-    def add_mirror(self, path: str):
-        p = self.paths[path]
+    def add_mirror(self, path: str, relabel: bool = None):
+        """
+        Photons in mode k are reflected to mode -k
+        :param path: the path
+        :param relabel: True: permute the modes by relabeling the qubits which hold them (no gates)
+                        False: SWAP gates, also after optimize_circuit
+                        None: SWAP gates, optimize_circuit turns them into a relabeling
+        :return: self for chaining
+        """
+        if relabel:
+            self._relabel(permutation=self._mode_permutation(kind="add_mirror", path=path))
+            self._abstract_setup += [AbstractElement(name="M", paths=[path], kind="add_mirror",
+                                                     parameters={"path": path, "relabel": relabel})]
+            return self
+
+        p = self.mapped_paths[path]
         result = tq.gates.QCircuit()
         passed_keys = [0]
         for k, v in p.items():
@@ -292,7 +976,8 @@ class PhotonicSetup:
                 raise Exception("No Partner for Mode %" % si1)
 
         self._setup += result
-        self._abstract_setup += [AbstractElement(name="M", paths=[path])]
+        self._abstract_setup += [AbstractElement(name="M", paths=[path], kind="add_mirror",
+                                                 parameters={"path": path, "relabel": relabel})]
         return self
 
     def add_doveprism(self, path: str, t):
@@ -300,10 +985,11 @@ class PhotonicSetup:
         :param t: The phase is parametrized by t: phase=exp(-i*pi*t)
         :return: DovePrism circuit
         """
-        for k, v in self.paths[path].items():
+        for k, v in self.mapped_paths[path].items():
             self._setup += QuditS(target=v, t=t * k)
 
-        self._abstract_setup += [AbstractElement(name="DP(\\phi)", paths=[path])]
+        self._abstract_setup += [AbstractElement(name="DP(\\phi)", paths=[path], kind="add_doveprism",
+                                                 parameters={"path": path, "t": t})]
         return self
 
     def add_phase_shifter(self, t, path: str, mode: int = None):
@@ -315,15 +1001,30 @@ class PhotonicSetup:
         """
         modes = [mode]
         if mode is None:
-            modes = self.paths[path].keys()
+            modes = self.mapped_paths[path].keys()
 
         for key in modes:
-            self._setup += QuditS(target=self.paths[path][key], t=t)
-            self._abstract_setup += [AbstractElement(name="PS(\\phi)", paths=[path])]
+            self._setup += QuditS(target=self.mapped_paths[path][key], t=t)
+            self._abstract_setup += [AbstractElement(name="PS(\\phi)", paths=[path], kind="add_phase_shifter",
+                                                     parameters={"t": t, "path": path, "mode": key})]
         return self
 
-    def add_hologram(self, path: str):
-        p = self.paths[path]
+    def add_hologram(self, path: str, relabel: bool = None):
+        """
+        Photons in mode k are shifted to mode k+1 (and from S to -S)
+        :param path: the path
+        :param relabel: True: permute the modes by relabeling the qubits which hold them (no gates)
+                        False: SWAP gates, also after optimize_circuit
+                        None: SWAP gates, optimize_circuit turns them into a relabeling
+        :return: self for chaining
+        """
+        if relabel:
+            self._relabel(permutation=self._mode_permutation(kind="add_hologram", path=path))
+            self._abstract_setup += [AbstractElement(name="H", paths=[path], kind="add_hologram",
+                                                     parameters={"path": path, "relabel": relabel})]
+            return self
+
+        p = self.mapped_paths[path]
         sorted_keys = [k for k in p.keys()]
         sorted_keys.sort(reverse=True)
         result = tq.gates.QCircuit()
@@ -333,7 +1034,8 @@ class PhotonicSetup:
             result += QuditSWAP(mode1=p[k], mode2=p[k - 1])
 
         self._setup += result
-        self._abstract_setup += [AbstractElement(name="H", paths=[path])]
+        self._abstract_setup += [AbstractElement(name="H", paths=[path], kind="add_hologram",
+                                                 parameters={"path": path, "relabel": relabel})]
         return self
 
     def add_parametrized_one_photon_projector(self, path: str, angles: typing.List[float], daggered=True):
@@ -352,7 +1054,7 @@ class PhotonicSetup:
         """
 
         # get the qubits which encode the 0 and 1 occupation numbers (the last of each mode, since we're in MSB numbering)
-        qubits = [mode.qubits[-1] for mode in self.paths[path].values()]
+        qubits = [mode.qubits[-1] for mode in self.mapped_paths[path].values()]
 
         result = tq.gates.QCircuit()
         result += tq.gates.Ry(target=qubits[-1], angle=angles[0])
@@ -366,12 +1068,17 @@ class PhotonicSetup:
             result += tq.gates.Ry(target=q, control=qubits[0], angle=angles[i])
             result += tq.gates.X(target=qubits[0], control=q)
 
+        parameters = {"path": path, "angles": angles, "daggered": daggered}
         if daggered:
             self._setup += result.dagger()
-            self._abstract_setup += [AbstractElement(name="R(\\theta)", paths=[path])]
+            self._abstract_setup += [AbstractElement(name="R(\\theta)", paths=[path],
+                                                     kind="add_parametrized_one_photon_projector",
+                                                     parameters=parameters)]
         else:
             self._setup += result
-            self._abstract_setup += [AbstractElement(name="R(\\theta)", paths=[path])]
+            self._abstract_setup += [AbstractElement(name="R(\\theta)", paths=[path],
+                                                     kind="add_parametrized_one_photon_projector",
+                                                     parameters=parameters)]
 
         # add heralder
         self.heralding = PhotonicHeraldingProjector(paths=self.paths, active_path=path)
@@ -391,7 +1098,7 @@ class PhotonicSetup:
         assert self.S > 0
 
         # identify the significant qubits encoding occs 0 and 1 in modes 0 and 1
-        qubits = [mode.qubits[-1] for mode in [self.paths[path][0], self.paths[path][1]]]
+        qubits = [mode.qubits[-1] for mode in [self.mapped_paths[path][0], self.mapped_paths[path][1]]]
 
         result = tq.gates.X(target=qubits[1])
         result += tq.gates.H(target=qubits[1])
@@ -406,7 +1113,9 @@ class PhotonicSetup:
         self.heralding = PhotonicHeraldingProjector(paths=self.paths, active_path=path,
                                                     delete_active_path=delete_active_path)
 
-        self._abstract_setup += [AbstractElement(name="R", paths=[path])]
+        self._abstract_setup += [AbstractElement(name="R", paths=[path], kind="add_one_photon_projector",
+                                                 parameters={"path": path, "daggered": daggered,
+                                                             "delete_active_path": delete_active_path})]
         return self
 
     def add_one_photon_projector_plus(self, path: str, daggered: bool = True, delete_active_path: bool = True):
@@ -422,7 +1131,7 @@ class PhotonicSetup:
         assert self.S > 0
 
         # identify the significant qubits encoding occs 0 and 1 in modes 0 and 1
-        qubits = [mode.qubits[-1] for mode in [self.paths[path][0], self.paths[path][1]]]
+        qubits = [mode.qubits[-1] for mode in [self.mapped_paths[path][0], self.mapped_paths[path][1]]]
 
         result = tq.gates.H(target=qubits[1])
         result += tq.gates.X(target=qubits[0], control=qubits[1])
@@ -436,15 +1145,17 @@ class PhotonicSetup:
         self.heralding = PhotonicHeraldingProjector(paths=self.paths, active_path=path,
                                                     delete_active_path=delete_active_path)
 
-        self._abstract_setup += [AbstractElement(name="R", paths=[path])]
+        self._abstract_setup += [AbstractElement(name="R", paths=[path], kind="add_one_photon_projector_plus",
+                                                 parameters={"path": path, "daggered": daggered,
+                                                             "delete_active_path": delete_active_path})]
         return self
 
     def prepare_SPDC_state(self, path_a: str, path_b: str):
         triple_angle = 0.9553166181245093
         qubits = []
         max_qubit = 0
-        a = self.paths[path_a]
-        b = self.paths[path_b]
+        a = self.mapped_paths[path_a]
+        b = self.mapped_paths[path_b]
         for path in [a, b]:
             for mode in [-1, 0, 1]:
                 if path[mode].numbering == tq.BitNumbering.LSB:
@@ -469,12 +1180,13 @@ class PhotonicSetup:
         result += tq.gates.X(target=qubits[4], control=qubits[3])
 
         self._setup += result
-        self._abstract_setup += [AbstractElement(name="SPDC", paths=[path_a, path_b])]
+        self._abstract_setup += [AbstractElement(name="SPDC", paths=[path_a, path_b], kind="prepare_SPDC_state",
+                                                 parameters={"path_a": path_a, "path_b": path_b})]
         return self
 
     def add_beamsplitter(self, path_a: str, path_b: str, t=0.25, phi=-pi / 2, steps: int = 1,
                          join_components: bool = True,
-                         randomize_component_order: bool = False, randomize: bool = False):
+                         randomize_component_order: bool = False, randomize: bool = False, exact: bool = False):
         """
         Beamsplitter is defined here as:
         exp(i*pi*t*(exp(i*phi)*a^\dagger b + exp(-i*phi)*b^\dagger a))
@@ -482,18 +1194,45 @@ class PhotonicSetup:
         :param path_b: name of path b
         :param t: parametrizes the angle: phi = i*pi*t
         :param steps:
-        :param join_components: convenience to play around with Trotterization, see DecomposeFirstOrderTrotter doc of OpenVQE
-        :param randomize_component_order: see before
+        :param join_components: deprecated, the generators of the modes commute and get one gate each
+        :param randomize_component_order: deprecated, the order of the commuting gates is fixed
         :param randomize: see before
+        :param exact: compile the mode mixing without Trotter error (see ExactModeMixing), steps etc are ignored
         :return:
         """
-        assert (len(self.paths[path_a]) == len(self.paths[path_b]))
-        assert (self.paths[path_a].keys() == self.paths[path_b].keys())
+        assert (len(self.mapped_paths[path_a]) == len(self.mapped_paths[path_b]))
+        assert (self.mapped_paths[path_a].keys() == self.mapped_paths[path_b].keys())
+        if not join_components or randomize_component_order:
+            warnings.warn("join_components and randomize_component_order are deprecated and ignored, "
+                          "the beamsplitter has one Trotterized gate for each mode", DeprecationWarning, stacklevel=2)
 
         # convenience
-        a = self.paths[path_a]
-        b = self.paths[path_b]
+        a = self.mapped_paths[path_a]
+        b = self.mapped_paths[path_b]
+
+        if exact:
+            result = tq.gates.QCircuit()
+            for mode in a.keys():
+                # exp(i*phi*n_b) G exp(-i*phi*n_b) gives the phase of the generator
+                result += QuditS(target=b[mode], t=-phi / pi)
+                result += ExactModeMixing(qubits_a=a[mode].qubits, qubits_b=b[mode].qubits, t=t,
+                                          cache=self.operator_cache)
+                result += QuditS(target=b[mode], t=phi / pi)
+        else:
+            result = self._trotterized_beamsplitter(a=a, b=b, t=t, phi=phi, steps=steps, cache=self.operator_cache,
+                                                    randomize=randomize)
+        self._setup += result
+        self._abstract_setup += [AbstractElement(name="BS(\\theta)", paths=[path_a, path_b], kind="add_beamsplitter",
+                                                 parameters={"path_a": path_a, "path_b": path_b, "t": t, "phi": phi,
+                                                             "steps": steps, "join_components": join_components,
+                                                             "randomize_component_order": randomize_component_order,
+                                                             "randomize": randomize, "exact": exact})]
 
+        # return self for chaining
+        return self
+
+    @staticmethod
+    def _trotterized_beamsplitter(a, b, t, phi, steps, cache, randomize):
         # Tequila uses the same angle convention for Trotterization as for QubitRotations, therefore the -2 here
         # the t parameter is added as angles to the TrotterizedGate
         omega = pi * -2.0
@@ -502,40 +1241,43 @@ class PhotonicSetup:
         modes = [k for k in a.keys()]
         generators = []
         for mode in modes:
-            hamiltonian = tq.hamiltonian.QubitHamiltonian.zero()
-            hamiltonian += creation(qubits=a[mode].qubits) * anihilation(qubits=b[mode].qubits)
-            generators.append(omega * (phase * hamiltonian + phase.conj() * hamiltonian.dagger()))
+            qubits_a, qubits_b = tuple(a[mode].qubits), tuple(b[mode].qubits)
 
-        parameters = tq.gates.TrotterParameters(join_components=join_components,
-                                                randomize_component_order=randomize_component_order,
-                                                randomize=randomize)
+            def builder():
+                hamiltonian = ladder_product([("creation", qubits_a), ("anihilation", qubits_b)], cache=cache)
+                hermitian_conjugate = ladder_product([("creation", qubits_b), ("anihilation", qubits_a)], cache=cache)
+                return omega * (phase * hamiltonian + phase.conj() * hermitian_conjugate)
 
-        result = tq.gates.Trotterized(generators=generators, steps=steps, parameters=parameters, angles=[t]*len(generators))
-        self._setup += result
-        self._abstract_setup += [AbstractElement(name="BS(\\theta)", paths=[path_a, path_b])]
-
-        # return self for chaining
-        return self
+            generators.append(cache.get(key=(("beamsplitter", qubits_a, qubits_b, phi),), builder=builder))
 
+        # one gate per mode: the generators act on different qubits and commute,
+        # so joining them or the order of the components does not change the circuit
+        result = tq.gates.QCircuit()
+        for generator in generators:
+            result += tq.gates.Trotterized(generator=generator, steps=steps, angle=t, randomize=randomize)
+        return result
 
     def add_edge(self, path_a: str, path_b: str, i:int, j:int, omega, steps: int = 1, *args, **kwargs):
         """
         Add an edge between path a and path b
         creating photons in |i>_a (x) |j>_b where i,j are the internal degrees of freedom (modes)
         """
-        assert (len(self.paths[path_a]) == len(self.paths[path_b]))
-        assert (self.paths[path_a].keys() == self.paths[path_b].keys())
+        assert (len(self.mapped_paths[path_a]) == len(self.mapped_paths[path_b]))
+        assert (self.mapped_paths[path_a].keys() == self.mapped_paths[path_b].keys())
 
         # convenience
-        a = self.paths[path_a]
-        b = self.paths[path_b]
+        a = self.mapped_paths[path_a]
+        b = self.mapped_paths[path_b]
 
-        generator = creation(qubits=a[i].qubits) * creation(qubits=b[j].qubits)
-        generator -= anihilation(qubits=a[i].qubits) * anihilation(qubits=b[j].qubits)
+        generator = ladder_product([("creation", a[i].qubits), ("creation", b[j].qubits)], cache=self.operator_cache)
+        generator -= ladder_product([("anihilation", a[i].qubits), ("anihilation", b[j].qubits)],
+                                    cache=self.operator_cache)
 
-        result = tq.gates.Trotterized(generators=[1.0j*generator], steps=steps, angles=[omega])
+        result = tq.gates.Trotterized(generator=1.0j*generator, steps=steps, angle=omega)
         self._setup += result
-        self._abstract_setup += [AbstractElement(name="Edge(\\omega)", paths=[path_a, path_b])]
+        self._abstract_setup += [AbstractElement(name="Edge(\\omega)", paths=[path_a, path_b], kind="add_edge",
+                                                 parameters={"path_a": path_a, "path_b": path_b, "i": i, "j": j,
+                                                             "omega": omega, "steps": steps})]
 
         # return self for chaining
         return self
@@ -549,14 +1291,18 @@ class PhotonicSetup:
         if isinstance(state, str):
             state = PhotonicStateVector.from_string(paths=self.paths, string=state)
             print("state=", state.state)
+        self._flush_relabeling()
         USP = UnaryStatePrep(target_space=state.state)
         U = USP(wfn=state.state)
+        parameters = {"state": state, "daggered": daggered}
         if daggered:
             self._setup += U.dagger()
-            self._abstract_setup += [AbstractElement(name="U^\dagger(\\theta)", paths=[k for k in state.paths.keys()])]
+            self._abstract_setup += [AbstractElement(name="U^\dagger(\\theta)", paths=[k for k in state.paths.keys()],
+                                                     kind="prepare_unary_type_state", parameters=parameters)]
         else:
             self._setup += U
-            self._abstract_setup += [AbstractElement(name="U(\\theta)", paths=[k for k in state.paths.keys()])]
+            self._abstract_setup += [AbstractElement(name="U(\\theta)", paths=[k for k in state.paths.keys()],
+                                                     kind="prepare_unary_type_state", parameters=parameters)]
         return self
 
     def add_circuit(self, U):
@@ -565,8 +1311,10 @@ class PhotonicSetup:
         :param U: add this unitary to the setup
         :return: self for chaining
         """
+        self._flush_relabeling()
         self._setup += U
-        self._abstract_setup += [AbstractElement(name="U(\\theta)", paths=[k for k in self.paths.keys()])]
+        self._abstract_setup += [AbstractElement(name="U(\\theta)", paths=[k for k in self.paths.keys()],
+                                                 kind="add_circuit", parameters={"U": U})]
         return self
 
     def export_to_qpic(self, filename=None) -> str:
@@ -0,0 +1,373 @@
+"""
+Simulation in the subspace of Fock states with fixed photon numbers
+The linear elements conserve the total photon number, so only the Fock states with the photon numbers
+of the initial state are enumerated (with the maximal occupation 2^qpm-1 of the qubit encoding per mode)
+and a dense vector of that size is evolved.
+The elements are applied as sparse (CSR) matrices on the Fock basis,
+mirrors and holograms are permutations and phase shifters are diagonal
+The beamsplitter is truncated in the same way as the ladder operators of the qubit encoding,
+so the result is the one of the qubit encoding without Trotter error
+"""
+import functools
+import numbers
+import typing
+import numpy
+import scipy.sparse
+
+import tequila as tq
+
+from photonic.mode import PhotonicPaths, PhotonicStateVector, occupation_dtype, row_keys
+from photonic.linear_optics import LINEAR_ELEMENTS, evaluate_parameter, mode_indices
+
+
+def fock_states(n_modes: int, photons: int, max_occ: int) -> typing.List[typing.Tuple[int]]:
+    """
+    :return: all occupation tuples of n_modes modes with the given total photon number and at most max_occ per mode
+    """
+    if n_modes == 0:
+        return [()] if photons == 0 else []
+    result = []
+    for n in range(min(photons, max_occ), -1, -1):
+        if photons - n > (n_modes - 1) * max_occ:
+            break
+        for rest in fock_states(n_modes=n_modes - 1, photons=photons - n, max_occ=max_occ):
+            result.append((n,) + rest)
+    return result
+
+
+@functools.lru_cache(maxsize=256)
+def two_mode_unitary(t: float, phi: float, max_occ: int) -> typing.Dict[int, typing.Tuple[list, numpy.ndarray]]:
+    """
+    exp(i*pi*t*(exp(i*phi)*b^\\dagger a + exp(-i*phi)*a^\\dagger b)) with ladder operators truncated at max_occ
+    :return: dictionary which holds for each total photon number n_a+n_b the basis states (n_a, n_b) of the block
+             and the unitary on them
+    """
+    result = dict()
+    for total in range(2 * max_occ + 1):
+        block = [(na, total - na) for na in range(max(0, total - max_occ), min(total, max_occ) + 1)]
+        generator = numpy.zeros(shape=[len(block), len(block)], dtype=complex)
+        for k, (na, nb) in enumerate(block[1:], start=1):
+            # b^\dagger a: block[k-1] has one photon less in a
+            generator[k - 1, k] = numpy.exp(1j * phi) * numpy.sqrt(na * (nb + 1))
+            generator[k, k - 1] = generator[k - 1, k].conjugate()
+        eigenvalues, eigenvectors = numpy.linalg.eigh(generator)
+        unitary = eigenvectors @ numpy.diag(numpy.exp(1j * numpy.pi * t * eigenvalues)) @ eigenvectors.conj().T
+        result[total] = (block, unitary)
+    return result
+
+
+def _scale(diagonal: numpy.ndarray, vector: numpy.ndarray) -> numpy.ndarray:
+    # diagonal matrix times vector (or times the columns of a matrix)
+    return diagonal[:, None] * vector if vector.ndim == 2 else diagonal * vector
+
+
+class FockSpace:
+    """
+    Fock states with the given total photon numbers on the modes of the paths
+    The modes are in the order of linear_optics.mode_indices (and PhotonicStateVector.modes)
+    """
+
+    def __init__(self, paths: PhotonicPaths, photons: typing.Union[int, typing.List[int]]):
+        """
+        :param paths: the photonic paths, the qubits per mode define the maximal occupation per mode
+        :param photons: the photon number(s) which span the space
+        """
+        if not hasattr(photons, "__len__"):
+            photons = [photons]
+        self.paths = paths
+        self.photons = sorted(set(photons))
+        self.max_occ = 2 ** paths.qpm - 1
+        self.indices = mode_indices(paths)
+        self.states = []
+        for n in self.photons:
+            self.states += fock_states(n_modes=len(self.indices), photons=n, max_occ=self.max_occ)
+        self._occupations = numpy.asarray(self.states, dtype=occupation_dtype(paths.qpm)).reshape(len(self.states),
+                                                                                                 len(self.indices))
+        keys = row_keys(self._occupations)
+        self._order = numpy.argsort(keys)
+        self._sorted_keys = keys[self._order]
+        # element matrices
+        self._cache = dict()
+
+    def __len__(self):
+        return len(self.states)
+
+    @classmethod
+    def from_state(cls, state: PhotonicStateVector) -> 'FockSpace':
+        """
+        :return: the space spanned by the photon numbers of the state
+        """
+        return cls(paths=state.paths, photons=numpy.unique(numpy.sum(state.occupations, axis=1)).tolist())
+
+    def vector(self, state: PhotonicStateVector) -> numpy.ndarray:
+        """
+        :return: the state as dense vector in this space
+        """
+        occupations = state.occupations
+        keys = row_keys(numpy.asarray(occupations, dtype=self._occupations.dtype))
+        positions = numpy.minimum(numpy.searchsorted(self._sorted_keys, keys), len(self) - 1)
+        missing = numpy.flatnonzero(self._sorted_keys[positions] != keys)
+        if len(missing) > 0:
+            raise Exception("{} is not part of the Fock space".format(state.occupation_string(
+                occupations[missing[0]].tolist())))
+        result = numpy.zeros(len(self), dtype=complex)
+        numpy.add.at(result, self._order[positions], state.amplitudes)
+        return result
+
+    def state(self, vector: numpy.ndarray, threshold: float = 1.e-14) -> PhotonicStateVector:
+        """
+        :return: the dense vector as PhotonicStateVector
+        """
+        keep = numpy.abs(vector) >= threshold
+        return PhotonicStateVector.from_arrays(paths=self.paths, occupations=self._occupations[keep],
+                                               amplitudes=vector[keep])
+
+    def index(self, occupations: numpy.ndarray, missing: int = None) -> numpy.ndarray:
+        """
+        :param occupations: (n x modes) array of occupation numbers which are part of this space
+        :param missing: if not None: index given back for the basis states which are not part of this space
+        :return: the indices of the basis states in this space
+        """
+        keys = row_keys(numpy.asarray(occupations, dtype=self._occupations.dtype))
+        if missing is None:
+            return self._order[numpy.searchsorted(self._sorted_keys, keys)]
+        positions = numpy.minimum(numpy.searchsorted(self._sorted_keys, keys), len(self) - 1)
+        return numpy.where(self._sorted_keys[positions] == keys, self._order[positions], missing)
+
+    def _pair_transfer(self, i: int, j: int, blocks: dict) -> scipy.sparse.csr_matrix:
+        # two-mode unitary on modes i and j
+        occupations = self._occupations
+        totals = occupations[:, i].astype(numpy.int64) + occupations[:, j]
+        rows, columns, values = [], [], []
+        for total in numpy.unique(totals):
+            block, unitary = blocks[total]
+            states = numpy.flatnonzero(totals == total)
+            # position of the input states in the block, block[k] = (first + k, total - first - k)
+            first = block[0][0]
+            position = occupations[states, i] - first
+            for row, (na, nb) in enumerate(block):
+                out = occupations[states].copy()
+                out[:, i] = na
+                out[:, j] = nb
+                rows.append(self.index(out))
+                columns.append(states)
+                values.append(unitary[row, position])
+        rows, columns, values = (numpy.concatenate(x) for x in (rows, columns, values))
+        keep = values != 0.0
+        return scipy.sparse.csr_matrix((values[keep], (rows[keep], columns[keep])), shape=(len(self), len(self)))
+
+    def _mode_transfer(self, pairs: typing.List[typing.Tuple[int, int]], blocks: dict) -> scipy.sparse.csr_matrix:
+        # the same two-mode unitary on each pair of modes
+        result = scipy.sparse.identity(len(self), dtype=complex, format="csr")
+        for i, j in pairs:
+            result = self._pair_transfer(i=i, j=j, blocks=blocks) @ result
+        return result.tocsr()
+
+    def _mode_permutation(self, permutation: typing.List[int]) -> scipy.sparse.csr_matrix:
+        # photons in mode i are moved to mode permutation[i]
+        out = numpy.empty_like(self._occupations)
+        out[:, permutation] = self._occupations
+        columns = numpy.arange(len(self))
+        return scipy.sparse.csr_matrix((numpy.ones(len(self), dtype=complex), (self.index(out), columns)),
+                                       shape=(len(self), len(self)))
+
+    def _mode_phases(self, phases: numpy.ndarray) -> scipy.sparse.csr_matrix:
+        # phase exp(i*pi*t_i*n_i) for each mode i
+        return scipy.sparse.diags(numpy.exp(1j * numpy.pi * (self._occupations @ phases)), format="csr")
+
+    def _pair_generator(self, i: int, j: int, phi: float) -> scipy.sparse.csr_matrix:
+        # exp(i*phi)*b^\dagger a + h.c. on modes i (a) and j (b), truncated like two_mode_unitary
+        occupations = self._occupations
+        states = numpy.flatnonzero((occupations[:, i] > 0) & (occupations[:, j] < self.max_occ))
+        out = occupations[states].copy()
+        out[:, i] -= 1
+        out[:, j] += 1
+        rows = self.index(out)
+        values = numpy.exp(1j * phi) * numpy.sqrt(occupations[states, i] * (occupations[states, j] + 1.0))
+        result = scipy.sparse.csr_matrix((values, (rows, states)), shape=(len(self), len(self)))
+        return result + result.conj().T
+
+    def element_derivatives(self, element, variables: dict = None) -> typing.Dict[str, typing.Callable]:
+        """
+        Analytic derivatives of the element matrix U with respect to its parameters
+        :param element: AbstractElement as recorded by PhotonicSetup
+        :param variables: values for the variables of parametrized elements
+        :return: dictionary {parameter: function(vector, U @ vector) which gives dU/dparameter @ vector}
+                 parameters which are fixed numbers are left out
+        """
+        parameters = element.parameters
+        result = dict()
+        if element.kind == "add_beamsplitter":
+            phi = evaluate_parameter(parameters["phi"], variables)
+            modes = self.paths[parameters["path_a"]].keys()
+            pairs = [(self.indices[(parameters["path_a"], mode)], self.indices[(parameters["path_b"], mode)])
+                     for mode in modes]
+            if not isinstance(parameters["t"], numbers.Number):
+                # U = exp(i*pi*t*G), the pairs commute
+                generator = sum(self._pair_generator(i=i, j=j, phi=phi) for i, j in pairs)
+                result["t"] = lambda vector, out: 1j * numpy.pi * (generator @ out)
+            if not isinstance(parameters["phi"], numbers.Number):
+                # U(phi) = exp(i*phi*N_b) U(0) exp(-i*phi*N_b)
+                weights = numpy.zeros(len(self.indices))
+                weights[[j for _, j in pairs]] = 1.0
+                n_b = self._occupations @ weights
+                matrix = self.element_matrix(element=element, variables=variables)
+                result["phi"] = lambda vector, out: 1j * (_scale(n_b, out) - matrix @ _scale(n_b, vector))
+        elif element.kind in ["add_phase_shifter", "add_doveprism"] and not isinstance(parameters["t"],
+                                                                                    numbers.Number):
+            weights = numpy.zeros(len(self.indices))
+            if element.kind == "add_phase_shifter":
+                weights[self.indices[(parameters["path"], parameters["mode"])]] = 1.0
+            else:
+                for mode in self.paths[parameters["path"]].keys():
+                    weights[self.indices[(parameters["path"], mode)]] = mode
+            # U = exp(i*pi*t*sum_k w_k n_k)
+            diagonal = self._occupations @ weights
+            result["t"] = lambda vector, out: 1j * numpy.pi * _scale(diagonal, out)
+        return result
+
+    def element_matrix(self, element, variables: dict = None, cache: bool = True) -> scipy.sparse.csr_matrix:
+        """
+        :param element: AbstractElement as recorded by PhotonicSetup
+        :param variables: values for the variables of parametrized elements
+        :param cache: keep the matrix for later calls with the same numerical parameters
+        :return: the element as sparse matrix on this space
+        """
+        if element.kind not in LINEAR_ELEMENTS:
+            raise Exception("element {} ({}) does not conserve the photon number".format(element.name, element.kind))
+
+        parameters = dict(element.parameters)
+        for name in ["t", "phi"]:
+            if name in parameters:
+                parameters[name] = evaluate_parameter(parameters[name], variables)
+        key = (element.kind,) + tuple(sorted(parameters.items()))
+        if key not in self._cache:
+            if not cache:
+                return self._element_matrix(kind=element.kind, parameters=parameters)
+            self._cache[key] = self._element_matrix(kind=element.kind, parameters=parameters)
+        return self._cache[key]
+
+    def _element_matrix(self, kind: str, parameters: dict) -> scipy.sparse.csr_matrix:
+        if kind == "add_beamsplitter":
+            pairs = [(self.indices[(parameters["path_a"], mode)], self.indices[(parameters["path_b"], mode)])
+                     for mode in self.paths[parameters["path_a"]].keys()]
+            blocks = two_mode_unitary(t=parameters["t"], phi=parameters["phi"], max_occ=self.max_occ)
+            return self._mode_transfer(pairs=pairs, blocks=blocks)
+        elif kind == "add_phase_shifter":
+            phases = numpy.zeros(len(self.indices))
+            phases[self.indices[(parameters["path"], parameters["mode"])]] = parameters["t"]
+            return self._mode_phases(phases=phases)
+        elif kind == "add_doveprism":
+            phases = numpy.zeros(len(self.indices))
+            for mode in self.paths[parameters["path"]].keys():
+                phases[self.indices[(parameters["path"], mode)]] = parameters["t"] * mode
+            return self._mode_phases(phases=phases)
+        else:
+            permutation = list(range(len(self.indices)))
+            modes = sorted(self.paths[parameters["path"]].keys())
+            for mode in modes:
+                if kind == "add_mirror":
+                    target = -mode
+                else:
+                    # hologram: k --> k+1 (cyclic in the simulated modes)
+                    target = modes[(modes.index(mode) + 1) % len(modes)]
+                permutation[self.indices[(parameters["path"], mode)]] = self.indices[(parameters["path"], target)]
+            return self._mode_permutation(permutation=permutation)
+
+    def evolve(self, elements: list, vector: numpy.ndarray, variables: dict = None) -> numpy.ndarray:
+        """
+        :param elements: AbstractElements in the order they act
+        :param vector: dense vector in this space
+        :return: the evolved vector
+        """
+        for element in elements:
+            vector = self.element_matrix(element=element, variables=variables) @ vector
+        return vector
+
+    def evolve_state(self, elements: list, state: PhotonicStateVector, variables: dict = None) -> PhotonicStateVector:
+        """
+        Same as evolve, but for PhotonicStateVectors
+        """
+        return self.state(self.evolve(elements=elements, vector=self.vector(state), variables=variables))
+
+
+def simulate_subspace(elements: list, paths: PhotonicPaths, initial_state: PhotonicStateVector = None,
+                      variables: dict = None) -> PhotonicStateVector:
+    """
+    Simulate a sequence of linear elements in the Fock space with the photon numbers of the initial state
+    :param elements: AbstractElements of the setup
+    :param paths: paths of the setup
+    :param initial_state: initial state, vacuum if None
+    :param variables: values for the variables of parametrized elements
+    :return: the final state
+    """
+    if initial_state is None:
+        space = FockSpace(paths=paths, photons=0)
+        vector = numpy.ones(1, dtype=complex)
+    else:
+        space = FockSpace.from_state(initial_state)
+        vector = space.vector(initial_state)
+    return space.state(space.evolve(elements=elements, vector=vector, variables=variables))
+
+
+def transfer_table(elements: list, paths: PhotonicPaths, inputs: typing.List[PhotonicStateVector],
+                   variables: dict = None) -> typing.Tuple[FockSpace, numpy.ndarray]:
+    """
+    Simulate many initial states at once, the element matrices are applied to the matrix of all input vectors
+    :param elements: AbstractElements of the setup
+    :param paths: paths of the setup
+    :param inputs: initial states
+    :param variables: values for the variables of parametrized elements
+    :return: the Fock space with the photon numbers of all inputs and the (space x inputs) matrix of the final states
+    """
+    photons = set()
+    for state in inputs:
+        photons.update(numpy.sum(state.occupations, axis=1).tolist())
+    space = FockSpace(paths=paths, photons=sorted(photons))
+    vectors = numpy.zeros(shape=(len(space), len(inputs)), dtype=complex)
+    for k, state in enumerate(inputs):
+        vectors[:, k] = space.vector(state)
+    return space, space.evolve(elements=elements, vector=vectors, variables=variables)
+
+
+def adjoint_gradient(elements: list, paths: PhotonicPaths, initial_state: PhotonicStateVector,
+                     observable: typing.Callable, variables: dict = None) -> typing.Tuple[float, dict]:
+    """
+    Expectation value of an observable which is diagonal in the Fock basis and its gradient with respect to all
+    variables of the elements in one forward and one backward pass (adjoint method)
+    The intermediate states are recomputed backwards with the inverse (adjoint) element matrices
+    :param elements: AbstractElements of the setup (linear-optical)
+    :param paths: paths of the setup
+    :param initial_state: initial state
+    :param observable: function which gives the values of the observable for an (n x modes) array of occupations
+    :param variables: values for the variables of parametrized elements
+    :return: the expectation value and the dictionary {variable: derivative}
+    """
+    space = FockSpace.from_state(initial_state)
+    state = space.evolve(elements=elements, vector=space.vector(initial_state), variables=variables)
+    weights = numpy.asarray(observable(space._occupations), dtype=float)
+    adjoint = weights * state
+    value = float(numpy.real(numpy.vdot(state, adjoint)))
+
+    if variables is None:
+        variables = dict()
+    formatted = tq.format_variable_dictionary(variables)
+    gradient = {k: 0.0 for k in formatted.keys()}
+    for element in reversed(elements):
+        matrix = space.element_matrix(element=element, variables=variables)
+        previous = matrix.conj().T @ state
+        for name, derivative in space.element_derivatives(element=element, variables=variables).items():
+            contribution = 2.0 * numpy.real(numpy.vdot(adjoint, derivative(previous, state)))
+            parameter = element.parameters[name]
+            if not hasattr(parameter, "extract_variables"):
+                parameter = tq.assign_variable(parameter)
+            if isinstance(parameter, tq.Variable):
+                gradient[parameter] = gradient.get(parameter, 0.0) + contribution
+                continue
+            # chain rule for parameters like pi*Variable
+            for variable in parameter.extract_variables():
+                factor = evaluate_parameter(tq.grad(parameter, variable), variables)
+                gradient[variable] = gradient.get(variable, 0.0) + contribution * factor
+        adjoint = matrix.conj().T @ adjoint
+        state = previous
+    return value, gradient
@@ -0,0 +1,326 @@
+"""
+Native simulation of the linear-optical part of a PhotonicSetup
+The recorded elements are interpreted as unitaries on the single-photon mode space
+and the photonic states are evolved directly in the Fock basis (no qubit mapping, no Trotter error)
+"""
+import itertools
+import math
+import numbers
+import typing
+import numpy
+
+import tequila as tq
+
+from photonic.mode import PhotonicPaths, PhotonicStateVector
+
+# elements (by the name of the PhotonicSetup method which adds them) which act linearly on the modes
+LINEAR_ELEMENTS = ["add_beamsplitter", "add_phase_shifter", "add_doveprism", "add_mirror", "add_hologram"]
+
+
+def evaluate_parameter(value, variables: dict = None):
+    """
+    :param value: a number, a tequila Variable/Objective or a hashable which names a variable
+    :param variables: values for the variables
+    :return: the numerical value of the parameter
+    """
+    if isinstance(value, numbers.Number):
+        return value
+    if variables is None:
+        variables = dict()
+    if not hasattr(value, "extract_variables"):
+        value = tq.assign_variable(value)
+    return value(tq.format_variable_dictionary(variables))
+
+
+def mode_indices(paths: PhotonicPaths) -> typing.Dict[typing.Tuple[str, int], int]:
+    """
+    :return: dictionary which maps (path, mode) to the index of the mode in the single-photon mode space
+    The order follows the order of the paths and the modes therein
+    """
+    result = dict()
+    for pname, p in paths.items():
+        for mname in p.keys():
+            result[(pname, mname)] = len(result)
+    return result
+
+
+def element_unitary(element, paths: PhotonicPaths, variables: dict = None) -> numpy.ndarray:
+    """
+    Single-photon unitary u of a linear element
+    creation operators transform as c_j^\\dagger --> sum_i u_ij c_i^\\dagger
+    :param element: AbstractElement as recorded by PhotonicSetup
+    :param paths: the paths of the setup
+    :param variables: values for the variables of parametrized elements
+    :return: the unitary as dense matrix
+    """
+    if element.kind not in LINEAR_ELEMENTS:
+        raise Exception("element {} ({}) is not a linear-optical element".format(element.name, element.kind))
+
+    indices = mode_indices(paths)
+    result = numpy.eye(len(indices), dtype=complex)
+    parameters = element.parameters
+
+    if element.kind == "add_beamsplitter":
+        # same convention as the qubit encoding, where the generator of add_beamsplitter
+        # acts as exp(i*pi*t*(exp(i*phi)*b^\dagger a + exp(-i*phi)*a^\dagger b)) on the occupation numbers
+        theta = numpy.pi * evaluate_parameter(parameters["t"], variables)
+        phase = numpy.exp(1j * evaluate_parameter(parameters["phi"], variables))
+        for mode in paths[parameters["path_a"]].keys():
+            a = indices[(parameters["path_a"], mode)]
+            b = indices[(parameters["path_b"], mode)]
+            result[a, a] = numpy.cos(theta)
+            result[b, b] = numpy.cos(theta)
+            result[a, b] = 1j * phase.conjugate() * numpy.sin(theta)
+            result[b, a] = 1j * phase * numpy.sin(theta)
+    elif element.kind == "add_phase_shifter":
+        # phase exp(i*pi*t*n) on occupation n (up to a global phase of the qubit encoding)
+        t = evaluate_parameter(parameters["t"], variables)
+        i = indices[(parameters["path"], parameters["mode"])]
+        result[i, i] = numpy.exp(1j * numpy.pi * t)
+    elif element.kind == "add_doveprism":
+        t = evaluate_parameter(parameters["t"], variables)
+        for mode in paths[parameters["path"]].keys():
+            i = indices[(parameters["path"], mode)]
+            result[i, i] = numpy.exp(1j * numpy.pi * t * mode)
+    elif element.kind == "add_mirror":
+        # photons in mode k are reflected to mode -k
+        result[:, :] = 0.0
+        for (pname, mode), i in indices.items():
+            if pname == parameters["path"]:
+                result[indices[(pname, -mode)], i] = 1.0
+            else:
+                result[i, i] = 1.0
+    elif element.kind == "add_hologram":
+        # photons in mode k are shifted to mode k+1 (cyclic in the simulated modes)
+        result[:, :] = 0.0
+        modes = sorted(paths[parameters["path"]].keys())
+        for (pname, mode), i in indices.items():
+            if pname == parameters["path"]:
+                target = modes[(modes.index(mode) + 1) % len(modes)]
+                result[indices[(pname, target)], i] = 1.0
+            else:
+                result[i, i] = 1.0
+
+    return result
+
+
+def setup_unitary(elements: list, paths: PhotonicPaths, variables: dict = None) -> numpy.ndarray:
+    """
+    :param elements: list of AbstractElements in the order they act
+    :return: the single-photon unitary of the whole sequence of elements
+    """
+    result = numpy.eye(len(mode_indices(paths)), dtype=complex)
+    for element in elements:
+        result = element_unitary(element=element, paths=paths, variables=variables) @ result
+    return result
+
+
+def fock_amplitudes(unitary: numpy.ndarray, occupations: typing.Tuple[int]) -> typing.Dict[
+    typing.Tuple[int], complex]:
+    """
+    Evolve a single Fock state by expanding the transformed creation operators
+    :param unitary: single-photon unitary
+    :param occupations: occupation number of each mode (in the order of mode_indices)
+    :return: dictionary of output occupations and their amplitudes
+    """
+    norm = numpy.prod([math.factorial(n) for n in occupations])
+    current = {tuple([0] * len(occupations)): 1.0 / numpy.sqrt(norm)}
+    for j, n in enumerate(occupations):
+        column = unitary[:, j]
+        support = [i for i in range(len(column)) if column[i] != 0.0]
+        for _ in range(n):
+            updated = dict()
+            for occ, coeff in current.items():
+                for i in support:
+                    key = occ[:i] + (occ[i] + 1,) + occ[i + 1:]
+                    updated[key] = updated.get(key, 0.0) + coeff * column[i]
+            current = updated
+
+    result = dict()
+    for occ, coeff in current.items():
+        result[occ] = coeff * numpy.sqrt(numpy.prod([math.factorial(n) for n in occ]))
+    return result
+
+
+def permanent(matrix: numpy.ndarray, chunk: int = 2 ** 16) -> complex:
+    """
+    Permanent with Glynn's formula, the sign vectors are traversed in Gray-code order
+    so that each step only updates one row (vectorized over chunks of steps with cumsum)
+    :param matrix: square matrix
+    :param chunk: number of Gray-code steps which are processed at once
+    :return: the permanent
+    """
+    matrix = numpy.asarray(matrix, dtype=complex)
+    n = matrix.shape[0]
+    if n == 0:
+        return 1.0
+    if n == 1:
+        return matrix[0, 0]
+
+    total = 0.0
+    current = numpy.sum(matrix, axis=0)
+    total += numpy.prod(current)
+    n_steps = 2 ** (n - 1)
+    for start in range(1, n_steps, chunk):
+        k = numpy.arange(start, min(start + chunk, n_steps), dtype=numpy.int64)
+        # the bit which flips in step k is the lowest set bit of k
+        flipped = numpy.log2(k & -k).astype(numpy.int64)
+        gray = k ^ (k >> 1)
+        delta = 1 - 2 * ((gray >> flipped) & 1)
+        sums = current + numpy.cumsum(2 * delta[:, None] * matrix[flipped + 1], axis=0)
+        # exactly one sign flips per step, so the sign of the product of deltas alternates
+        signs = 1 - 2 * (k & 1)
+        total += numpy.sum(signs * numpy.prod(sums, axis=1))
+        current = sums[-1]
+    return total / n_steps
+
+
+def transition_amplitude(unitary: numpy.ndarray, occupations_in: typing.Tuple[int],
+                         occupations_out: typing.Tuple[int]) -> complex:
+    """
+    <out|U|in> for Fock states from the permanent of the submatrix of the single-photon unitary
+    :param unitary: single-photon unitary
+    :param occupations_in: occupation number of each mode (in the order of mode_indices)
+    :param occupations_out: same for the output state
+    :return: the amplitude
+    """
+    if sum(occupations_in) != sum(occupations_out):
+        return 0.0
+    columns = [j for j, n in enumerate(occupations_in) for _ in range(n)]
+    rows = [i for i, n in enumerate(occupations_out) for _ in range(n)]
+    norm = numpy.prod([math.factorial(n) for n in occupations_in])
+    norm *= numpy.prod([math.factorial(n) for n in occupations_out])
+    return permanent(unitary[numpy.ix_(rows, columns)]) / numpy.sqrt(norm)
+
+
+def displacements(n: int, order: int = None) -> typing.Iterator[typing.Tuple[int]]:
+    """
+    :param n: number of elements
+    :param order: maximal number of elements which are not fixed, all permutations if None
+    :return: iterator over the permutations of range(n) with at most order elements which are not fixed
+    """
+    if order is None or order > n:
+        order = n
+    for k in range(order + 1):
+        for moved in itertools.combinations(range(n), k):
+            for image in itertools.permutations(moved):
+                if any(i == j for i, j in zip(moved, image)):
+                    continue
+                result = list(range(n))
+                for i, j in zip(moved, image):
+                    result[i] = j
+                yield tuple(result)
+
+
+def partially_distinguishable_probability(unitary: numpy.ndarray, occupations_in: typing.Tuple[int],
+                                          occupations_out: typing.Tuple[int], gram: numpy.ndarray,
+                                          order: int = None) -> float:
+    """
+    Probability of an output pattern for photons with internal states (Tichy, Shchesnovich)
+    P = 1/(prod m_in! prod m_out!) sum_sigma prod_k S_(sigma(k),k) perm(M * conj(M[:, sigma]))
+    with M the submatrix of the unitary for the input photons (columns) and output photons (rows)
+    :param unitary: single-photon unitary
+    :param occupations_in: occupation number of each mode (in the order of mode_indices)
+    :param occupations_out: same for the output pattern
+    :param gram: (photons x photons) overlaps S_kl = <phi_k|phi_l> of the internal states of the input photons
+                 (photons ordered by their modes), identity: distinguishable, all ones: indistinguishable
+    :param order: truncate the sum to permutations which exchange at most order photons
+                  (0 gives the probability of distinguishable photons), exact if None
+    :return: the probability
+    """
+    if sum(occupations_in) != sum(occupations_out):
+        return 0.0
+    columns = [j for j, n in enumerate(occupations_in) for _ in range(n)]
+    rows = [i for i, n in enumerate(occupations_out) for _ in range(n)]
+    matrix = unitary[numpy.ix_(rows, columns)]
+    gram = numpy.asarray(gram, dtype=complex)
+    result = 0.0
+    for sigma in displacements(len(columns), order=order):
+        weight = numpy.prod(gram[list(sigma), numpy.arange(len(columns))])
+        if weight == 0.0:
+            continue
+        result += weight * permanent(matrix * matrix[:, sigma].conj())
+    norm = numpy.prod([math.factorial(n) for n in occupations_in])
+    norm *= numpy.prod([math.factorial(n) for n in occupations_out])
+    return float(numpy.real(result)) / norm
+
+
+def basis_state_occupations(paths: PhotonicPaths, state: typing.Dict[str, typing.Dict[int, int]]) -> typing.Tuple[int]:
+    """
+    :param state: basis state in the form {path: {mode:occ}} (as from PhotonicStateVector.string_to_basis_state)
+                  paths or modes which are not given are unoccupied
+    :return: occupation tuple in the order of mode_indices
+    """
+    return tuple(state.get(pname, dict()).get(mname, 0) for pname, mname in mode_indices(paths).keys())
+
+
+def state_occupations(state: PhotonicStateVector) -> typing.Dict[typing.Tuple[int], complex]:
+    """
+    :return: dictionary of occupation tuples (in the order of mode_indices) and amplitudes of the state
+    """
+    return dict(zip(map(tuple, state.occupations.tolist()), state.amplitudes.tolist()))
+
+
+def occupations_to_state(paths: PhotonicPaths, amplitudes: typing.Dict[typing.Tuple[int], complex],
+                         threshold: float = 1.e-14) -> PhotonicStateVector:
+    """
+    Inverse of state_occupations
+    Raises if an occupation can not be represented with the qubits per mode of the paths
+    """
+    max_occ = 2 ** paths.qpm - 1
+    n_modes = len(mode_indices(paths))
+    occupations = numpy.asarray(list(amplitudes.keys()), dtype=numpy.int64).reshape(len(amplitudes), n_modes)
+    values = numpy.asarray(list(amplitudes.values()), dtype=complex)
+    keep = numpy.abs(values) >= threshold
+    occupations = occupations[keep]
+    if occupations.size > 0 and occupations.max() > max_occ:
+        raise Exception("occupation {} exceeds the maximal occupation {} of qpm={}, increase qpm".format(
+            occupations.max(), max_occ, paths.qpm))
+    return PhotonicStateVector.from_arrays(paths=paths, occupations=occupations, amplitudes=values[keep])
+
+
+def simulate_fock(elements: list, paths: PhotonicPaths, initial_state: PhotonicStateVector = None,
+                  variables: dict = None) -> PhotonicStateVector:
+    """
+    Simulate a sequence of linear elements directly in the Fock basis
+    :param elements: AbstractElements of the setup
+    :param paths: paths of the setup
+    :param initial_state: initial state, vacuum if None
+    :param variables: values for the variables of parametrized elements
+    :return: the final state
+    """
+    unitary = setup_unitary(elements=elements, paths=paths, variables=variables)
+    if initial_state is None:
+        initial = {tuple([0] * unitary.shape[0]): 1.0}
+    else:
+        initial = state_occupations(initial_state)
+    return fock_state(unitary=unitary, paths=paths, initial=initial)
+
+
+def fock_state(unitary: numpy.ndarray, paths: PhotonicPaths,
+               initial: typing.Dict[typing.Tuple[int], complex]) -> PhotonicStateVector:
+    """
+    :param unitary: single-photon unitary of the setup (see setup_unitary)
+    :param paths: paths of the setup
+    :param initial: occupation tuples and amplitudes of the initial state (see state_occupations)
+    :return: the final state
+    """
+    result = dict()
+    for occ, coeff in initial.items():
+        for out, value in fock_amplitudes(unitary=unitary, occupations=occ).items():
+            result[out] = result.get(out, 0.0) + coeff * value
+    return occupations_to_state(paths=paths, amplitudes=result)
+
+
+def sample_state(state: PhotonicStateVector, samples: int,
+                 seed: typing.Union[int, numpy.random.Generator] = None) -> PhotonicStateVector:
+    """
+    Draw samples from the photon-number distribution of a wavefunction
+    :param seed: seed or numpy random generator
+    :return: counts in the same format as tequila gives them back
+    """
+    probabilities = numpy.abs(numpy.asarray(state.amplitudes, dtype=complex)) ** 2
+    counts = numpy.random.default_rng(seed).multinomial(samples, probabilities / numpy.sum(probabilities))
+    drawn = counts > 0
+    return PhotonicStateVector.from_arrays(paths=state.paths, occupations=state.occupations[drawn],
+                                           amplitudes=counts[drawn])
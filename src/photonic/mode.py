@@ -1,11 +1,13 @@
 """
 Wrappers to represent photonic modes by multiple qubits
 """
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from copy import deepcopy
+import re
 from tequila import QubitWaveFunction, BitString, BitNumbering
 from tequila.tools.convenience import number_to_string
 from numpy import isclose
+import numpy
 
 
 class PhotonicMode:
@@ -106,6 +108,11 @@ class PhotonicPaths:
                 qubit_key += qpm
             self._paths[path_name] = path
 
+        # for decode_keys and encode_occupations, the paths do not change after construction
+        qubits = numpy.array([[m.qubits for m in p.values()] for p in self.values()], dtype=numpy.int64)
+        self._shifts = self.n_qubits - 1 - qubits
+        self._shifts.setflags(write=False)
+
     def __repr__(self):
         result = "PhotonicPath with " + str(self.n_qubits) + " Qubits\n"
         for name, p in self.items():
@@ -129,13 +136,10 @@ class PhotonicPaths:
         :param i: the bitstring
         :return: photonic notation as string
         """
+        occupations = self.decode_keys([int(i)])[0]
         result = ""
-        for pname, p in self.items():
-            result += "|"
-            for mname, m in p.items():
-                nocc = BitString.from_array(array=[i[k] for k in m.qubits], nbits=self.n_qubits)
-                result += str(nocc.integer)
-            result += ">_" + str(pname)
+        for pname, occ in zip(self.keys(), occupations.tolist()):
+            result += "|" + "".join(str(n) for n in occ) + ">_" + str(pname)
         return result
 
     def extract_occupation_numbers(self, i: BitString) -> Dict[str, Dict[int, BitString]]:
@@ -143,45 +147,183 @@ class PhotonicPaths:
         Same as interpret bitstring, but returns a dictionary of dictionaries (indexed by paths and modes) holding occupation numbers
         e.g. result['a'][-1] gives back the occupation number of mode S=-1 in path a
         """
+        occupations = self.decode_keys([int(i)])[0]
         result = dict()
-        for pname, p in self.items():
-            modes = dict()
-            for mname, m in p.items():
-                nocc = BitString.from_array(array=[i[k] for k in m.qubits], nbits=self.n_qubits)
-                modes[mname] = nocc
-            result[pname] = modes
+        for (pname, p), occ in zip(self.items(), occupations.tolist()):
+            result[pname] = {mname: BitString.from_int(integer=n, nbits=self.n_qubits) for mname, n in zip(p.keys(), occ)}
         return result
 
+    def qubit_shifts(self) -> numpy.ndarray:
+        """
+        :return: (paths x modes x qpm) array with the position of each qubit in the integer of a basis state
+                 (the integer of the BitString in MSB numbering), computed once when the paths are created
+        """
+        return self._shifts
+
+    def _key_array(self, keys) -> numpy.ndarray:
+        # python integers (object array) if the keys don't fit into int64
+        if self.n_qubits < 64:
+            return numpy.asarray(keys, dtype=numpy.int64)
+        return numpy.asarray([int(k) for k in keys], dtype=object)
+
+    def decode_keys(self, keys) -> numpy.ndarray:
+        """
+        Batch version of extract_occupation_numbers
+        :param keys: integers of the qubit basis states (e.g. keys of a QubitWaveFunction converted to int)
+        :return: (len(keys) x paths x modes) array of occupation numbers, paths and modes in the order of self.items()
+        """
+        keys = self._key_array(keys)
+        shifts = self.qubit_shifts()
+        result = numpy.zeros(shape=(len(keys),) + shifts.shape[:2], dtype=keys.dtype)
+        for i in range(self.qpm):
+            # the first qubit of a mode is the most significant bit of the occupation number
+            result |= ((keys[:, None, None] >> shifts[:, :, i]) & 1) << (self.qpm - 1 - i)
+        return result.astype(occupation_dtype(self.qpm))
+
+    def encode_occupations(self, occupations) -> numpy.ndarray:
+        """
+        Inverse of decode_keys
+        :param occupations: array of occupation numbers, (n x paths x modes) or (n x paths*modes)
+        :return: integers of the corresponding qubit basis states
+        """
+        shifts = self.qubit_shifts()
+        occupations = numpy.asarray(occupations).reshape((-1,) + shifts.shape[:2])
+        dtype = numpy.int64 if self.n_qubits < 64 else object
+        occupations = occupations.astype(dtype)
+        result = numpy.zeros(len(occupations), dtype=dtype)
+        for i in range(self.qpm):
+            bits = (occupations >> (self.qpm - 1 - i)) & 1
+            result |= numpy.sum(bits << shifts[None, :, :, i].astype(dtype), axis=(1, 2))
+        return result
+
+
+# one ket |x>_a of a basis state: occupation numbers and path name (the underscore is optional)
+_KET = re.compile(r"\|([0-9]*)>_?([^\s|+\-()]+)")
+# one term of a superposition: coefficient (maybe empty) and the kets
+_TERM = re.compile(r"\s*([^|]*?)\s*((?:\|[0-9]*>_?[^\s|+\-()]+\s*)+)")
+
+
+def _split_terms(string: str) -> List[Tuple[complex, List[Tuple[str, str]]]]:
+    """
+    :param string: superposition in the form c1|x>_a|y>_b+c2|z>_a|w>_b ...
+    :return: list of (coefficient, [(occupation string, path), ...]) for each term
+    """
+    result = []
+    position = 0
+    for match in _TERM.finditer(string):
+        if match.start() != position:
+            break
+        position = match.end()
+        coeff = match.group(1).replace(" ", "")
+        if coeff.startswith("+"):
+            coeff = coeff[1:]
+        sign = 1.0
+        if coeff.startswith("-"):
+            sign = -1.0
+            coeff = coeff[1:]
+        if coeff.startswith("(") and coeff.endswith(")"):
+            coeff = coeff[1:-1]
+        try:
+            coeff = sign * (complex(coeff.replace("i", "j")) if coeff != "" else 1.0)
+        except ValueError:
+            raise Exception("can not read coefficient {} in {}".format(match.group(1), string))
+        result.append((coeff, _KET.findall(match.group(2))))
+    if string[position:].strip() != "" or len(result) == 0:
+        raise Exception("can not read state {} at position {}".format(string, position))
+    return result
+
+
+def occupation_dtype(qpm: int) -> numpy.dtype:
+    """
+    :return: smallest unsigned integer type which holds the occupation numbers of qpm qubits
+    """
+    return numpy.min_scalar_type(2 ** qpm - 1)
+
+
+def row_keys(occupations: numpy.ndarray) -> numpy.ndarray:
+    """
+    :return: one hashable/sortable entry per row of the occupation array (for unique, intersect etc)
+    """
+    occupations = numpy.ascontiguousarray(occupations)
+    return occupations.view(numpy.dtype((numpy.void, occupations.dtype.itemsize * occupations.shape[1]))).ravel()
+
 
 class PhotonicStateVector:
     """
     Take the simulator result and keep track of the photonic modes
+    The state is either held as QubitWaveFunction or as arrays of occupation numbers and amplitudes
+    each representation is created lazily from the other one when needed
     """
 
     @classmethod
-    def from_string(cls, paths: PhotonicPaths, string: str):
+    def from_arrays(cls, paths: PhotonicPaths, occupations, amplitudes):
         """
-        Terms are splitted by '+' so complex values like (x+iy)|...> will not work, you need to add Real and imaginary separately
-        Or improve this consructor :-)
-        :param paths:
-        :param string:
-        :return:
+        :param paths: the photonic paths
+        :param occupations: (n_states x n_modes) array of occupation numbers, modes ordered as in self.modes
+        :param amplitudes: amplitudes (or counts) of the basis states, duplicated basis states are added up
+        :return: the state vector
         """
-        string = string.lstrip('+')
-        result = cls(paths)
-        terms = string.split('+')
-        for term in terms:
-
-            tmp = term.split("|")
-            if tmp[0] == '':
-                coeff = 1.0
-            else:
-                coeff = complex(tmp[0])
-
-            basis_state = cls.string_to_basis_state(string=term)
-            result.add_basis_state(state=basis_state, coeff=coeff)
+        amplitudes = numpy.asarray(amplitudes)
+        n_modes = sum(len(p) for p in paths.values())
+        occupations = numpy.asarray(occupations, dtype=occupation_dtype(paths.qpm)).reshape(len(amplitudes), n_modes)
+        # combine duplicates but keep the order of first appearance
+        unique, first, inverse = numpy.unique(row_keys(occupations), return_index=True, return_inverse=True)
+        if len(unique) < len(amplitudes):
+            combined = numpy.zeros(len(unique), dtype=amplitudes.dtype)
+            numpy.add.at(combined, inverse, amplitudes)
+            order = numpy.argsort(first)
+            occupations = occupations[first[order]]
+            amplitudes = combined[order]
+
+        result = cls(paths=paths)
+        result._state = None
+        result._occupations = occupations
+        result._amplitudes = amplitudes
         return result
 
+    @classmethod
+    def from_string(cls, paths: PhotonicPaths, string: str):
+        """
+        :param paths: the photonic paths
+        :param string: superposition of basis states in the form c1|x>_a|y>_b+c2|z>_a|w>_b ...
+                       coefficients are optional, e.g. -1.0, 0.5j, 1-1j or (0.5+0.5i)
+                       path names can have more than one character, paths which are not given are empty
+                       the occupation numbers of a path are the 2s+1 modes -s...s with s<=S
+        :return: the state vector
+        """
+        # column of mode -s in each path (the modes of the string are centered in the path)
+        offsets = dict()
+        j = 0
+        for pname, p in paths.items():
+            offsets[str(pname)] = j + paths.S
+            j += len(p)
+        max_occ = 2 ** paths.qpm - 1
+
+        coefficients = []
+        rows = []
+        for coeff, kets in _split_terms(string):
+            coefficients.append(coeff)
+            row = [0] * j
+            for occs, pname in kets:
+                if pname not in offsets:
+                    raise Exception("unknown path {} in {}".format(pname, string))
+                if len(occs) % 2 == 0:
+                    raise Exception("need an odd number of modes (2S+1, centered) in path {}: {}".format(pname, occs))
+                s = (len(occs) - 1) // 2
+                if s > paths.S:
+                    raise Exception("more modes than S={} in path {}: {}".format(paths.S, pname, occs))
+                start = offsets[pname] - s
+                for k, occ in enumerate(occs):
+                    row[start + k] = ord(occ) - 48
+            rows.append(row)
+
+        occupations = numpy.asarray(rows, dtype=numpy.int64).reshape(len(rows), j)
+        if numpy.any(occupations > max_occ):
+            raise Exception("occupation numbers above {} ({} qubits per mode) in {}".format(max_occ, paths.qpm,
+                                                                                           string))
+        return cls.from_arrays(paths=paths, occupations=occupations, amplitudes=numpy.asarray(coefficients,
+                                                                                            dtype=complex))
+
     @classmethod
     def string_to_basis_state(cls, string: str) -> Dict[str, Dict[int, int]]:
         """
@@ -189,31 +331,22 @@ class PhotonicStateVector:
         :return: Dictionary in the form {path: {mode:occ}}
         """
         basis_state = dict()
-        tmp = string.split("|")
-        for i in range(1, len(tmp)):
-            bs = tmp[i].rstrip().lstrip()
-            path = bs[-1]
-            occs = bs.split(">")[0]
-            M = len(occs)
-            S = (M - 1) // 2
-            modes = dict()
-            for j, m in enumerate(range(-S, S + 1)):
-                modes[m] = int(occs[j])
-            basis_state[path] = modes
+        for match in _KET.finditer(string):
+            occs, path = match.group(1), match.group(2)
+            S = (len(occs) - 1) // 2
+            basis_state[path] = {m: int(occ) for m, occ in zip(range(-S, S + 1), occs)}
         return basis_state
 
     def add_basis_state(self, state: Dict[str, Dict[int, int]], coeff=1):
         if isinstance(state, str):
             state = self.string_to_basis_state(string=state)
 
-        qubit_string = BitString.from_int(integer=0, nbits=self.n_qubits)
-        for p, v in state.items():
-            for m, occ in v.items():
-                mode = self.get_mode(p, m)
-                occ = BitString.from_int(integer=occ, nbits=mode.n_qubits)
-                for i, q in enumerate(mode.qubits):
-                    qubit_string[q] = occ[i]
-        self._state += QubitWaveFunction.from_int(i=qubit_string, coeff=coeff)
+        qubit_string = self.get_qubit_key(state)
+        self._state = self._wavefunction()
+        if qubit_string in self._state.keys():
+            coeff += self._state[qubit_string]
+        self._state[qubit_string] = coeff
+        self._clear_arrays()
 
     def get_qubit_key(self, state):
         qubit_string = BitString.from_int(integer=0, nbits=self.n_qubits)
@@ -232,8 +365,9 @@ class PhotonicStateVector:
         """
         basis_state = self.string_to_basis_state(string=string)
         key = self.get_qubit_key(basis_state)
-        if key in self._state.keys():
-            return self._state[key]
+        state = self._wavefunction()
+        if key in state.keys():
+            return state[key]
         else:
             return 0
 
@@ -261,13 +395,88 @@ class PhotonicStateVector:
         return result
 
     @property
-    def state(self):
+    def state(self) -> QubitWaveFunction:
+        self._state = self._wavefunction()
+        # the wavefunction can be modified from outside, so the arrays are rebuilt when needed
+        self._clear_arrays()
         return self._state
 
     @property
     def paths(self):
         return self._paths
 
+    @property
+    def modes(self) -> List[Tuple[str, int]]:
+        """
+        :return: (path, mode) for all modes, this is the order of the columns in self.occupations
+        """
+        return [(pname, mname) for pname, p in self._paths.items() for mname in p.keys()]
+
+    @property
+    def occupations(self) -> numpy.ndarray:
+        """
+        :return: (n_states x n_modes) array of occupation numbers, don't modify it
+        """
+        if self._occupations is None:
+            self._occupations, self._amplitudes = self._decode()
+        return self._occupations
+
+    @property
+    def amplitudes(self) -> numpy.ndarray:
+        """
+        :return: amplitudes (or counts) belonging to the rows of self.occupations, don't modify it
+        """
+        if self._amplitudes is None:
+            self._occupations, self._amplitudes = self._decode()
+        return self._amplitudes
+
+    def __len__(self):
+        if self._state is None:
+            return len(self._amplitudes)
+        return len(self._state)
+
+    def _clear_arrays(self):
+        self._occupations = None
+        self._amplitudes = None
+
+    def _decode(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        keys = [key.integer for key in self._state.keys()]
+        occupations = self._paths.decode_keys(keys).reshape(len(keys), -1)
+        amplitudes = numpy.asarray(list(self._state.values()))
+        return occupations, amplitudes
+
+    def _wavefunction(self) -> QubitWaveFunction:
+        if self._state is not None:
+            return self._state
+        nqubits = self.n_qubits
+        keys = self._paths.encode_occupations(self._occupations).tolist()
+        state = {BitString.from_int(integer=k, nbits=nqubits): v for k, v in zip(keys, self._amplitudes.tolist())}
+        return QubitWaveFunction(state=state)
+
+    def occupation_string(self, occupations) -> str:
+        """
+        :param occupations: row of self.occupations
+        :return: the basis state in the photonic notation |x>_a|y>_b ...
+        """
+        result = ""
+        j = 0
+        for pname, p in self._paths.items():
+            result += "|" + "".join(str(n) for n in occupations[j:j + len(p)]) + ">_" + str(pname)
+            j += len(p)
+        return result
+
+    def filter(self, mask) -> 'PhotonicStateVector':
+        """
+        :param mask: boolean array over the basis states (rows of self.occupations)
+                     or a function which computes it from the occupations array
+        :return: new state vector with the basis states where the mask is True
+        """
+        if callable(mask):
+            mask = mask(self.occupations)
+        mask = numpy.asarray(mask, dtype=bool)
+        return PhotonicStateVector.from_arrays(paths=self._paths, occupations=self.occupations[mask],
+                                               amplitudes=self.amplitudes[mask])
+
     def get_mode(self, path, mode):
         """
         :param path: Name of the path
@@ -285,39 +494,49 @@ class PhotonicStateVector:
         self._state = state
         if state is None:
             self._state = QubitWaveFunction()
+        self._occupations = None
+        self._amplitudes = None
 
     def normalize(self):
-        self._state = self._state.normalize()
+        amplitudes = self.amplitudes
+        norm = numpy.sqrt(numpy.sum(numpy.abs(amplitudes) ** 2))
+        self._amplitudes = amplitudes / norm
+        self._state = None
         return self
 
     def __repr__(self):
         threshold = 1.e-3
         result = ""
-        nqubits = self.n_qubits
-        for i, s in self._state.items():
-            i.bits = nqubits
-            if isclose(s, 0.0, atol=threshold):
-                continue
+        amplitudes = self.amplitudes
+        keep = numpy.logical_not(isclose(amplitudes, 0.0, atol=threshold))
+        for occ, s in zip(self.occupations[keep].tolist(), amplitudes[keep].tolist()):
             result += number_to_string(number=s)
-            result += self.interpret_bitstring(i=i)
+            result += self.occupation_string(occupations=occ)
         return result
 
     def interpret_bitstring(self, i: BitString) -> str:
         return self._paths.interpret_bitstring(i=i)
 
     def __eq__(self, other):
-        return self._paths == other._paths and self._state == other._state
+        return self._paths == other._paths and self._wavefunction() == other._wavefunction()
 
     def __rmul__(self, other):
+        if self._state is None:
+            return PhotonicStateVector.from_arrays(paths=self._paths, occupations=self._occupations,
+                                                   amplitudes=other * self._amplitudes)
         return PhotonicStateVector(paths=self._paths, state=other * deepcopy(self._state))
 
     def __iadd__(self, other):
         assert (self.paths == other.paths)
-        self._state += other.state
+        self._state = self._wavefunction()
+        self._state += other._wavefunction()
+        self._clear_arrays()
         return self
 
     def inner(self, other):
-        return self._state.inner(other._state)
+        common, i, j = numpy.intersect1d(row_keys(self.occupations), row_keys(other.occupations),
+                                         return_indices=True)
+        return numpy.sum(self.amplitudes[i].conjugate() * other.amplitudes[j])
 
     def plot(self, title: str = None, label: str = None, filename: str = None):
         from matplotlib import pyplot as plt
@@ -326,11 +545,8 @@ class PhotonicStateVector:
             plt.title(title)
         plt.ylabel("counts")
         plt.xlabel("state")
-        values = []
-        names = []
-        for k, v in self._state.items():
-            values.append(v)
-            names.append(self.interpret_bitstring(i=k))
+        values = self.amplitudes.tolist()
+        names = [self.occupation_string(occupations=occ) for occ in self.occupations.tolist()]
         plt.bar(names, values, label=label)
         if label is not None:
             plt.legend()
@@ -348,5 +564,23 @@ class PhotonicStateVector:
             plt.show()
 
 
+def success_rate(state: PhotonicStateVector, mask: numpy.ndarray, counts: bool = None) -> float:
+    """
+    :param state: counts or amplitudes
+    :param mask: boolean array over the basis states of the state which are accepted
+                 or the probability that each basis state is accepted
+    :param counts: the state holds counts (otherwise amplitudes), if None: counts if the values are integers
+    :return: the fraction of counts (or probability) in the accepted basis states
+    """
+    values = state.amplitudes
+    if counts is None:
+        counts = numpy.issubdtype(values.dtype, numpy.integer)
+    weights = numpy.abs(values) if counts else numpy.abs(values) ** 2
+    total = numpy.sum(weights)
+    if total == 0.0:
+        return 0.0
+    return float(numpy.sum(weights * mask) / total)
+
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,330 @@
+"""
+Photon loss and detector inefficiency
+Losses inside the setup are simulated with Monte Carlo wavefunction trajectories in the Fock space
+(each trajectory is a pure state, no density matrix is built)
+Losses in front of the detectors act on the photon-number distribution directly and are exact
+"""
+import typing
+import numpy
+from scipy.special import comb
+from dataclasses import dataclass, field
+
+from photonic.mode import PhotonicPaths, PhotonicStateVector, success_rate
+from photonic.fock import FockSpace
+
+
+@dataclass
+class LossModel:
+    """
+    Transmissions (1.0: no loss) of the setup
+    elements: {element index, element name or element kind: transmission}
+              the modes the element acts on lose photons after the element (see element_modes)
+              the index (position in PhotonicSetup._abstract_setup) is looked up first, then the name and the kind
+    paths: {path: transmission} of every mode of the path between the setup and the detectors
+    detector_efficiency: efficiency of the detectors, same for all paths
+    """
+    elements: typing.Dict[typing.Any, float] = field(default_factory=dict)
+    paths: typing.Dict[str, float] = field(default_factory=dict)
+    detector_efficiency: float = 1.0
+
+    def element_transmission(self, index: int, element) -> float:
+        for key in [index, element.name, element.kind]:
+            if key in self.elements:
+                return self.elements[key]
+        return 1.0
+
+    def detection_efficiencies(self, paths: PhotonicPaths) -> numpy.ndarray:
+        """
+        :return: efficiency of each mode (order of PhotonicStateVector.modes) including the path transmissions
+        """
+        return numpy.asarray([self.paths.get(pname, 1.0) * self.detector_efficiency
+                              for pname, p in paths.items() for _ in p.keys()])
+
+
+def element_modes(element, paths: PhotonicPaths) -> typing.List[typing.Tuple[str, int]]:
+    """
+    :return: the modes an element acts on, (path, mode) for single-mode elements (phase shifters on one mode)
+             and all modes of the paths of the element otherwise
+    """
+    if element.parameters.get("mode", None) is not None:
+        return [(element.paths[0], element.parameters["mode"])]
+    return [(pname, mname) for pname in element.paths for mname in paths[pname].keys()]
+
+
+def loss_weights(occupations: numpy.ndarray, lost: int, transmission: float) -> numpy.ndarray:
+    """
+    :return: probability that lost of the photons in a mode with the given occupations are lost
+    """
+    occupations = numpy.asarray(occupations, dtype=float)
+    return comb(occupations, lost) * (1.0 - transmission) ** lost * transmission ** (occupations - lost)
+
+
+def _lower(space: FockSpace, mode: int, lost: int) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    # basis states which have at least lost photons in the mode and the indices of the states without them
+    states = numpy.flatnonzero(space._occupations[:, mode] >= lost)
+    out = space._occupations[states].copy()
+    out[:, mode] -= lost
+    return states, space.index(out)
+
+
+def lose_photons(space: FockSpace, vector: numpy.ndarray, modes: typing.List[int], transmission: float,
+                 random: numpy.random.Generator) -> numpy.ndarray:
+    """
+    One quantum jump per mode: the number of lost photons k is drawn and the Kraus operator
+    sqrt((1-eta)^k/k!) eta^(n/2) a^k is applied
+    :param space: Fock space which contains all photon numbers up to the one of the vector
+    :param vector: normalized state in the space
+    :param modes: indices of the modes which lose photons
+    :param transmission: transmission eta of the modes
+    :param random: random number generator
+    :return: the normalized state after the jumps
+    """
+    for mode in modes:
+        occupations = space._occupations[:, mode]
+        probabilities = numpy.asarray([numpy.sum(numpy.abs(vector) ** 2 * loss_weights(occupations, k, transmission))
+                                       for k in range(space.max_occ + 1)])
+        lost = random.choice(len(probabilities), p=probabilities / numpy.sum(probabilities))
+        states, indices = _lower(space=space, mode=mode, lost=lost)
+        result = numpy.zeros_like(vector)
+        result[indices] = vector[states] * numpy.sqrt(loss_weights(occupations[states], lost, transmission))
+        vector = result / numpy.sqrt(probabilities[lost])
+    return vector
+
+
+def detect(space: FockSpace, probabilities: numpy.ndarray, efficiencies: numpy.ndarray) -> numpy.ndarray:
+    """
+    Losses in front of the detectors on the photon-number distribution (exact)
+    :param efficiencies: efficiency of each mode
+    :return: the distribution of the detected photon numbers
+    """
+    for mode, efficiency in enumerate(efficiencies):
+        if efficiency == 1.0:
+            continue
+        result = numpy.zeros_like(probabilities)
+        occupations = space._occupations[:, mode]
+        for lost in range(space.max_occ + 1):
+            states, indices = _lower(space=space, mode=mode, lost=lost)
+            numpy.add.at(result, indices, probabilities[states] * loss_weights(occupations[states], lost, efficiency))
+        probabilities = result
+    return probabilities
+
+
+class TrajectoryResult:
+    """
+    Running average of the detected photon-number distributions of the trajectories
+    Results of different runs (e.g. worker processes) are added with update
+    """
+
+    def __init__(self, paths: PhotonicPaths):
+        self.paths = paths
+        self.trajectories = 0
+        n_modes = sum(len(p) for p in paths.values())
+        self._sums = PhotonicStateVector.from_arrays(paths=paths, occupations=numpy.zeros((0, n_modes)),
+                                                     amplitudes=numpy.zeros(0))
+        self._squares = PhotonicStateVector.from_arrays(paths=paths, occupations=numpy.zeros((0, n_modes)),
+                                                        amplitudes=numpy.zeros(0))
+
+    @classmethod
+    def from_sums(cls, paths: PhotonicPaths, occupations: numpy.ndarray, sums: numpy.ndarray, squares: numpy.ndarray,
+                  trajectories: int) -> 'TrajectoryResult':
+        """
+        :param occupations: (n x modes) array of the basis states
+        :param sums: sum of the detection probabilities of the basis states over the trajectories
+        :param squares: sum of the squared probabilities
+        :param trajectories: number of trajectories
+        """
+        result = cls(paths=paths)
+        result.trajectories = trajectories
+        result._sums = PhotonicStateVector.from_arrays(paths=paths, occupations=occupations, amplitudes=sums)
+        result._squares = PhotonicStateVector.from_arrays(paths=paths, occupations=occupations, amplitudes=squares)
+        return result
+
+    def update(self, other: 'TrajectoryResult') -> 'TrajectoryResult':
+        """
+        Add the trajectories of another result
+        :return: self
+        """
+        self.trajectories += other.trajectories
+        self._sums = _merge(self._sums, other._sums)
+        self._squares = _merge(self._squares, other._squares)
+        return self
+
+    def probabilities(self) -> PhotonicStateVector:
+        """
+        :return: estimated detection probabilities (in place of the amplitudes)
+        """
+        return PhotonicStateVector.from_arrays(paths=self.paths, occupations=self._sums.occupations,
+                                               amplitudes=self._sums.amplitudes / max(self.trajectories, 1))
+
+    def standard_errors(self) -> numpy.ndarray:
+        """
+        :return: standard errors of the estimated probabilities (in the order of self.probabilities())
+        """
+        n = max(self.trajectories, 1)
+        mean = self._sums.amplitudes / n
+        variance = numpy.maximum(self._squares.amplitudes / n - mean ** 2, 0.0)
+        return numpy.sqrt(variance / max(n - 1, 1))
+
+    def count_rates(self, rate: float) -> PhotonicStateVector:
+        """
+        :param rate: rate of the source (e.g. events per second)
+        :return: expected count rates of the basis states
+        """
+        probabilities = self.probabilities()
+        return PhotonicStateVector.from_arrays(paths=self.paths, occupations=probabilities.occupations,
+                                               amplitudes=rate * probabilities.amplitudes)
+
+    def __repr__(self):
+        return "TrajectoryResult with {} trajectories:\n{}".format(self.trajectories, self.probabilities())
+
+
+def _merge(a: PhotonicStateVector, b: PhotonicStateVector) -> PhotonicStateVector:
+    if len(a) == 0:
+        return b
+    return PhotonicStateVector.from_arrays(paths=a.paths, occupations=numpy.concatenate([a.occupations, b.occupations]),
+                                           amplitudes=numpy.concatenate([a.amplitudes, b.amplitudes]))
+
+
+def simulate_trajectories(elements: list, paths: PhotonicPaths, initial_state: PhotonicStateVector,
+                          model: LossModel, trajectories: int = 100, variables: dict = None,
+                          seed=None) -> TrajectoryResult:
+    """
+    Monte Carlo wavefunction trajectories of a linear-optical setup with photon loss
+    :param elements: AbstractElements of the setup
+    :param paths: paths of the setup
+    :param initial_state: initial state
+    :param model: the LossModel
+    :param trajectories: number of trajectories
+    :param variables: values for the variables of parametrized elements
+    :param seed: seed (or numpy SeedSequence) of the random numbers
+    :return: the averaged detection probabilities
+    """
+    random = numpy.random.default_rng(seed)
+    photons = int(numpy.max(numpy.sum(initial_state.occupations, axis=1)))
+    # lost photons lead to the smaller photon numbers
+    space = FockSpace(paths=paths, photons=list(range(photons + 1)))
+    initial = space.vector(initial_state)
+    initial = initial / numpy.linalg.norm(initial)
+    efficiencies = model.detection_efficiencies(paths)
+
+    losses = []
+    for index, element in enumerate(elements):
+        transmission = model.element_transmission(index=index, element=element)
+        modes = [space.indices[key] for key in element_modes(element=element, paths=paths)]
+        losses.append((transmission, modes))
+
+    sums = numpy.zeros(len(space))
+    squares = numpy.zeros(len(space))
+    for _ in range(trajectories):
+        vector = initial
+        for element, (transmission, modes) in zip(elements, losses):
+            vector = space.element_matrix(element=element, variables=variables) @ vector
+            if transmission < 1.0:
+                vector = lose_photons(space=space, vector=vector, modes=modes, transmission=transmission,
+                                      random=random)
+        probabilities = detect(space=space, probabilities=numpy.abs(vector) ** 2, efficiencies=efficiencies)
+        sums += probabilities
+        squares += probabilities ** 2
+    keep = sums > 0.0
+    return TrajectoryResult.from_sums(paths=paths, occupations=space._occupations[keep], sums=sums[keep],
+                                      squares=squares[keep], trajectories=trajectories)
+
+
+class ThresholdDetectors:
+    """
+    Click detectors (one per mode) which only tell if at least one photon arrived
+    With efficiency, dark counts and crosstalk to the neighbouring modes of the same path
+    The click patterns are given as occupations with 0 (no click) and 1 (click),
+    so they can be post-selected with PhotonicHeralder like photon numbers
+    """
+
+    def __init__(self, paths: PhotonicPaths, efficiency: typing.Union[float, typing.Dict[str, float]] = 1.0,
+                 dark_counts: typing.Union[float, typing.Dict[str, float]] = 0.0,
+                 crosstalk: typing.Union[float, typing.Dict[str, float]] = 0.0):
+        """
+        :param paths: the photonic paths
+        :param efficiency: probability that a photon is detected, for all paths or as {path: efficiency}
+        :param dark_counts: probability of a click without photon, for all paths or as {path: probability}
+        :param crosstalk: probability that a click also makes the neighbouring detectors (modes k-1 and k+1) click,
+                          for all paths or as {path: probability}
+        """
+        self.paths = paths
+
+        def per_mode(value, default):
+            if not isinstance(value, dict):
+                value = {pname: value for pname in paths.keys()}
+            return numpy.asarray([value.get(pname, default) for pname, p in paths.items() for _ in p.keys()],
+                                 dtype=float)
+
+        self.efficiency = per_mode(efficiency, 1.0)
+        self.dark_counts = per_mode(dark_counts, 0.0)
+        self.crosstalk = per_mode(crosstalk, 0.0)
+        # pairs of neighbouring modes (same path)
+        self._neighbours = []
+        j = 0
+        for p in paths.values():
+            for k in range(len(p) - 1):
+                self._neighbours += [(j + k, j + k + 1), (j + k + 1, j + k)]
+            j += len(p)
+
+    def click_probabilities(self, occupations: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param occupations: (n x modes) array of photon numbers
+        :return: (n x modes) array with the probabilities of the detectors to click (without crosstalk)
+        """
+        occupations = numpy.asarray(occupations, dtype=float)
+        return 1.0 - (1.0 - self.efficiency) ** occupations * (1.0 - self.dark_counts)
+
+    def clicks(self, counts: PhotonicStateVector, seed=None) -> PhotonicStateVector:
+        """
+        Draw the click pattern of every sample
+        :param counts: photon-number resolved counts (e.g. from PhotonicSetup.sample)
+        :param seed: seed of the random numbers
+        :return: counts of the click patterns
+        """
+        values = counts.amplitudes
+        if not numpy.issubdtype(values.dtype, numpy.integer):
+            if not numpy.allclose(values, numpy.round(numpy.real(values))):
+                raise Exception("clicks needs counts, use herald_probability for probabilities or amplitudes")
+            values = numpy.round(numpy.real(values)).astype(numpy.int64)
+        random = numpy.random.default_rng(seed)
+        occupations = numpy.repeat(counts.occupations, values, axis=0)
+        primary = random.random(occupations.shape) < self.click_probabilities(occupations)
+        result = primary.copy()
+        for i, j in self._neighbours:
+            if self.crosstalk[j] > 0.0:
+                result[:, i] |= primary[:, j] & (random.random(len(primary)) < self.crosstalk[j])
+        return PhotonicStateVector.from_arrays(paths=counts.paths, occupations=result,
+                                               amplitudes=numpy.ones(len(result), dtype=numpy.int64))
+
+    def herald_probability(self, state: typing.Union[PhotonicStateVector, typing.List[PhotonicStateVector]],
+                           heralder, counts: bool = None) -> typing.Union[float, numpy.ndarray]:
+        """
+        Exact probability that the click pattern is accepted by the heralder (clicks are counted like photons)
+        Only possible without crosstalk (the clicks of different detectors are independent then)
+        :param state: counts, amplitudes or a list of them (e.g. the states of a parameter sweep)
+        :param heralder: PhotonicHeralder
+        :param counts: see success_rate
+        :return: the heralding probability (array of them for a list of states)
+        """
+        if numpy.any(self.crosstalk > 0.0):
+            raise Exception("herald_probability is not possible with crosstalk, use clicks on samples")
+        if isinstance(state, (list, tuple)):
+            return numpy.asarray([self.herald_probability(state=s, heralder=heralder, counts=counts) for s in state])
+
+        clicks = self.click_probabilities(state.occupations).reshape((len(state),) + heralder.mask.shape)
+
+        accepted = numpy.ones(len(state))
+        for k in range(heralder.mask.shape[0]):
+            # distribution of the number of clicks in the path (Poisson binomial)
+            modes = numpy.flatnonzero(heralder.mask[k])
+            distribution = numpy.zeros(shape=(len(state), len(modes) + 1))
+            distribution[:, 0] = 1.0
+            for m in modes:
+                q = clicks[:, k, m][:, None]
+                distribution[:, 1:] = distribution[:, 1:] * (1.0 - q) + distribution[:, :-1] * q
+                distribution[:, 0] *= 1.0 - q[:, 0]
+            lower = min(heralder.lower[k], len(modes) + 1)
+            upper = min(heralder.upper[k], len(modes))
+            accepted *= numpy.sum(distribution[:, lower:upper + 1], axis=1)
+        return success_rate(state=state, mask=accepted, counts=counts)
@@ -0,0 +1,151 @@
+"""
+Run sweeps and multi-start optimizations of a PhotonicSetup on a pool of worker processes
+The workers receive the abstract setup description and rebuild (and compile) the setup once
+Results are given back as soon as the workers finish them
+"""
+import typing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+import tequila as tq
+
+from photonic.elements import PhotonicSetup
+from photonic.mode import PhotonicStateVector
+from photonic.compiled import variable_batches
+from photonic.noise import LossModel, TrajectoryResult
+from photonic.serialization import setup_description, build_setup
+from photonic.disk_cache import DiskCache
+
+
+# state of the worker processes
+_worker = dict()
+
+
+def _initialize_worker(description, initial_state, simulator, observables, engine, cache):
+    if cache is None:
+        setup = build_setup(description)
+    else:
+        setup = DiskCache(directory=cache).build_setup(description)
+    _worker["setup"] = setup
+    _worker["compiled"] = setup.compile(initial_state=initial_state, simulator=simulator, observables=observables,
+                                        engine=engine)
+
+
+def _simulate(points):
+    return _worker["compiled"].simulate(variables=points)
+
+
+def _expectation_values(points):
+    return list(_worker["compiled"].expectation_values(variables=points))
+
+
+def _minimize(objective, initial_values, kwargs):
+    result = tq.minimize(objective=objective(_worker["setup"]), initial_values=initial_values, **kwargs)
+    return {"energy": result.energy, "variables": dict(result.angles)}
+
+
+def _trajectories(model, trajectories, variables, seed):
+    return _worker["setup"].simulate_losses(initial_state=_worker["compiled"].initial_state, model=model,
+                                            trajectories=trajectories, variables=variables, seed=seed)
+
+
+class ParallelSetup:
+    """
+    Pool of worker processes which hold the rebuilt and compiled setup
+    Use as context manager or call shutdown when done
+    """
+
+    def __init__(self, setup: PhotonicSetup, initial_state: [str, PhotonicStateVector] = None, simulator=None,
+                 observables: typing.List[tq.hamiltonian.QubitHamiltonian] = None, engine: str = "qubit",
+                 max_workers: int = None, cache: str = None):
+        """
+        :param setup: the PhotonicSetup
+        :param initial_state: see PhotonicSetup.compile
+        :param simulator: see PhotonicSetup.compile
+        :param observables: see PhotonicSetup.compile
+        :param engine: see PhotonicSetup.compile
+        :param max_workers: number of processes, all cores if None
+        :param cache: directory of a DiskCache, the workers take the operators of the setup from there
+        """
+        self._initial_state = initial_state
+        self._executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_initialize_worker,
+                                             initargs=(setup_description(setup), initial_state, simulator,
+                                                       observables, engine, cache))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def _stream(self, function, tasks: list, chunksize: int = 1):
+        futures = dict()
+        for start in range(0, len(tasks), chunksize):
+            futures[self._executor.submit(function, tasks[start:start + chunksize])] = start
+        for future in as_completed(futures):
+            for k, result in enumerate(future.result()):
+                yield futures[future] + k, result
+
+    def simulate(self, variables: typing.Union[dict, typing.List[dict]] = None,
+                 chunksize: int = 1) -> typing.Iterator[typing.Tuple[int, PhotonicStateVector]]:
+        """
+        :param variables: batch of variables (see compiled.variable_batches)
+        :param chunksize: number of points which are send to a worker at once
+        :return: iterator over (index of the point in the batch, final state) in the order the workers finish
+        """
+        return self._stream(function=_simulate, tasks=variable_batches(variables), chunksize=chunksize)
+
+    def expectation_values(self, variables: typing.Union[dict, typing.List[dict]] = None,
+                           chunksize: int = 1) -> typing.Iterator[typing.Tuple[int, typing.List[float]]]:
+        """
+        Same as simulate but for the expectation values of the observables
+        """
+        return self._stream(function=_expectation_values, tasks=variable_batches(variables), chunksize=chunksize)
+
+    def minimize(self, objective: typing.Callable, initial_values: typing.List[dict],
+                 **kwargs) -> typing.Iterator[typing.Tuple[int, dict]]:
+        """
+        One tq.minimize run for each set of initial values
+        :param objective: function which builds the tequila objective from the (rebuilt) PhotonicSetup
+                          needs to be picklable (e.g. defined on module level)
+        :param initial_values: list of initial values
+        :param kwargs: passed to tq.minimize
+        :return: iterator over (index of the initial values, {'energy': ..., 'variables': ...})
+        """
+        futures = dict()
+        for k, values in enumerate(initial_values):
+            futures[self._executor.submit(_minimize, objective, values, kwargs)] = k
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def trajectories(self, model: LossModel, trajectories: int, batch: int = 100, variables: dict = None,
+                     seed=None) -> typing.Iterator[TrajectoryResult]:
+        """
+        Photon-loss trajectories (see PhotonicSetup.simulate_losses) in batches on the workers
+        the initial state is the one the pool was created with
+        :param model: the LossModel
+        :param trajectories: total number of trajectories
+        :param batch: trajectories per task
+        :param variables: values for the variables of parametrized elements
+        :param seed: seed of the random numbers, every batch gets its own independent stream
+        :return: iterator over the running result (the same object, updated whenever a batch is finished)
+        """
+        if self._initial_state is None:
+            raise Exception("trajectories need the initial state, create the ParallelSetup with initial_state=...")
+        return self._trajectories(model=model, trajectories=trajectories, batch=batch, variables=variables, seed=seed)
+
+    def _trajectories(self, model: LossModel, trajectories: int, batch: int, variables: dict,
+                      seed) -> typing.Iterator[TrajectoryResult]:
+        sizes = [min(batch, trajectories - start) for start in range(0, trajectories, batch)]
+        seeds = numpy.random.SeedSequence(seed).spawn(len(sizes))
+        futures = [self._executor.submit(_trajectories, model, size, variables, s) for size, s in zip(sizes, seeds)]
+        result = None
+        for future in as_completed(futures):
+            if result is None:
+                result = future.result()
+            else:
+                result.update(future.result())
+            yield result
@@ -0,0 +1,149 @@
+"""
+Draw samples in chunks and keep running photonic count histograms
+The memory is bounded by the number of different outcomes and not by the number of samples
+"""
+import typing
+import numpy
+
+from photonic.mode import PhotonicStateVector
+from photonic import linear_optics
+
+
+def wilson_interval(successes, trials, z: float = 1.96) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Wilson score interval of a binomial probability
+    :param successes: number(s) of successes
+    :param trials: number of trials
+    :param z: quantile of the normal distribution (1.96 for 95% confidence)
+    :return: lower and upper bounds
+    """
+    successes = numpy.asarray(successes, dtype=float)
+    if trials == 0:
+        return numpy.zeros_like(successes), numpy.ones_like(successes)
+    p = successes / trials
+    denominator = 1.0 + z ** 2 / trials
+    center = (p + z ** 2 / (2 * trials)) / denominator
+    width = z * numpy.sqrt(p * (1.0 - p) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+    return center - width, center + width
+
+
+class SampleStatistics:
+    """
+    Running statistics of sampled photonic counts
+    Updated chunk by chunk, see PhotonicSetup.sample_stream
+    """
+
+    def __init__(self, paths, heralder=None, z: float = 1.96):
+        """
+        :param paths: the photonic paths of the counts
+        :param heralder: PhotonicHeralder, only the accepted samples are part of the histogram
+        :param z: quantile of the normal distribution for the confidence intervals
+        """
+        self.paths = paths
+        self.heralder = heralder
+        self.z = z
+        self.samples = 0
+        self.accepted = 0
+        self.chunks = 0
+        n_modes = sum(len(p) for p in paths.values())
+        self._counts = PhotonicStateVector.from_arrays(paths=paths, occupations=numpy.zeros((0, n_modes)),
+                                                       amplitudes=numpy.zeros(0, dtype=numpy.int64))
+
+    @property
+    def counts(self) -> PhotonicStateVector:
+        """
+        :return: histogram of the (accepted) samples, same format as PhotonicSetup.sample
+        """
+        return self._counts
+
+    @property
+    def heralding_rate(self) -> float:
+        if self.samples == 0:
+            return 0.0
+        return self.accepted / self.samples
+
+    def heralding_interval(self) -> typing.Tuple[float, float]:
+        """
+        :return: confidence interval of the heralding rate
+        """
+        lower, upper = wilson_interval(self.accepted, self.samples, z=self.z)
+        return float(lower), float(upper)
+
+    def probabilities(self) -> numpy.ndarray:
+        """
+        :return: estimated probabilities of the outcomes in self.counts (conditioned on heralding)
+        """
+        if self.accepted == 0:
+            return numpy.zeros(len(self._counts))
+        return self._counts.amplitudes / self.accepted
+
+    def confidence_intervals(self) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        :return: lower and upper bounds of the probabilities of the outcomes in self.counts
+        """
+        return wilson_interval(self._counts.amplitudes, self.accepted, z=self.z)
+
+    def precision(self) -> float:
+        """
+        :return: largest half width of the confidence intervals of the joint probabilities (outcome seen and accepted)
+                 and of the heralding rate, outcomes which were not seen yet are bounded by the interval of zero counts
+        """
+        lower, upper = wilson_interval(numpy.append(self._counts.amplitudes, 0), self.samples, z=self.z)
+        result = float(numpy.max(upper - lower)) / 2
+        if self.heralder is not None:
+            lower, upper = self.heralding_interval()
+            result = max(result, (upper - lower) / 2)
+        return result
+
+    def update(self, chunk: PhotonicStateVector):
+        """
+        Add a chunk of counts
+        :param chunk: counts on the same paths
+        :return: self
+        """
+        self.chunks += 1
+        self.samples += int(numpy.sum(chunk.amplitudes))
+        if self.heralder is not None:
+            chunk = chunk.filter(self.heralder.valid(chunk.occupations))
+        self.accepted += int(numpy.sum(chunk.amplitudes))
+        if len(self._counts) == 0:
+            occupations, amplitudes = chunk.occupations, chunk.amplitudes
+        else:
+            occupations = numpy.concatenate([self._counts.occupations, chunk.occupations])
+            amplitudes = numpy.concatenate([self._counts.amplitudes, chunk.amplitudes])
+        self._counts = PhotonicStateVector.from_arrays(paths=self.paths, occupations=occupations,
+                                                       amplitudes=amplitudes)
+        return self
+
+    def __repr__(self):
+        result = "SampleStatistics: {} samples in {} chunks".format(self.samples, self.chunks)
+        if self.heralder is not None:
+            lower, upper = self.heralding_interval()
+            result += ", heralding rate {:.4f} [{:.4f}, {:.4f}]".format(self.heralding_rate, lower, upper)
+        return result + ", precision {:.4f}".format(self.precision())
+
+
+def sample_stream(state: PhotonicStateVector, chunk: int = 1000, max_samples: int = None, precision: float = None,
+                  heralder=None, z: float = 1.96,
+                  seed: typing.Union[int, numpy.random.Generator] = None) -> typing.Iterator[SampleStatistics]:
+    """
+    Draw samples from the photon-number distribution of a wavefunction in chunks
+    :param state: the wavefunction
+    :param chunk: samples per chunk
+    :param max_samples: stop after this many samples, no limit if None (then precision is needed)
+    :param precision: stop when SampleStatistics.precision is below this value
+    :param heralder: see SampleStatistics
+    :param z: see SampleStatistics
+    :param seed: seed or numpy random generator, the chunks are drawn from the same generator
+    :return: iterator over the running statistics (the same object, updated after each chunk)
+    """
+    if max_samples is None and precision is None:
+        raise Exception("sample_stream needs max_samples or precision, otherwise it does not stop")
+    statistics = SampleStatistics(paths=state.paths, heralder=heralder, z=z)
+    generator = numpy.random.default_rng(seed)
+    while max_samples is None or statistics.samples < max_samples:
+        n = chunk if max_samples is None else min(chunk, max_samples - statistics.samples)
+        statistics.update(linear_optics.sample_state(state=state, samples=n, seed=generator))
+        yield statistics
+        if precision is not None and statistics.precision() <= precision:
+            break
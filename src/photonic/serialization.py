@@ -0,0 +1,258 @@
+"""
+Versioned JSON format for PhotonicSetups and PhotonicStateVectors
+A setup is stored as its paths and the recorded elements (see PhotonicSetup._abstract_setup),
+optionally together with the ladder operators the elements need, so loading only replays the elements
+and does not compute the qubit representation of the operators again
+"""
+import json
+import numbers
+import typing
+import numpy
+
+import tequila as tq
+
+from photonic import elements
+from photonic.elements import PhotonicSetup
+from photonic.mode import PhotonicPaths, PhotonicStateVector
+
+FORMAT = "photonic"
+VERSION = 1
+
+
+def setup_description(setup: PhotonicSetup) -> dict:
+    """
+    :return: the abstract description of the setup (paths and the recorded elements with their arguments)
+             raises if the setup contains circuits which were not added with the methods of PhotonicSetup
+             (e.g. setup=... in the constructor or +=), they could not be replayed
+    """
+    if not setup._replayable:
+        raise Exception("setup contains circuits which were not added with the methods of PhotonicSetup")
+    qubits = setup.paths.qubits
+    return {"pathnames": list(setup.paths.keys()), "S": setup.S, "qpm": setup.qpm,
+            "qubits": None if isinstance(qubits, range) else list(qubits),
+            "elements": [(element.kind, dict(element.parameters)) for element in setup._abstract_setup]}
+
+
+def build_setup(description: dict, cache: elements.OperatorCache = None) -> PhotonicSetup:
+    """
+    Inverse of setup_description, replays the elements on a new setup
+    :param cache: OperatorCache of the new setup (see PhotonicSetup), the global operator_cache if None
+    """
+    setup = PhotonicSetup(pathnames=description["pathnames"], S=description["S"], qpm=description["qpm"],
+                          qubits=description.get("qubits", None), cache=cache)
+    for kind, parameters in description["elements"]:
+        if kind is None or not hasattr(setup, kind):
+            raise Exception("can not rebuild element of kind {}".format(kind))
+        getattr(setup, kind)(**parameters)
+    return setup
+
+
+def _to_tuple(value):
+    # json turns tuples into lists
+    if isinstance(value, list):
+        return tuple(_to_tuple(v) for v in value)
+    return value
+
+
+def encode_value(value) -> typing.Any:
+    """
+    :param value: parameter of an element: numbers, strings, lists, tequila Variables or PhotonicStateVectors
+    :return: json compatible representation
+    """
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, numpy.generic):
+        value = value.item()
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, numbers.Complex):
+        return {"complex": [value.real, value.imag]}
+    if isinstance(value, (list, tuple, numpy.ndarray)):
+        return [encode_value(v) for v in value]
+    if isinstance(value, tq.Variable):
+        return {"variable": encode_value(value.name)}
+    if isinstance(value, PhotonicStateVector):
+        return {"state": state_to_dict(value)}
+    raise Exception("can not serialize parameter {} of type {}".format(value, type(value)))
+
+
+def decode_value(value) -> typing.Any:
+    """
+    Inverse of encode_value (tuples come back as lists)
+    """
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    if isinstance(value, dict):
+        if "complex" in value:
+            return complex(*value["complex"])
+        if "variable" in value:
+            return tq.Variable(_to_tuple(value["variable"]))
+        if "state" in value:
+            return state_from_dict(value["state"])
+        raise Exception("unknown parameter encoding: {}".format(value))
+    return value
+
+
+def encode_hamiltonian(hamiltonian: tq.hamiltonian.QubitHamiltonian) -> list:
+    """
+    :return: list of [[[qubit, pauli], ...], real, imag] for the Pauli strings of the hamiltonian
+    """
+    return [[[list(p) for p in term], coeff.real, coeff.imag]
+            for term, coeff in ((term, complex(c)) for term, c in hamiltonian.qubit_operator.terms.items())]
+
+
+def decode_hamiltonian(data: list) -> tq.hamiltonian.QubitHamiltonian:
+    result = tq.hamiltonian.QubitHamiltonian.zero()
+    result.qubit_operator.terms = {tuple((q, p) for q, p in term): complex(real, imag) for term, real, imag in data}
+    return result
+
+
+def paths_to_dict(paths: PhotonicPaths) -> dict:
+    qubits = paths.qubits
+    return {"pathnames": list(paths.keys()), "S": paths.S, "qpm": paths.qpm,
+            "qubits": None if isinstance(qubits, range) else [int(q) for q in qubits]}
+
+
+def paths_from_dict(data: dict) -> PhotonicPaths:
+    return PhotonicPaths(path_names=data["pathnames"], S=data["S"], qpm=data["qpm"], qubits=data["qubits"])
+
+
+def state_to_dict(state: PhotonicStateVector) -> dict:
+    """
+    :return: json compatible representation of the state (occupation numbers and amplitudes or counts)
+    """
+    amplitudes = state.amplitudes
+    result = {"format": FORMAT, "version": VERSION, "paths": paths_to_dict(state.paths),
+              "occupations": state.occupations.tolist()}
+    if numpy.issubdtype(amplitudes.dtype, numpy.integer):
+        result["counts"] = amplitudes.tolist()
+    else:
+        amplitudes = numpy.asarray(amplitudes, dtype=complex)
+        result["real"] = amplitudes.real.tolist()
+        result["imag"] = amplitudes.imag.tolist()
+    return result
+
+
+def state_from_dict(data: dict) -> PhotonicStateVector:
+    _check_version(data)
+    if "counts" in data:
+        amplitudes = numpy.asarray(data["counts"], dtype=numpy.int64)
+    else:
+        amplitudes = numpy.asarray(data["real"]) + 1.0j * numpy.asarray(data["imag"])
+    return PhotonicStateVector.from_arrays(paths=paths_from_dict(data["paths"]), occupations=data["occupations"],
+                                           amplitudes=amplitudes)
+
+
+class _RecordingCache:
+    """
+    OperatorCache for the replay of a setup which records all operators handed out
+    """
+
+    def __init__(self, cache: elements.OperatorCache):
+        self.cache = cache
+        self.operators = dict()
+
+    def get(self, key, builder: typing.Callable) -> tq.hamiltonian.QubitHamiltonian:
+        result = self.cache.get(key=key, builder=builder)
+        self.operators[key] = result
+        return result
+
+
+def record_operators(description: dict) -> typing.Tuple[PhotonicSetup, list]:
+    """
+    Replay a setup description and collect the operators its elements take from the global operator_cache
+    :param description: see setup_description
+    :return: the setup and the operators in the form of setup_to_dict
+    """
+    recording = _RecordingCache(elements.operator_cache)
+    setup = build_setup(description, cache=recording)
+    setup.operator_cache = elements.operator_cache
+    return setup, [[encode_value(key), encode_hamiltonian(hamiltonian)]
+                   for key, hamiltonian in recording.operators.items()]
+
+
+def description_to_dict(description: dict, operators: bool = True) -> dict:
+    """
+    :param description: see setup_description
+    :param operators: see setup_to_dict
+    :return: json compatible representation of the described setup
+    """
+    result = {"format": FORMAT, "version": VERSION,
+              "paths": {k: encode_value(description.get(k, None)) for k in ["pathnames", "S", "qpm", "qubits"]},
+              "elements": [[kind, {k: encode_value(v) for k, v in parameters.items()}]
+                           for kind, parameters in description["elements"]]}
+    if operators:
+        result["operators"] = record_operators(description)[1]
+    return result
+
+
+def setup_to_dict(setup: PhotonicSetup, operators: bool = True) -> dict:
+    """
+    :param setup: the PhotonicSetup, all elements need to be added with the methods of PhotonicSetup
+                  (circuits from add_circuit or the constructor can not be stored)
+    :param operators: store the ladder operators of the elements as well (the setup is replayed once to collect them)
+    :return: json compatible representation of the setup
+    """
+    return description_to_dict(setup_description(setup), operators=operators)
+
+
+def setup_from_dict(data: dict) -> PhotonicSetup:
+    """
+    Inverse of setup_to_dict
+    Stored operators are put into an OperatorCache which holds all of them and the elements are replayed with it,
+    otherwise the elements take their operators from the global operator_cache
+    """
+    _check_version(data)
+    description = dict(data["paths"])
+    description["elements"] = [(kind, {k: decode_value(v) for k, v in parameters.items()})
+                               for kind, parameters in data["elements"]]
+    if "operators" not in data:
+        return build_setup(description)
+    cache = elements.OperatorCache(maxsize=len(data["operators"]) + elements.operator_cache.maxsize)
+    for key, hamiltonian in data["operators"]:
+        cache.put(key=_to_tuple(key), hamiltonian=decode_hamiltonian(hamiltonian))
+    setup = build_setup(description, cache=cache)
+    setup.operator_cache = elements.operator_cache
+    return setup
+
+
+def _check_version(data: dict):
+    if data.get("format", None) != FORMAT:
+        raise Exception("not a photonic file")
+    if data["version"] > VERSION:
+        raise Exception("file version {} is newer than the supported version {}".format(data["version"], VERSION))
+
+
+def dumps(value: typing.Union[PhotonicSetup, PhotonicStateVector], operators: bool = True) -> str:
+    """
+    :param value: PhotonicSetup or PhotonicStateVector
+    :param operators: see setup_to_dict
+    :return: compact json string
+    """
+    if isinstance(value, PhotonicStateVector):
+        data = state_to_dict(value)
+    else:
+        data = setup_to_dict(value, operators=operators)
+    return json.dumps(data, separators=(",", ":"))
+
+
+def loads(string: str) -> typing.Union[PhotonicSetup, PhotonicStateVector]:
+    data = json.loads(string)
+    if "elements" in data:
+        return setup_from_dict(data)
+    return state_from_dict(data)
+
+
+def save(value: typing.Union[PhotonicSetup, PhotonicStateVector], filename: str, operators: bool = True):
+    """
+    Write a PhotonicSetup or PhotonicStateVector to a json file, see dumps
+    """
+    with open(filename, "w") as f:
+        f.write(dumps(value, operators=operators))
+
+
+def load(filename: str) -> typing.Union[PhotonicSetup, PhotonicStateVector]:
+    with open(filename, "r") as f:
+        return loads(f.read())
@@ -1,6 +1,8 @@
 from tequila import QubitWaveFunction
 from photonic import PhotonicPaths, PhotonicSetup, PhotonicStateVector
-from numpy import sqrt
+from photonic.elements import OperatorCache, creation, anihilation, ladder_product, operator_cache, _ladder_operator
+from numpy import sqrt, isclose, pi
+import numpy
 from tequila import BitString
 
 import pytest
@@ -314,6 +316,753 @@ def test_projector(qpm):
     reduced_paths = PhotonicPaths(path_names=['b'], S=S, qpm=qpm)
     assert (str(PhotonicStateVector.from_string(paths=reduced_paths, string="100|111>_b")) == str(counts))
 
+@pytest.mark.parametrize("qpm", [1, 2, 3])
+def test_operator_cache(qpm):
+    qa = [i for i in range(qpm)]
+    qb = [i + qpm for i in range(qpm)]
+    operator_cache.clear()
+
+    product = ladder_product([("creation", qa), ("anihilation", qb)])
+    expected = (_ladder_operator(name="creation", qubits=qa) * _ladder_operator(name="anihilation", qubits=qb))
+    assert product.qubit_operator.terms == expected.simplify().qubit_operator.terms
+    misses = operator_cache.misses
+
+    # second call is served from the cache and in-place changes do not leak into it
+    product += creation(qubits=qa)
+    again = ladder_product([("creation", qa), ("anihilation", qb)])
+    assert operator_cache.misses == misses
+    assert again.qubit_operator.terms == expected.simplify().qubit_operator.terms
+    assert anihilation(qubits=qb).qubit_operator.terms == _ladder_operator(name="anihilation", qubits=qb).qubit_operator.terms
+
+    # bounded size with least-recently-used eviction
+    cache = OperatorCache(maxsize=2)
+    for q in range(3):
+        cache.get(key=q, builder=lambda: creation(qubits=[q]))
+    assert len(cache) == 2
+    assert 0 not in cache and 2 in cache
+
+
+def test_fock_engine():
+    # single photons with one qubit per mode: here the Trotter decomposition of the beamsplitter is exact
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=1, qpm=1)
+    setup.add_doveprism(path='a', t=0.3)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.13)
+    setup.add_mirror(path='b')
+    setup.add_hologram(path='a')
+    setup.add_phase_shifter(path='b', t=0.7, mode=1)
+
+    for initial_state in ["1.0|100>_a|000>_b", "1.0|000>_a|001>_b"]:
+        fock = setup.simulate_wavefunction(initial_state=initial_state, engine="fock")
+        qubit = setup.simulate_wavefunction(initial_state=initial_state)
+        assert isclose(abs(fock.inner(qubit)), 1.0)
+
+    # Hong-Ou-Mandel without Trotter error
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.25)
+    wfn = setup.simulate_wavefunction(initial_state="|1>_a|1>_b", engine="fock")
+    assert isclose(wfn.get_basis_state("|1>_a|1>_b"), 0.0)
+    assert isclose(abs(wfn.get_basis_state("|2>_a|0>_b")), sqrt(0.5))
+    assert isclose(abs(wfn.get_basis_state("|0>_a|2>_b")), sqrt(0.5))
+
+    counts = setup.sample(samples=100, initial_state="|1>_a|1>_b", engine="fock")
+    assert counts.get_basis_state("|2>_a|0>_b") + counts.get_basis_state("|0>_a|2>_b") == 100
+
+    # the options for the joined generator of the old Trotterization are ignored
+    for options in [{"join_components": False}, {"randomize_component_order": True}]:
+        with pytest.warns(DeprecationWarning):
+            setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, **options)
+
+
+def test_output_amplitudes():
+    from itertools import combinations
+    from photonic.linear_optics import permanent
+    assert isclose(permanent([[1.0, 2.0], [3.0, 4.0]]), 10.0)
+
+    setup = PhotonicSetup(pathnames=['a', 'b', 'c', 'd', 'e'], S=0, qpm=2)
+    for i, (p, q) in enumerate([('a', 'b'), ('b', 'c'), ('c', 'd'), ('d', 'e'), ('a', 'b'), ('b', 'c')]):
+        setup.add_beamsplitter(path_a=p, path_b=q, t=0.1 * (i + 1), phi=0.0)
+        setup.add_phase_shifter(path=q, t=0.3 * i)
+
+    initial_state = "|1>_a|1>_c|1>_e"
+    outputs = ["".join("|1>_" + x for x in comb) for comb in combinations(['a', 'b', 'c', 'd', 'e'], 3)]
+    outputs += ["|2>_a|1>_b", "|3>_d"]
+    amplitudes = setup.output_amplitudes(initial_state=initial_state, outputs=outputs)
+
+    wfn = setup.simulate_wavefunction(initial_state=initial_state, engine="fock")
+    for output, amplitude in zip(outputs, amplitudes):
+        assert isclose(amplitude, wfn.get_basis_state(output))
+
+
+@pytest.mark.parametrize("t,phi", [(0.25, -pi / 2), (0.13, 0.7)])
+def test_exact_beamsplitter(t, phi):
+    # two photons with two qubits per mode: the Trotterized beamsplitter is not exact here
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=t, phi=phi, exact=True)
+    for initial_state in ["|1>_a|1>_b", "|2>_a|0>_b"]:
+        qubit = setup.simulate_wavefunction(initial_state=initial_state)
+        fock = setup.simulate_wavefunction(initial_state=initial_state, engine="fock")
+        # tolerance for single precision simulators
+        assert isclose(abs(fock.inner(qubit)), 1.0, atol=1.e-4)
+
+
+@pytest.mark.parametrize("qpm", [1, 2])
+def test_state_arrays(qpm):
+    paths = PhotonicPaths(path_names=['a', 'b'], S=1, qpm=qpm)
+    wfn = PhotonicStateVector.from_string(paths=paths, string="1.0|100>_a|001>_b+2.0|010>_a|010>_b+1.0j|000>_a|101>_b")
+    assert wfn.modes == [('a', -1), ('a', 0), ('a', 1), ('b', -1), ('b', 0), ('b', 1)]
+    assert wfn.occupations.tolist() == [[1, 0, 0, 0, 0, 1], [0, 1, 0, 0, 1, 0], [0, 0, 0, 1, 0, 1]]
+
+    # lazy conversion back to the qubit representation, duplicates are combined
+    occupations = numpy.concatenate([wfn.occupations, wfn.occupations[:1]])
+    amplitudes = numpy.concatenate([wfn.amplitudes, [1.0]])
+    other = PhotonicStateVector.from_arrays(paths=paths, occupations=occupations, amplitudes=amplitudes)
+    assert len(other) == 3
+    assert isclose(other.get_basis_state("|100>_a|001>_b"), 2.0)
+    expected = PhotonicStateVector.from_string(paths=paths,
+                                               string="2.0|100>_a|001>_b+2.0|010>_a|010>_b+1.0j|000>_a|101>_b")
+    assert other.state.isclose(expected.state)
+
+    assert isclose(wfn.inner(other), 1.0 * 2.0 + 4.0 + 1.0)
+    assert isclose(wfn.inner(wfn), wfn.state.inner(wfn.state))
+    assert isclose(wfn.normalize().inner(wfn), 1.0)
+    assert str(wfn) == str(PhotonicStateVector(paths=paths, state=wfn.state))
+
+    filtered = wfn.filter(lambda occ: occ[:, :3].sum(axis=1) == 1)
+    assert filtered.occupations.tolist() == [[1, 0, 0, 0, 0, 1], [0, 1, 0, 0, 1, 0]]
+
+
+@pytest.mark.parametrize("qpm", [1, 2, 3])
+def test_decode_keys(qpm):
+    paths = PhotonicPaths(path_names=['a', 'b', 'c'], S=1, qpm=qpm)
+    keys = numpy.random.randint(0, 2 ** paths.n_qubits, size=100)
+    occupations = paths.decode_keys(keys)
+    assert occupations.shape == (100, 3, 3)
+    for key, occ in zip(keys, occupations):
+        bits = BitString.from_int(integer=int(key), nbits=paths.n_qubits)
+        for mode in paths['b'].values():
+            expected = BitString.from_array(array=[bits[q] for q in mode.qubits]).integer
+            assert occ[1][int(mode.name) + 1] == expected
+    assert (paths.encode_occupations(occupations) == keys).all()
+    # the shifts are computed once with the paths
+    assert paths.qubit_shifts() is paths.qubit_shifts()
+
+
+def test_heralding():
+    from photonic.elements import PhotonicHeralder, PhotonicHeraldingProjector
+    paths = PhotonicPaths(path_names=['a', 'b', 'c'], S=1, qpm=2)
+    counts = PhotonicStateVector.from_string(paths=paths,
+                                             string="10|100>_a|010>_b|000>_c+20|010>_a|001>_b|000>_c"
+                                                    "+30|200>_a|000>_b|000>_c+40|000>_a|011>_b|001>_c")
+    counts = PhotonicStateVector.from_arrays(paths=paths, occupations=counts.occupations,
+                                             amplitudes=counts.amplitudes.real.astype(int))
+
+    heralder = PhotonicHeralder(paths=paths, photons=None, windows={'a': (1, 1), 'b': (1, 1)})
+    heralded, rate = heralder.herald(counts)
+    assert isclose(rate, 0.3)
+    assert heralded.get_basis_state("|010>_a|001>_b|000>_c") == 20
+    for key in counts.state.keys():
+        assert heralder.is_valid(key) == (heralded.get_basis_state(paths.interpret_bitstring(key)) != 0)
+
+    # only photons in mode 0 are counted in path b
+    heralder = PhotonicHeralder(paths=paths, windows={'a': (0, 2), 'c': (0, 1)}, mode_masks={'b': [0]})
+    heralded, rate = heralder.herald(counts)
+    assert isclose(rate, 0.4 + 0.1)
+
+    projector = PhotonicHeraldingProjector(paths=paths, active_path='c')
+    projected, rate = projector.project(counts)
+    assert isclose(rate, 0.6)
+    assert projected.paths == projector.reduced_paths
+    assert projected.get_basis_state("|200>_a|000>_b") == 30
+
+    wfn = PhotonicStateVector.from_string(paths=paths, string="1.0|100>_a|000>_b|000>_c+1.0|000>_a|000>_b|001>_c")
+    projected, rate = projector.project(wfn.normalize())
+    assert isclose(rate, 0.5)
+
+
+def test_compiled_setup():
+    from tequila import Variable
+    from tequila.hamiltonian import paulis
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=1)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=Variable("t"))
+    setup.add_phase_shifter(path='b', t=Variable("x"))
+
+    values = numpy.linspace(0.0, 0.5, 7)
+    compiled = setup.compile(initial_state="|1>_a|0>_b", observables=[paulis.Qm(setup.paths['b'][0].qubits)])
+
+    amplitudes = compiled.amplitudes(outputs=["|1>_a|0>_b", "|0>_a|1>_b"], variables={"t": values, "x": 0.3})
+    assert amplitudes.shape == (7, 2)
+    assert numpy.allclose(numpy.abs(amplitudes) ** 2, [[c ** 2, s ** 2] for c, s in
+                                                       zip(numpy.cos(pi * values), numpy.sin(pi * values))], atol=1.e-5)
+    assert numpy.allclose(compiled.expectation_values(variables={"t": values, "x": 0.3})[:, 0],
+                          numpy.sin(pi * values) ** 2, atol=1.e-5)
+
+    fock = setup.compile(initial_state="|1>_a|0>_b", engine="fock")
+    for a, b in zip(fock.simulate(variables={"t": values, "x": 0.3}), compiled.simulate(variables={"t": values, "x": 0.3})):
+        assert isclose(abs(a.inner(b)), 1.0, atol=1.e-5)
+
+    # other initial states are given to the compiled expectation values as well
+    compiled = setup.compile(initial_state="|0>_a|1>_b", observables=[paulis.Qm(setup.paths['b'][0].qubits)])
+    assert numpy.allclose(compiled.expectation_values(variables={"t": values, "x": 0.3})[:, 0],
+                          numpy.cos(pi * values) ** 2, atol=1.e-5)
+
+    # elements without variables are built once, the ones with variables for every point
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.13, exact=True)
+    setup.add_phase_shifter(path='a', t=0.4)
+    reference = [setup.simulate_wavefunction(initial_state="|1>_a|0>_b", variables={"t": t, "x": 0.3}, engine="fock")
+                 for t in values]
+    for engine in ["fock", "subspace"]:
+        compiled = setup.compile(initial_state="|1>_a|0>_b", engine=engine)
+        for a, b in zip(compiled.simulate(variables={"t": values, "x": 0.3}), reference):
+            assert isclose(a.inner(b), 1.0)
+    assert len(compiled._space._cache) == 2
+
+
+def _parallel_objective(setup):
+    from tequila import ExpectationValue
+    from tequila.hamiltonian import paulis
+    return ExpectationValue(U=setup.setup, H=-1.0 * paulis.Qm(setup.paths['b'][0].qubits))
+
+
+def test_parallel_setup():
+    from tequila import Variable, gates
+    from photonic.parallel import ParallelSetup, setup_description, build_setup
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=1)
+    setup.add_circuit(U=gates.X(target=setup.paths['a'][0].qubits))
+    setup.add_beamsplitter(path_a='a', path_b='b', t=Variable("t"))
+    setup.add_phase_shifter(path='b', t=0.3)
+
+    rebuilt = build_setup(setup_description(setup))
+    assert rebuilt.paths == setup.paths
+    assert [e.kind for e in rebuilt._abstract_setup] == [e.kind for e in setup._abstract_setup]
+
+    # gates which were not added with the methods of PhotonicSetup can not be replayed by the workers
+    other = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=1)
+    other += setup
+    with pytest.raises(Exception):
+        setup_description(other)
+    with pytest.raises(Exception):
+        ParallelSetup(setup=other, max_workers=1)
+
+    values = numpy.linspace(0.0, 0.5, 5)
+    serial = setup.compile().simulate(variables={"t": values})
+    with ParallelSetup(setup=setup, max_workers=2) as parallel:
+        results = list(parallel.simulate(variables={"t": values}, chunksize=2))
+        assert sorted(k for k, _ in results) == list(range(5))
+        for k, wfn in results:
+            assert isclose(abs(wfn.inner(serial[k])), 1.0)
+
+        results = dict(parallel.minimize(objective=_parallel_objective,
+                                         initial_values=[{"t": 0.1}, {"t": 0.3}], method="cobyla"))
+        for k in range(2):
+            assert isclose(results[k]["energy"], -1.0, atol=1.e-3)
+
+
+@pytest.mark.parametrize("qpm", [1, 2])
+def test_subspace_engine(qpm):
+    from photonic.fock import FockSpace
+    # with qpm=1 the beamsplitter is truncated in the same way as in the qubit encoding
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=1, qpm=qpm)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.13, phi=0.4, exact=True)
+    setup.add_doveprism(path='a', t=0.3)
+    setup.add_mirror(path='b')
+    setup.add_hologram(path='a')
+    setup.add_phase_shifter(path='b', t=0.7, mode=1)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.21, exact=True)
+
+    for initial_state in ["|010>_a|010>_b", "|110>_a|001>_b"]:
+        subspace = setup.simulate_wavefunction(initial_state=initial_state, engine="subspace")
+        if qpm == 1:
+            qubit = setup.simulate_wavefunction(initial_state=initial_state)
+            assert isclose(abs(subspace.inner(qubit)), 1.0, atol=1.e-4)
+        else:
+            fock = setup.simulate_wavefunction(initial_state=initial_state, engine="fock")
+            assert isclose(abs(subspace.inner(fock)), 1.0)
+
+    # 3 photons in 6 paths with S=1
+    paths = PhotonicPaths(path_names=['a', 'b', 'c', 'd', 'e', 'f'], S=1, qpm=2)
+    assert len(FockSpace(paths=paths, photons=3)) == 1140
+
+
+def test_sparse_elements():
+    import scipy.sparse
+    from photonic.fock import FockSpace
+    setup = PhotonicSetup(pathnames=['a', 'b', 'c', 'd', 'e', 'f'], S=1, qpm=2)
+    for i, (p, q) in enumerate([('a', 'b'), ('c', 'd'), ('e', 'f'), ('b', 'c'), ('d', 'e')]):
+        setup.add_beamsplitter(path_a=p, path_b=q, t=0.1 * (i + 1), phi=0.3 * i)
+        setup.add_mirror(path=q)
+        setup.add_hologram(path=p)
+        setup.add_doveprism(path=p, t=0.2)
+        setup.add_phase_shifter(path=q, t=0.4, mode=-1)
+
+    space = FockSpace(paths=setup.paths, photons=3)
+    matrices = [space.element_matrix(element) for element in setup._abstract_setup]
+    for element, matrix in zip(setup._abstract_setup, matrices):
+        assert scipy.sparse.isspmatrix_csr(matrix)
+        if element.kind in ["add_mirror", "add_hologram", "add_doveprism", "add_phase_shifter"]:
+            assert matrix.nnz == len(space)
+    # cached
+    assert space.element_matrix(setup._abstract_setup[0]) is matrices[0]
+
+    initial_state = PhotonicStateVector.from_string(paths=setup.paths,
+                                                    string="1.0|010>_a|000>_b|100>_c|000>_d|001>_e|000>_f")
+    result = space.evolve_state(elements=setup._abstract_setup, state=initial_state)
+    assert isclose(result.inner(result), 1.0)
+    fock = setup.simulate_wavefunction(initial_state=initial_state, engine="fock")
+    assert isclose(abs(result.inner(fock)), 1.0)
+
+
+def test_optimize_circuit():
+    from tequila import simulate
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=1, qpm=1)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.13)
+    setup.add_doveprism(path='a', t=0.3)
+    setup.add_mirror(path='a')
+    setup.add_phase_shifter(path='a', t=0.7, mode=1)
+    setup.add_hologram(path='b')
+    setup.add_hologram(path='b')
+    setup.add_phase_shifter(path='b', t=0.2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.21)
+    setup.add_mirror(path='b')
+    setup.add_doveprism(path='b', t=0.1)
+
+    initial_state = "|100>_a|010>_b"
+    expected = setup.simulate_wavefunction(initial_state=initial_state)
+    n_gates = len(setup.setup.gates)
+
+    setup.optimize_circuit()
+    assert setup.relabeled
+    assert len(setup.setup.gates) < n_gates
+    assert [e.kind for e in setup._abstract_setup].count("add_hologram") == 2
+    result = setup.simulate_wavefunction(initial_state=initial_state)
+    assert result.paths == setup.paths
+    assert isclose(abs(result.inner(expected)), 1.0, atol=1.e-4)
+
+    # the circuit with the relabeling resolved acts on the original qubits
+    key = setup.initialize_state(initial_state).state.keys()
+    wfn = simulate(setup.setup, initial_state=[k for k in key][0].integer)
+    assert isclose(abs(PhotonicStateVector(paths=setup.paths, state=wfn).inner(expected)), 1.0, atol=1.e-4)
+
+
+def test_lazy_relabeling():
+    from tequila import simulate
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=2, qpm=2)
+    for _ in range(3):
+        setup.add_hologram(path='a', relabel=True)
+    setup.add_mirror(path='b', relabel=True)
+    assert len(setup._setup.gates) == 0
+    assert setup.relabeled
+
+    swaps = PhotonicSetup(pathnames=['a', 'b'], S=2, qpm=2)
+    for _ in range(3):
+        swaps.add_hologram(path='a', relabel=False)
+    swaps.add_mirror(path='b', relabel=False)
+    assert not swaps.relabeled
+    # the default keeps the SWAP gates, optimize_circuit only relabels the modes of those
+    default = PhotonicSetup(pathnames=['a', 'b'], S=2, qpm=2)
+    default.add_mirror(path='b')
+    assert not default.relabeled and len(default._setup.gates) > 0
+    assert default.optimize_circuit().relabeled
+    assert not swaps.optimize_circuit().relabeled
+
+    initial_state = "|21000>_a|00013>_b"
+    expected = setup.simulate_wavefunction(initial_state=initial_state, engine="fock")
+    for s in [setup, swaps]:
+        result = s.simulate_wavefunction(initial_state=initial_state)
+        assert result.paths == s.paths
+        assert isclose(abs(result.inner(expected)), 1.0)
+        compiled = s.compile(initial_state=initial_state)
+        assert isclose(abs(compiled.simulate()[0].inner(expected)), 1.0)
+
+    # the circuit with the relabeling resolved acts on the original qubits
+    key = setup.initialize_state(initial_state).state.keys()
+    wfn = simulate(setup.setup, initial_state=[k for k in key][0].integer)
+    assert isclose(abs(PhotonicStateVector(paths=setup.paths, state=wfn).inner(expected)), 1.0)
+
+
+def test_from_string():
+    paths = PhotonicPaths(path_names=['a', 'bb', 'c1'], S=1, qpm=2)
+    state = PhotonicStateVector.from_string(paths=paths, string="(0.5+0.5i)|010>_a - 1e-3|100>_bb+0.5-1j|3>c1")
+    assert numpy.allclose(state.amplitudes, [0.5 + 0.5j, -1.e-3, 0.5 - 1.j])
+    assert state.occupations.tolist() == [[0, 1, 0, 0, 0, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0, 0, 0],
+                                          [0, 0, 0, 0, 0, 0, 0, 3, 0]]
+    assert PhotonicStateVector.string_to_basis_state("|010>_a|1>_bb") == {'a': {-1: 0, 0: 1, 1: 0}, 'bb': {0: 1}}
+
+    # duplicated terms are added up
+    state = PhotonicStateVector.from_string(paths=paths, string="|1>_a+|1>_a-2.0|2>_bb")
+    assert numpy.allclose(state.amplitudes, [2.0, -2.0])
+    assert isclose(state.get_basis_state("|010>_a|000>_bb|000>_c1"), 2.0)
+
+    for string in ["|1>_d", "|040>_a", "|00100>_a", "1.0|1>_a foo", "|10>_a", "|10>_a|1>_bb", "|>_a"]:
+        with pytest.raises(Exception):
+            PhotonicStateVector.from_string(paths=paths, string=string)
+
+
+def test_sample_stream():
+    from photonic.elements import PhotonicHeralder
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, exact=True)
+
+    chunks = [s.samples for s in setup.sample_stream(chunk=100, max_samples=250, initial_state="|1>_a|1>_b")]
+    assert chunks == [100, 200, 250]
+    runs = [list(setup.sample_stream(chunk=100, max_samples=250, initial_state="|1>_a", seed=7))[-1] for _ in range(2)]
+    assert numpy.array_equal(runs[0].counts.amplitudes, runs[1].counts.amplitudes)
+
+    # Hong-Ou-Mandel: no coincidences, stops when the heralding rate is known well enough
+    heralder = PhotonicHeralder(paths=setup.paths)
+    for statistics in setup.sample_stream(chunk=500, precision=0.01, initial_state="|1>_a|1>_b", heralder=heralder):
+        assert statistics.accepted == 0
+    assert statistics.precision() <= 0.01
+    assert statistics.heralding_interval()[1] < 0.01
+
+    statistics = list(setup.sample_stream(chunk=1000, max_samples=10000, initial_state="|1>_a|0>_b", seed=1))[-1]
+    assert statistics.samples == statistics.accepted == 10000
+    assert int(numpy.sum(statistics.counts.amplitudes)) == 10000
+    lower, upper = statistics.confidence_intervals()
+    assert numpy.all(lower <= 0.5) and numpy.all(upper >= 0.5)
+
+
+def test_sampling_cache():
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, exact=True)
+    n_gates = len(setup._setup.gates)
+
+    for _ in range(3):
+        counts = setup.sample(samples=100, initial_state="|1>_a|1>_b")
+        assert int(numpy.sum(counts.amplitudes)) == 100
+        # Hong-Ou-Mandel
+        assert isclose(counts.get_basis_state("|1>_a|1>_b"), 0)
+        assert isclose(counts.get_basis_state("|2>_a|0>_b") + counts.get_basis_state("|0>_a|2>_b"), 100)
+    counts = setup.sample(samples=100, initial_state="|1>_a|0>_b")
+    assert isclose(counts.get_basis_state("|0>_a|0>_b"), 0)
+    assert len(setup._setup.gates) == n_gates
+    # one circuit for each prepared basis state
+    assert len(setup._circuit_cache) == 2
+
+    # relabeling needs no new circuit, new gates invalidate the cache
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=1, qpm=1)
+    setup.sample(samples=10, initial_state="|010>_a|000>_b")
+    circuit, = setup._circuit_cache.values()
+    setup.add_hologram(path='a', relabel=True)
+    counts = setup.sample(samples=10, initial_state="|010>_a|000>_b")
+    assert list(setup._circuit_cache.values()) == [circuit]
+    assert isclose(counts.get_basis_state("|001>_a|000>_b"), 10)
+    setup.add_phase_shifter(path='a', t=0.5)
+    counts = setup.sample(samples=10, initial_state="|010>_a|000>_b")
+    assert isclose(counts.get_basis_state("|001>_a|000>_b"), 10)
+    setup.sample(samples=10)
+    assert len(setup._circuit_cache) == 2
+    assert all(c is not circuit for c in setup._circuit_cache.values())
+
+
+def test_superposition_input():
+    setup = PhotonicSetup(pathnames=['a', 'b', 'c'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, exact=True)
+    initial_state = "0.7071|1>_a|0>_b|1>_c+0.7071j|0>_a|1>_b|1>_c+0.5|1>_a|1>_b|0>_c"
+    expected = setup.simulate_wavefunction(initial_state=initial_state, engine="fock")
+    result = setup.simulate_wavefunction(initial_state=initial_state)
+    assert isclose(abs(result.inner(expected)), abs(expected.inner(expected)), atol=1.e-4)
+    compiled = setup.compile(initial_state=initial_state)
+    assert isclose(abs(compiled.simulate()[0].inner(expected)), abs(expected.inner(expected)), atol=1.e-4)
+
+    counts = setup.sample(samples=10000, initial_state=initial_state)
+    assert int(numpy.sum(counts.amplitudes)) == 10000
+    probabilities = numpy.abs(expected.amplitudes) ** 2 / abs(expected.inner(expected))
+    drawn = numpy.real([counts.get_basis_state(expected.occupation_string(o)) for o in expected.occupations.tolist()])
+    assert isclose(numpy.sum(drawn), 10000)
+    assert numpy.allclose(drawn / 10000, probabilities, atol=0.03)
+    # the photon in c is not touched by any gate, but counted
+    counts = setup.sample(samples=100, initial_state="|1>_a|0>_b|1>_c")
+    assert numpy.all(counts.occupations[:, 2] == 1)
+    assert numpy.all(counts.occupations[:, 0] + counts.occupations[:, 1] == 1)
+
+
+def test_transfer_table():
+    import itertools
+    setup = PhotonicSetup(pathnames=['a', 'b', 'c', 'd'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, exact=True)
+    setup.add_phase_shifter(path='b', t=0.3)
+    setup.add_beamsplitter(path_a='b', path_b='c', t=0.13, exact=True)
+    setup.add_beamsplitter(path_a='c', path_b='d', t=0.41, exact=True)
+
+    # all inputs with one photon in two of the four paths
+    inputs = ["".join("|{}>_{}".format(int(p in occupied), p) for p in "abcd")
+              for occupied in itertools.combinations("abcd", 2)]
+    outputs, table = setup.transfer_table(inputs=inputs)
+    assert table.shape == (len(inputs), len(outputs))
+    assert numpy.allclose(numpy.sum(numpy.abs(table) ** 2, axis=1), 1.0)
+    for k, initial_state in enumerate(inputs):
+        expected = setup.output_amplitudes(initial_state=initial_state, outputs=outputs)
+        assert numpy.allclose(table[k], expected)
+
+    outputs = ["|2>_a", "|1>_a|1>_d", "|1>_a"]
+    _, table = setup.transfer_table(inputs=inputs, outputs=outputs)
+    assert numpy.allclose(table[:, 2], 0.0)
+    assert numpy.allclose(table[:, :2], [setup.output_amplitudes(initial_state=i, outputs=outputs[:2]) for i in inputs])
+
+
+def test_adjoint_gradient():
+    import tequila as tq
+    a, b, c, d = [tq.Variable(name) for name in "abcd"]
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=1, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=a, phi=d, exact=True)
+    setup.add_phase_shifter(path='a', t=pi * b, mode=1)
+    setup.add_doveprism(path='b', t=c)
+    setup.add_hologram(path='b')
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.3, phi=2 * d, exact=True)
+    setup.add_mirror(path='a')
+    setup.add_beamsplitter(path_a='a', path_b='b', t=-a, exact=True)
+
+    initial_state = "0.8944|001>_a|001>_b+0.4472|010>_a|001>_b"
+    variables = {"a": 0.21, "b": 0.13, "c": 0.37, "d": 0.4}
+    for observable in [lambda occupations: occupations[:, 0] + 2.0 * occupations[:, 1] * occupations[:, 4],
+                       ["|100>_a|001>_b", "|000>_a|011>_b"]]:
+        value, gradient = setup.gradient(initial_state=initial_state, observable=observable, variables=variables)
+        for k in variables:
+            shifted = [dict(variables), dict(variables)]
+            shifted[0][k] += 1.e-6
+            shifted[1][k] -= 1.e-6
+            plus, minus = [setup.gradient(initial_state=initial_state, observable=observable, variables=v)[0]
+                           for v in shifted]
+            assert isclose(gradient[tq.Variable(k)], (plus - minus) / 2.e-6, atol=1.e-6)
+
+    wfn = setup.simulate_wavefunction(initial_state=initial_state, variables=variables, engine="subspace")
+    probability = sum(abs(wfn.get_basis_state(output)) ** 2 for output in observable)
+    assert isclose(value, probability)
+
+
+def test_photon_loss():
+    from photonic.noise import LossModel
+    from photonic.parallel import ParallelSetup
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, exact=True)
+    eta = 0.7
+    expected = {"|2>_a|0>_b": 0.5 * eta ** 2, "|1>_a|0>_b": eta * (1.0 - eta), "|0>_a|0>_b": (1.0 - eta) ** 2,
+                "|1>_a|1>_b": 0.0}
+
+    # losses in front of the detectors are exact
+    result = setup.simulate_losses(initial_state="|1>_a|1>_b", model=LossModel(detector_efficiency=eta),
+                                   trajectories=1)
+    for output, p in expected.items():
+        assert isclose(result.probabilities().get_basis_state(output), p)
+
+    # the same losses after the beamsplitter as trajectories
+    model = LossModel(elements={"add_beamsplitter": eta})
+    result = setup.simulate_losses(initial_state="|1>_a|1>_b", model=model, trajectories=2000, seed=1)
+    probabilities = result.probabilities()
+    errors = dict(zip([probabilities.occupation_string(o) for o in probabilities.occupations.tolist()],
+                      result.standard_errors()))
+    for output, p in expected.items():
+        assert isclose(probabilities.get_basis_state(output), p, atol=5 * errors.get(output, 0.0) + 1.e-10)
+    assert isclose(numpy.sum(probabilities.amplitudes), 1.0)
+
+    with ParallelSetup(setup=setup, initial_state="|1>_a|1>_b", engine="subspace", max_workers=2) as pool:
+        runs = [r.trajectories for r in pool.trajectories(model=model, trajectories=250, batch=100, seed=1)]
+    assert runs[-1] == 250 and len(runs) == 3
+    with ParallelSetup(setup=setup, engine="subspace", max_workers=1) as pool:
+        with pytest.raises(Exception):
+            pool.trajectories(model=model, trajectories=10)
+
+    # a lossy phase shifter on one mode leaves the photons in the other modes alone
+    setup = PhotonicSetup(pathnames=['a'], S=1, qpm=1)
+    setup.add_phase_shifter(path='a', t=0.3, mode=1)
+    result = setup.simulate_losses(initial_state="|101>_a", model=LossModel(elements={"add_phase_shifter": eta}),
+                                   trajectories=2000, seed=1)
+    probabilities = result.probabilities()
+    assert isclose(probabilities.get_basis_state("|100>_a"), 1.0 - eta, atol=0.05)
+    assert isclose(probabilities.get_basis_state("|001>_a"), 0.0)
+
+
+def test_threshold_detectors():
+    from photonic.noise import ThresholdDetectors
+    from photonic.elements import PhotonicHeralder
+    paths = PhotonicPaths(path_names=['a', 'b'], S=1, qpm=2)
+    detectors = ThresholdDetectors(paths=paths, efficiency={'a': 0.8, 'b': 0.5}, dark_counts=0.1)
+    heralder = PhotonicHeralder(paths=paths, photons=1)
+    state = PhotonicStateVector.from_string(paths=paths, string="|020>_a|001>_b")
+    # exactly one click per path: from the photons (and no dark count) or from one dark count
+    a = 1.0 - 0.2 ** 2 * 0.9
+    b = 1.0 - 0.5 * 0.9
+    expected = (a * 0.9 ** 2 + (1.0 - a) * 2 * 0.1 * 0.9) * (b * 0.9 ** 2 + (1.0 - b) * 2 * 0.1 * 0.9)
+    assert isclose(detectors.herald_probability(state=state, heralder=heralder), expected)
+
+    counts = PhotonicStateVector.from_arrays(paths=paths, occupations=state.occupations, amplitudes=[20000])
+    clicks = detectors.clicks(counts=counts, seed=1)
+    assert int(numpy.sum(clicks.amplitudes)) == 20000
+    assert numpy.all(clicks.occupations <= 1)
+    _, rate = heralder.herald(clicks)
+    assert isclose(rate, expected, atol=0.02)
+
+    states = [state, PhotonicStateVector.from_string(paths=paths, string="|010>_a|000>_b")]
+    assert detectors.herald_probability(state=states, heralder=heralder).shape == (2,)
+
+    detectors = ThresholdDetectors(paths=paths, crosstalk=1.0)
+    clicks = detectors.clicks(counts=counts)
+    assert clicks.occupations.tolist() == [[1, 1, 1, 0, 1, 1]]
+    with pytest.raises(Exception):
+        detectors.herald_probability(state=state, heralder=heralder)
+
+
+def test_partial_distinguishability():
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, exact=True)
+    outputs = ["|1>_a|1>_b", "|2>_a", "|2>_b"]
+    for overlap in [0.0, 0.3, 1.0]:
+        # HOM dip: the coincidence probability drops with the squared overlap of the photons
+        p = setup.output_probabilities(initial_state="|1>_a|1>_b", outputs=outputs, gram=overlap)
+        assert numpy.allclose(p, [(1.0 - overlap ** 2) / 2, (1.0 + overlap ** 2) / 4, (1.0 + overlap ** 2) / 4])
+
+    setup = PhotonicSetup(pathnames=['a', 'b', 'c'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.25, exact=True)
+    setup.add_phase_shifter(path='b', t=0.3)
+    setup.add_beamsplitter(path_a='b', path_b='c', t=0.13, exact=True)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=0.41, exact=True)
+    initial_state = "|1>_a|1>_b|1>_c"
+    outputs = ["|1>_a|1>_b|1>_c", "|2>_a|1>_c", "|3>_b"]
+    exact = numpy.abs(setup.output_amplitudes(initial_state=initial_state, outputs=outputs)) ** 2
+    assert numpy.allclose(setup.output_probabilities(initial_state=initial_state, outputs=outputs), exact)
+
+    # internal states of the photons and their Gram matrix
+    vectors = numpy.asarray([[1.0, 0.0], [0.6, 0.8j], [0.0, 1.0]])
+    gram = vectors.conj().dot(vectors.T)
+    p = setup.output_probabilities(initial_state=initial_state, outputs=outputs, gram=gram)
+    assert numpy.allclose(p, setup.output_probabilities(initial_state=initial_state, outputs=outputs, gram=gram,
+                                                        order=3))
+    # photons 0 and 2 are orthogonal, only pairs can interfere and the truncation at pairs is exact
+    assert numpy.allclose(p, setup.output_probabilities(initial_state=initial_state, outputs=outputs, gram=gram,
+                                                        order=2))
+    distinguishable = setup.output_probabilities(initial_state=initial_state, outputs=outputs, gram=0.0)
+    assert numpy.allclose(distinguishable, setup.output_probabilities(initial_state=initial_state, outputs=outputs,
+                                                                      gram=gram, order=0))
+    assert not numpy.allclose(p, distinguishable)
+
+
+def test_serialization(tmp_path):
+    import json
+    from tequila import Variable
+    from photonic import serialization
+    from photonic.elements import operator_cache
+    setup = PhotonicSetup(pathnames=['a', 'b', 'c'], S=1, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=Variable("t"), exact=True)
+    setup.add_mirror(path='b')
+    setup.add_beamsplitter(path_a='b', path_b='c', t=0.13, phi=numpy.float64(0.4))
+    setup.add_doveprism(path='c', t=Variable(("x", 1)))
+    setup.add_phase_shifter(path='a', t=0.3, mode=-1)
+
+    filename = str(tmp_path / "setup.json")
+    serialization.save(setup, filename=filename)
+    operator_cache.clear()
+    maxsize, operator_cache.maxsize = operator_cache.maxsize, 1
+    try:
+        rebuilt = serialization.load(filename)
+    finally:
+        operator_cache.maxsize = maxsize
+    # all operators come from the file, the small global cache is not used
+    assert operator_cache.misses == operator_cache.hits == 0
+    assert rebuilt.operator_cache is operator_cache
+    assert rebuilt.paths == setup.paths
+    assert [e.parameters for e in rebuilt._abstract_setup] == [e.parameters for e in setup._abstract_setup]
+    variables = {"t": 0.2, ("x", 1): 0.7}
+    assert str(rebuilt.setup) == str(setup.setup)
+    expected = setup.simulate_wavefunction(initial_state="|1>_a|1>_b", variables=variables, engine="fock")
+    wfn = rebuilt.simulate_wavefunction(initial_state="|1>_a|1>_b", variables=variables, engine="fock")
+    assert isclose(abs(wfn.inner(expected)), 1.0)
+    assert "operators" not in json.loads(serialization.dumps(setup, operators=False))
+
+    state = serialization.loads(serialization.dumps(expected))
+    assert numpy.array_equal(state.occupations, expected.occupations)
+    assert numpy.allclose(state.amplitudes, expected.amplitudes)
+    counts = setup.sample(samples=10, initial_state="|1>_a", variables=variables, engine="fock")
+    assert numpy.array_equal(serialization.loads(serialization.dumps(counts)).amplitudes, counts.amplitudes)
+
+    data = serialization.setup_to_dict(setup)
+    data["version"] = serialization.VERSION + 1
+    with pytest.raises(Exception):
+        serialization.setup_from_dict(data)
+    setup.add_phase_shifter(path='a', t=pi * Variable("y"))
+    with pytest.raises(Exception):
+        serialization.dumps(setup)
+
+    # setups with their own OperatorCache do not touch the global one
+    operator_cache.clear()
+    own = OperatorCache()
+    other = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2, cache=own)
+    other.add_beamsplitter(path_a='a', path_b='b', t=0.2)
+    other.add_beamsplitter(path_a='a', path_b='b', t=0.3, exact=True)
+    assert len(own) > 0 and len(operator_cache) == 0
+
+
+def _cached_build(directory, t):
+    from photonic.disk_cache import DiskCache
+    from photonic.serialization import setup_description
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=t, exact=True)
+    return len(DiskCache(directory=directory).build_setup(setup_description(setup)).setup.gates)
+
+
+def test_disk_cache(tmp_path):
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+    from tequila import Variable
+    from photonic.disk_cache import DiskCache
+    from photonic.parallel import ParallelSetup
+    from photonic.serialization import setup_description
+    setup = PhotonicSetup(pathnames=['a', 'b', 'c'], S=1, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=Variable("t"), steps=2)
+    setup.add_hologram(path='c')
+    setup.add_beamsplitter(path_a='b', path_b='c', t=0.13, exact=True)
+    description = setup_description(setup)
+
+    cache = DiskCache(directory=str(tmp_path / "cache"))
+    first = cache.build_setup(description)
+    assert cache.misses == 1 and len(cache) == 1
+    operator_cache.clear()
+    second = DiskCache(directory=str(tmp_path / "cache")).build_setup(description)
+    assert operator_cache.misses == 0
+    assert str(first.setup) == str(second.setup) == str(setup.setup)
+
+    # the entry of a different setup evicts the least recently used one
+    other = dict(description, elements=description["elements"][:1])
+    small = DiskCache(directory=str(tmp_path / "cache"), max_bytes=cache.size())
+    small.build_setup(other)
+    assert len(small) == 1 and small.size() <= cache.size()
+    small.build_setup(other)
+    assert small.hits == 1
+
+    # processes which build the same setups at the same time
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(_cached_build, [str(tmp_path / "shared")] * 8, [0.1, 0.2] * 4))
+    assert results[0::2] == [results[0]] * 4
+    assert len(DiskCache(directory=str(tmp_path / "shared"))) == 2
+    # no temporary files or locks are left behind
+    assert all(name.endswith(".json") for name in os.listdir(str(tmp_path / "shared")))
+
+    # a holder which ran past the timeout does not remove the lock of the process which took it over
+    lock = str(tmp_path / "cache" / ".lock")
+    with cache._lock():
+        with open(lock, "w") as f:
+            f.write("other")
+    with open(lock, "r") as f:
+        assert f.read() == "other"
+    os.remove(lock)
+    with cache._lock():
+        os.remove(lock)
+    assert not os.path.exists(lock)
+
+    setup = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2)
+    setup.add_beamsplitter(path_a='a', path_b='b', t=Variable("t"), exact=True)
+    # gates added with += can not be replayed from the cache
+    other = PhotonicSetup(pathnames=['a', 'b'], S=0, qpm=2)
+    other += setup
+    with pytest.raises(Exception):
+        cache.build_setup(setup_description(other))
+    with ParallelSetup(setup=setup, initial_state="|1>_a|1>_b", max_workers=2,
+                       cache=str(tmp_path / "cache")) as parallel:
+        results = dict(parallel.simulate(variables={"t": [0.1, 0.2]}))
+    for k, wfn in results.items():
+        expected = setup.simulate_wavefunction(initial_state="|1>_a|1>_b", variables={"t": [0.1, 0.2][k]})
+        assert isclose(abs(wfn.inner(expected)), 1.0, atol=1.e-4)
+
+
 if __name__ == "__main__":
     test_notation(silent=False)
 